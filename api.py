@@ -1,122 +1,342 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import jwt_required
 from app import db
-from models import User, Run, CoinWallet, Seed, Plant, Garden, IntensityLevel, PlantStage, StravaAccount
-from utils import calculate_coins_for_run, create_default_seeds
+from auth import current_user_id
+from models import (User, Run, CoinWallet, Plant, Garden, IntensityLevel, PlantStage, StravaAccount, SyncJob,
+                    UserRunStats, XP_PER_KM)
+from utils import (calculate_coins_for_run, get_user_run_stats, aggregate_user_run_stats, water_garden,
+                   water_garden_with_runs, page_user_runs, count_user_runs)
 from strava_service import strava_service
+from strava_tasks import strava_bound
+from replicas import replica_reads
+from seed_catalog import seed_catalog
+from entity_versions import wallet_etag, garden_etag, stats_etag
+import coin_ledger
+from serializers import run_rows_to_dicts, garden_dict
+from sync_jobs import enqueue_sync
+from strava_webhooks import record_event, schedule_processing
 from datetime import datetime, timezone
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 
 api_bp = Blueprint('api', __name__)
 
+# Largest number of runs accepted by POST /runs/batch
+MAX_BATCH_RUNS = 500
+MAX_CLIENT_ID_LENGTH = 64
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def with_etag(response, etag):
+    """Tag a response so the client can poll it with If-None-Match"""
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def parse_date_param(value):
+    """Parse an ISO 8601 date or datetime query parameter as naive UTC"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def validate_run_data(data):
+    """Validate a run payload, returning (values, error)"""
+    distance_km = data.get('distance_km')
+    duration_minutes = data.get('duration_minutes')
+    intensity = data.get('intensity', 'moderate')
+    
+    # Validation
+    if not distance_km or not duration_minutes:
+        return None, 'Distance and duration are required'
+    
+    try:
+        distance_km = float(distance_km)
+        duration_minutes = int(duration_minutes)
+    except (ValueError, TypeError):
+        return None, 'Invalid distance or duration format'
+    
+    if distance_km <= 0 or duration_minutes <= 0:
+        return None, 'Distance and duration must be positive'
+    
+    if distance_km > 200:  # Reasonable upper limit
+        return None, 'Distance seems unrealistic (max 200km)'
+    
+    if duration_minutes > 1440:  # Max 24 hours
+        return None, 'Duration seems unrealistic (max 24 hours)'
+    
+    # Validate intensity
+    try:
+        intensity_enum = IntensityLevel(str(intensity).lower())
+    except ValueError:
+        return None, 'Invalid intensity level. Use: low, moderate, high, extreme'
+    
+    return {
+        'distance_km': distance_km,
+        'duration_minutes': duration_minutes,
+        'intensity': intensity_enum,
+        # Calculate pace
+        'pace_min_per_km': duration_minutes / distance_km,
+        # Calculate coins earned
+        'coins_earned': calculate_coins_for_run(distance_km, intensity_enum)
+    }, None
+
 @api_bp.route('/runs', methods=['POST'])
 @jwt_required()
 def log_run():
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         data = request.get_json()
         
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        distance_km = data.get('distance_km')
-        duration_minutes = data.get('duration_minutes')
-        intensity = data.get('intensity', 'moderate')
+        values, error = validate_run_data(data)
+        if error:
+            return jsonify({'error': error}), 400
         
-        # Validation
-        if not distance_km or not duration_minutes:
-            return jsonify({'error': 'Distance and duration are required'}), 400
-        
-        try:
-            distance_km = float(distance_km)
-            duration_minutes = int(duration_minutes)
-        except (ValueError, TypeError):
-            return jsonify({'error': 'Invalid distance or duration format'}), 400
+        distance_km = values['distance_km']
+        intensity_enum = values['intensity']
+        coins_earned = values['coins_earned']
         
-        if distance_km <= 0 or duration_minutes <= 0:
-            return jsonify({'error': 'Distance and duration must be positive'}), 400
-        
-        if distance_km > 200:  # Reasonable upper limit
-            return jsonify({'error': 'Distance seems unrealistic (max 200km)'}), 400
-        
-        if duration_minutes > 1440:  # Max 24 hours
-            return jsonify({'error': 'Duration seems unrealistic (max 24 hours)'}), 400
-        
-        # Validate intensity
-        try:
-            intensity_enum = IntensityLevel(intensity.lower())
-        except ValueError:
-            return jsonify({'error': 'Invalid intensity level. Use: low, moderate, high, extreme'}), 400
-        
-        # Calculate pace
-        pace_min_per_km = duration_minutes / distance_km
-        
-        # Calculate coins earned
-        coins_earned = calculate_coins_for_run(distance_km, intensity_enum)
+        # Load running aggregates before the new run is pending so a first-time
+        # rebuild from history doesn't count it twice
+        stats = get_user_run_stats(user_id)
         
         # Create run record
         run = Run()
         run.user_id = user_id
         run.distance_km = distance_km
-        run.duration_minutes = duration_minutes
+        run.duration_minutes = values['duration_minutes']
         run.intensity = intensity_enum
-        run.pace_min_per_km = pace_min_per_km
+        run.pace_min_per_km = values['pace_min_per_km']
         run.coins_earned = coins_earned
         
         db.session.add(run)
         
-        # Update coin wallet
-        wallet = CoinWallet.query.filter_by(user_id=user_id).first()
-        if not wallet:
-            wallet = CoinWallet()
-            wallet.user_id = user_id
-            db.session.add(wallet)
+        # Credit the coins without locking the wallet
+        coin_ledger.credit(user_id, coins_earned, coin_ledger.RUN)
         
-        wallet.add_coins(coins_earned)
+        # Update running aggregates
+        stats.add_run(run)
         
         # Update garden and plants
         garden = Garden.query.filter_by(user_id=user_id).first()
         if garden:
             # Add experience to garden
-            experience_points = int(distance_km * 10)  # 10 XP per km
+            experience_points = int(distance_km * XP_PER_KM)
             garden.add_experience(experience_points)
             
-            # Water all plants in the garden
-            for plant in garden.plants:
-                plant.water(distance_km, intensity_enum)
+            # The run happens now, after every plant was planted, so it waters them all
+            plants = water_garden(garden.id, Plant.growth_boost(distance_km, intensity_enum))
+            
+            stats.set_plant_counts(plants)
         
+        total_coins = coin_ledger.balance(user_id)
         db.session.commit()
         
         return jsonify({
             'message': 'Run logged successfully',
             'run': run.to_dict(),
             'coins_earned': coins_earned,
-            'total_coins': wallet.balance
+            'total_coins': total_coins
         }), 201
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Failed to log run: {str(e)}'}), 500
 
+@api_bp.route('/runs/batch', methods=['POST'])
+@jwt_required()
+def log_runs_batch():
+    """Log runs buffered by an offline client in a single transaction.
+    
+    Runs carrying a client_id already stored for the user are reported as
+    duplicates instead of logged again, so a client can safely retry an upload.
+    """
+    try:
+        user_id = current_user_id()
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('runs'), list) or not data['runs']:
+            return jsonify({'error': 'A non-empty runs list is required'}), 400
+        
+        if len(data['runs']) > MAX_BATCH_RUNS:
+            return jsonify({'error': f'Too many runs in one batch (max {MAX_BATCH_RUNS})'}), 400
+        
+        # Validate every item up front, invalid items are reported and skipped
+        items = []
+        for index, item in enumerate(data['runs']):
+            if not isinstance(item, dict):
+                items.append((index, None, 'Run must be an object'))
+                continue
+            
+            values, error = validate_run_data(item)
+            if not error and item.get('created_at'):
+                # When the run happened, as recorded by the client
+                try:
+                    values['created_at'] = parse_date_param(str(item['created_at']))
+                except ValueError:
+                    error = 'Invalid created_at format'
+            if not error and item.get('client_id') is not None:
+                client_id = item['client_id']
+                if isinstance(client_id, bool) or not isinstance(client_id, (str, int)) \
+                        or not 0 < len(str(client_id)) <= MAX_CLIENT_ID_LENGTH:
+                    error = f'Invalid client_id (a string of at most {MAX_CLIENT_ID_LENGTH} characters)'
+                else:
+                    values['client_id'] = str(client_id)
+            items.append((index, values, error))
+        
+        try:
+            results, runs, total_coins, balance = store_runs_batch(user_id, items)
+        except IntegrityError:
+            # A concurrent retry of the same upload stored some of its runs first, they are duplicates now
+            db.session.rollback()
+            results, runs, total_coins, balance = store_runs_batch(user_id, items)
+        
+        if not runs:
+            if any(result['status'] == 'duplicate' for result in results):
+                return jsonify({'message': 'No new runs in batch', 'results': results, 'coins_earned': 0}), 200
+            return jsonify({'error': 'No valid runs in batch', 'results': results}), 400
+        
+        return jsonify({
+            'message': f'Logged {len(runs)} of {len(results)} runs',
+            'results': results,
+            'coins_earned': total_coins,
+            'total_coins': balance
+        }), 201
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Failed to log runs: {str(e)}'}), 500
+
+def store_runs_batch(user_id, items):
+    """Store the valid batch items that aren't duplicates and apply their effects once.
+    
+    Returns (results, created runs, coins earned, balance), committing unless nothing is new.
+    """
+    client_ids = [values['client_id'] for _, values, _ in items if values and 'client_id' in values]
+    stored = {}
+    if client_ids:
+        stored = {run.client_id: run for run in Run.query.filter(Run.user_id == user_id, Run.client_id.in_(client_ids))}
+    
+    results = []
+    runs = []
+    for index, values, error in items:
+        if error:
+            results.append({'index': index, 'status': 'error', 'error': error})
+            continue
+        
+        client_id = values.get('client_id')
+        if client_id in stored:
+            # Sent before, or twice in this batch
+            results.append({'index': index, 'status': 'duplicate', 'run': stored[client_id]})
+            continue
+        
+        run = Run(user_id=user_id, **values)
+        runs.append(run)
+        if client_id is not None:
+            stored[client_id] = run
+        results.append({'index': index, 'status': 'created', 'run': run})
+    
+    if not runs:
+        return runs_to_dicts(results), runs, 0, None
+    
+    # Load running aggregates before the new runs are pending
+    stats = get_user_run_stats(user_id)
+    
+    db.session.add_all(runs)
+    
+    total_coins = 0
+    total_experience = 0
+    for run in runs:
+        stats.add_run(run)
+        total_coins += run.coins_earned
+        total_experience += int(run.distance_km * XP_PER_KM)
+    
+    # Credit the coins once for the whole batch
+    coin_ledger.credit(user_id, total_coins, coin_ledger.RUN)
+    
+    # Update garden and plants once for the whole batch
+    garden = Garden.query.filter_by(user_id=user_id).first()
+    if garden:
+        garden.add_experience(total_experience)
+        
+        # Runs recorded offline only water the plants planted by the time they happened
+        plants = water_garden_with_runs(garden.id, runs)
+        
+        stats.set_plant_counts(plants)
+    
+    balance = coin_ledger.balance(user_id)
+    db.session.commit()
+    
+    return runs_to_dicts(results), runs, total_coins, balance
+
+def runs_to_dicts(results):
+    for result in results:
+        if 'run' in result:
+            result['run'] = result['run'].to_dict()
+    return results
+
 @api_bp.route('/runs', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_runs():
     try:
-        user_id = get_jwt_identity()
-        page = request.args.get('page', 1, type=int)
-        per_page = min(request.args.get('per_page', 20, type=int), 100)
+        user_id = current_user_id()
+        per_page = request.args.get('per_page', 20, type=int)
+        # Sizes below 1 fall back to the default, as paginate does
+        per_page = min(per_page if per_page > 0 else 20, 100)
+        
+        # Older app versions still page by number
+        if 'page' in request.args and 'cursor' not in request.args:
+            page = request.args.get('page', 1, type=int)
+            runs = Run.query.filter_by(user_id=user_id).order_by(Run.created_at.desc()).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            
+            return jsonify({
+                'runs': [run.to_dict() for run in runs.items],
+                'pagination': {
+                    'page': runs.page,
+                    'pages': runs.pages,
+                    'total': runs.total,
+                    'per_page': runs.per_page
+                }
+            }), 200
+        
+        try:
+            since = parse_date_param(request.args.get('since'))
+            until = parse_date_param(request.args.get('until'))
+        except ValueError:
+            return jsonify({'error': 'Invalid since or until date, use ISO 8601'}), 400
+        
+        try:
+            runs, next_cursor = page_user_runs(
+                user_id, per_page, cursor=request.args.get('cursor'), since=since, until=until
+            )
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
         
-        runs = Run.query.filter_by(user_id=user_id).order_by(Run.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        pagination = {
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        # Counting walks the whole range, so only do it when asked
+        if request.args.get('include_total', 'false').lower() == 'true':
+            pagination['total'] = count_user_runs(user_id, since=since, until=until)
         
         return jsonify({
-            'runs': [run.to_dict() for run in runs.items],
-            'pagination': {
-                'page': runs.page,
-                'pages': runs.pages,
-                'total': runs.total,
-                'per_page': runs.per_page
-            }
+            'runs': run_rows_to_dicts(runs),
+            'pagination': pagination
         }), 200
         
     except Exception as e:
@@ -124,36 +344,46 @@ def get_runs():
 
 @api_bp.route('/wallet', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_wallet():
     try:
-        user_id = get_jwt_identity()
-        wallet = CoinWallet.query.filter_by(user_id=user_id).first()
+        user_id = current_user_id()
+        
+        # Unchanged since the client's last poll
+        etag = wallet_etag(user_id)
+        if etag and etag in request.if_none_match:
+            return not_modified(etag)
+        
+        wallet, pending = db.session.query(CoinWallet, coin_ledger.pending_credits(user_id)).filter(
+            CoinWallet.user_id == user_id
+        ).first() or (None, 0)
         
         if not wallet:
             wallet = CoinWallet()
             wallet.user_id = user_id
             db.session.add(wallet)
             db.session.commit()
+            etag = wallet_etag(user_id)
+            # Credits can be recorded before the wallet exists
+            pending = db.session.execute(select(coin_ledger.pending_credits(user_id))).scalar()
         
-        return jsonify({'wallet': wallet.to_dict()}), 200
+        return with_etag(jsonify({'wallet': wallet.to_dict(pending)}), etag), 200
         
     except Exception as e:
         return jsonify({'error': f'Failed to get wallet: {str(e)}'}), 500
 
 @api_bp.route('/seeds', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_seeds():
     try:
-        # Ensure default seeds exist
-        if Seed.query.count() == 0:
-            create_default_seeds()
-            db.session.commit()
+        version, _, body = seed_catalog.snapshot()
         
-        seeds = Seed.query.filter_by(is_available=True).all()
-        
-        return jsonify({
-            'seeds': [seed.to_dict() for seed in seeds]
-        }), 200
+        response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(f'seeds-{version}')
+        # Clients must revalidate, which is a 304 until the catalog changes
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
         
     except Exception as e:
         return jsonify({'error': f'Failed to get seeds: {str(e)}'}), 500
@@ -162,17 +392,16 @@ def get_seeds():
 @jwt_required()
 def buy_seed(seed_id):
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         data = request.get_json() or {}
         
         # Get seed
-        seed = Seed.query.get(seed_id)
-        if not seed or not seed.is_available:
+        seed = seed_catalog.get_seed(seed_id)
+        if not seed or not seed['is_available']:
             return jsonify({'error': 'Seed not found or not available'}), 404
         
-        # Get user's wallet
-        wallet = CoinWallet.query.filter_by(user_id=user_id).first()
-        if not wallet or wallet.balance < seed.cost_coins:
+        # Fail fast before the garden checks; the purchase itself re-checks atomically
+        if coin_ledger.balance(user_id) < seed['cost_coins']:
             return jsonify({'error': 'Insufficient coins'}), 400
         
         # Get user's garden
@@ -204,24 +433,28 @@ def buy_seed(seed_id):
         if existing_plant:
             return jsonify({'error': 'Position already occupied'}), 400
         
-        # Process purchase
-        wallet.spend_coins(seed.cost_coins)
+        # Process purchase, unless concurrent purchases spent the coins first
+        if not coin_ledger.spend(user_id, seed['cost_coins']):
+            db.session.rollback()
+            return jsonify({'error': 'Insufficient coins'}), 400
+        get_user_run_stats(user_id).add_plant()
         
         # Plant the seed
         plant = Plant()
         plant.garden_id = garden.id
-        plant.seed_id = seed.id
+        plant.seed_id = seed['id']
         plant.position_x = position_x
         plant.position_y = position_y
-        plant.name = data.get('name', seed.name)
+        plant.name = data.get('name', seed['name'])
         
         db.session.add(plant)
+        remaining_coins = coin_ledger.balance(user_id)
         db.session.commit()
         
         return jsonify({
             'message': 'Seed purchased and planted successfully',
             'plant': plant.to_dict(),
-            'remaining_coins': wallet.balance
+            'remaining_coins': remaining_coins
         }), 201
         
     except Exception as e:
@@ -230,18 +463,27 @@ def buy_seed(seed_id):
 
 @api_bp.route('/garden', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_garden():
     try:
-        user_id = get_jwt_identity()
-        garden = Garden.query.filter_by(user_id=user_id).first()
+        user_id = current_user_id()
+        
+        # Unchanged since the client's last poll
+        etag = garden_etag(user_id)
+        if etag and etag in request.if_none_match:
+            return not_modified(etag)
+        
+        garden = garden_dict(user_id)
         
         if not garden:
-            garden = Garden()
-            garden.user_id = user_id
-            db.session.add(garden)
+            new_garden = Garden()
+            new_garden.user_id = user_id
+            db.session.add(new_garden)
             db.session.commit()
+            garden = garden_dict(user_id)
+            etag = garden_etag(user_id)
         
-        return jsonify({'garden': garden.to_dict()}), 200
+        return with_etag(jsonify({'garden': garden}), etag), 200
         
     except Exception as e:
         return jsonify({'error': f'Failed to get garden: {str(e)}'}), 500
@@ -250,7 +492,7 @@ def get_garden():
 @jwt_required()
 def update_garden():
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         data = request.get_json()
         
         if not data:
@@ -268,7 +510,7 @@ def update_garden():
         
         return jsonify({
             'message': 'Garden updated successfully',
-            'garden': garden.to_dict()
+            'garden': garden_dict(user_id)
         }), 200
         
     except Exception as e:
@@ -279,7 +521,7 @@ def update_garden():
 @jwt_required()
 def update_plant(plant_id):
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         data = request.get_json()
         
         if not data:
@@ -334,51 +576,59 @@ def update_plant(plant_id):
 
 @api_bp.route('/stats', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_stats():
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
+        
+        # Unchanged since the client's last poll
+        etag = stats_etag(user_id)
+        if etag and etag in request.if_none_match:
+            return not_modified(etag)
         
         # Get user stats
         user = User.query.get(user_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Calculate running stats
-        runs = Run.query.filter_by(user_id=user_id).all()
-        total_distance = sum(run.distance_km for run in runs)
-        total_duration = sum(run.duration_minutes for run in runs)
-        total_runs = len(runs)
+        # Running totals and plant counts come from the pre-aggregated row
+        stats = UserRunStats.query.filter_by(user_id=user_id).first()
+        if stats is None:
+            # Registration and rebuild-run-stats create the row; until then count from history, without writing
+            stats = aggregate_user_run_stats(UserRunStats(user_id=user_id), user_id)
+        total_distance = stats.total_distance_km
+        total_duration = stats.total_duration_minutes
+        total_runs = stats.total_runs
         
-        # Get wallet info
-        wallet = CoinWallet.query.filter_by(user_id=user_id).first()
+        # Get wallet info, with credits not yet compacted into it
+        wallet, pending = db.session.query(CoinWallet, coin_ledger.pending_credits(user_id)).filter(
+            CoinWallet.user_id == user_id
+        ).first() or (None, 0)
         
         # Get garden info
         garden = Garden.query.filter_by(user_id=user_id).first()
         
         # Plant statistics
-        plants_by_stage = {}
-        if garden:
-            for stage in PlantStage:
-                count = Plant.query.filter_by(garden_id=garden.id, stage=stage).count()
-                plants_by_stage[stage.value] = count
+        plants_by_stage = stats.plants_by_stage() if garden else {}
         
-        return jsonify({
+        return with_etag(jsonify({
             'user': user.to_dict(),
             'running_stats': {
                 'total_runs': total_runs,
                 'total_distance_km': round(total_distance, 2),
                 'total_duration_minutes': total_duration,
                 'average_distance_km': round(total_distance / total_runs, 2) if total_runs > 0 else 0,
-                'average_pace_min_per_km': round(total_duration / total_distance, 2) if total_distance > 0 else 0
+                'average_pace_min_per_km': round(total_duration / total_distance, 2) if total_distance > 0 else 0,
+                'best_pace_min_per_km': round(stats.best_pace_min_per_km, 2) if stats.best_pace_min_per_km else None
             },
-            'wallet': wallet.to_dict() if wallet else None,
+            'wallet': wallet.to_dict(pending) if wallet else None,
             'garden': {
                 'level': garden.level if garden else 1,
                 'experience_points': garden.experience_points if garden else 0,
-                'total_plants': len(garden.plants) if garden else 0,
+                'total_plants': sum(plants_by_stage.values()),
                 'plants_by_stage': plants_by_stage
             }
-        }), 200
+        }), etag), 200
         
     except Exception as e:
         return jsonify({'error': f'Failed to get stats: {str(e)}'}), 500
@@ -386,9 +636,9 @@ def get_stats():
 @api_bp.route('/strava/sync', methods=['POST'])
 @jwt_required()
 def sync_strava_activities():
-    """Sync recent activities from Strava"""
+    """Queue a background sync of recent activities from Strava"""
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         data = request.get_json() or {}
         days_back = data.get('days_back', 7)
         
@@ -397,42 +647,100 @@ def sync_strava_activities():
         if not strava_account:
             return jsonify({'error': 'No Strava account connected. Please connect your Strava account first.'}), 400
         
-        # Sync activities
-        result = strava_service.sync_recent_activities(user_id, days_back)
+        try:
+            days_back = int(days_back)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid days_back format'}), 400
         
-        if 'error' in result:
-            return jsonify(result), 400
+        # Queue the sync, reusing a job already in flight for this user
+        job, created = enqueue_sync(user_id, days_back)
         
         return jsonify({
-            'message': 'Strava activities synced successfully',
-            **result
-        }), 200
+            'message': 'Strava sync queued' if created else 'Strava sync already in progress',
+            'job': job.to_dict()
+        }), 202, {'Location': f'/api/strava/sync/{job.id}'}
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': f'Failed to sync Strava activities: {str(e)}'}), 500
 
+@api_bp.route('/strava/sync/<job_id>', methods=['GET'])
+@jwt_required()
+def get_strava_sync_job(job_id):
+    """Get the status and result of a Strava sync job"""
+    try:
+        user_id = current_user_id()
+        
+        job = SyncJob.query.filter_by(id=job_id, user_id=user_id).first()
+        if not job:
+            return jsonify({'error': 'Sync job not found'}), 404
+        
+        return jsonify({'job': job.to_dict()}), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'Failed to get sync job: {str(e)}'}), 500
+
 @api_bp.route('/strava/stats', methods=['GET'])
 @jwt_required()
+@strava_bound
 def get_strava_stats():
     """Get Strava athlete statistics"""
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         
         # Check if user has Strava connected
         strava_account = StravaAccount.query.filter_by(user_id=user_id, is_active=True).first()
         if not strava_account:
             return jsonify({'error': 'No Strava account connected'}), 400
+        account_info = strava_account.to_dict()
         
         # Get Strava stats
-        strava_stats = strava_service.get_athlete_stats(user_id)
+        strava_stats = yield from strava_service.get_athlete_stats(user_id)
         
         if not strava_stats:
             return jsonify({'error': 'Failed to retrieve Strava statistics'}), 500
         
         return jsonify({
             'strava_stats': strava_stats,
-            'account_info': strava_account.to_dict()
+            'account_info': account_info
         }), 200
         
     except Exception as e:
         return jsonify({'error': f'Failed to get Strava stats: {str(e)}'}), 500
+
+@api_bp.route('/strava/webhook', methods=['GET'])
+def verify_strava_webhook():
+    """Answer Strava's push subscription validation handshake"""
+    verify_token = current_app.config.get('STRAVA_WEBHOOK_VERIFY_TOKEN')
+    
+    if request.args.get('hub.mode') != 'subscribe' or not verify_token \
+            or request.args.get('hub.verify_token') != verify_token:
+        return jsonify({'error': 'Invalid webhook verification request'}), 403
+    
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')}), 200
+
+@api_bp.route('/strava/webhook', methods=['POST'])
+def receive_strava_webhook():
+    """Queue a Strava activity or athlete event for processing"""
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        # Ignore events that don't belong to our subscription
+        subscription_id = current_app.config.get('STRAVA_WEBHOOK_SUBSCRIPTION_ID')
+        if subscription_id and str(data.get('subscription_id')) != str(subscription_id):
+            return jsonify({'error': 'Unknown subscription'}), 403
+        
+        event = record_event(data)
+        if not event:
+            return jsonify({'error': 'Invalid event payload'}), 400
+        
+        # Strava expects a reply within two seconds, so processing happens off the request
+        schedule_processing()
+        
+        return jsonify({'message': 'Event received'}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Failed to receive Strava event: {str(e)}'}), 500
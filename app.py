@@ -1,23 +1,38 @@
 import os
+import time
 import logging
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, configure_mappers
 from werkzeug.middleware.proxy_fix import ProxyFix
+from json_provider import OrjsonProvider
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging, DEBUG only when asked for since it slows every request down
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+class RoutingSession(Session):
+    """Session that reads from the replica picked for its request until it writes, see replicas.py"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get('replica')
+        if (replica is not None and bind is None and not self._flushing and not self.info.get('wrote')
+                and getattr(clause, '_for_update_arg', None) is None):
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 def create_app():
     # Create the app
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
     app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
     
@@ -27,21 +42,63 @@ def create_app():
         "pool_recycle": 300,
         "pool_pre_ping": True,
     }
+    if os.environ.get("DATABASE_POOL_SIZE"):
+        # Connections kept per process, e.g. one per gthread worker thread
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"] = int(os.environ["DATABASE_POOL_SIZE"])
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     
+    # Configure read replicas, comma separated URLs each becoming a bind, see replicas.py
+    replica_urls = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    app.config["SQLALCHEMY_BINDS"] = {f"replica_{i}": url for i, url in enumerate(replica_urls, 1)}
+    app.config["DATABASE_REPLICA_BINDS"] = list(app.config["SQLALCHEMY_BINDS"])
+    app.config["REPLICA_STICKY_SECONDS"] = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+    
     # Configure JWT
     app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY", "jwt-secret-change-in-production")
     app.config["JWT_ACCESS_TOKEN_EXPIRES"] = False  # Tokens don't expire for mobile app convenience
     
+    # Configure Strava webhooks
+    app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"] = os.environ.get("STRAVA_WEBHOOK_VERIFY_TOKEN")
+    app.config["STRAVA_WEBHOOK_SUBSCRIPTION_ID"] = os.environ.get("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+    
+    # Configure background Strava syncs
+    app.config["STRAVA_SYNC_WORKERS"] = int(os.environ.get("STRAVA_SYNC_WORKERS", 2))
+    app.config["STRAVA_SYNC_EAGER"] = os.environ.get("STRAVA_SYNC_EAGER", "false").lower() == "true"
+    
+    # Configure the async serving mode (SERVING_MODE=async), see strava_async.py
+    app.config["SERVING_MODE"] = os.environ.get("SERVING_MODE", "sync").lower()
+    app.config["STRAVA_ASYNC_CONCURRENCY"] = int(os.environ.get("STRAVA_ASYNC_CONCURRENCY", 50))
+    app.config["ASYNC_WORKER_THREADS"] = int(os.environ.get("ASYNC_WORKER_THREADS", 8))
+    
+    # Configure password hashing, done in a separate process pool unless eager
+    app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+    app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+    app.config["PASSWORD_HASH_EAGER"] = os.environ.get("PASSWORD_HASH_EAGER", "false").lower() == "true"
+    
+    # Configure metrics and slow request logging
+    app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 100))
+    app.config["SLOW_REQUEST_MS"] = float(os.environ.get("SLOW_REQUEST_MS", 500))
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+    
+    # Configure request profiling, off unless a token or a sampling rate is set
+    app.config["PROFILE_TOKEN"] = os.environ.get("PROFILE_TOKEN")
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    app.config["PROFILE_INTERVAL_MS"] = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+    app.config["PROFILE_KEEP"] = int(os.environ.get("PROFILE_KEEP", 100))
+    
     # Initialize extensions
     db.init_app(app)
     jwt = JWTManager(app)
     CORS(app)
     
-    # Import models to ensure they're registered
+    # Import models to ensure they're registered, then bring the schema up to date
     with app.app_context():
         import models
-        db.create_all()
+        from migrations import upgrade_schema
+        upgrade_schema()
+        # Done here rather than on the first request, and before forking when gunicorn preloads
+        configure_mappers()
     
     # Register blueprints
     from auth import auth_bp
@@ -50,6 +107,15 @@ def create_app():
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(api_bp, url_prefix='/api')
     
+    from replicas import init_replicas
+    init_replicas(app)
+    
+    from metrics import init_metrics
+    init_metrics(app)
+    
+    from profiling import init_profiling
+    init_profiling(app)
+    
     # Main route for documentation
     from flask import render_template
     
@@ -65,6 +131,63 @@ def create_app():
     def strava_test():
         return render_template('strava_test.html')
     
+    from sync_scheduler import sync_fleet_command
+    from strava_webhooks import process_webhook_events_command
+    app.cli.add_command(sync_fleet_command)
+    app.cli.add_command(process_webhook_events_command)
+    
+    from migrations import db_upgrade_command, check_query_plans_command
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(check_query_plans_command)
+    
+    from coin_ledger import compact_coin_ledger_command
+    app.cli.add_command(compact_coin_ledger_command)
+    
+    @app.cli.command('generate-data')
+    @click.option('--users', default=1000, show_default=True, help='Users to generate.')
+    @click.option('--runs-per-user', default=120, show_default=True, help='Mean runs per user.')
+    @click.option('--history-days', default=730, show_default=True, help='How far back signups and runs go.')
+    @click.option('--strava-share', default=0.35, show_default=True, help='Share of users with a Strava account.')
+    @click.option('--chunk-size', default=2000, show_default=True, help='Users per transaction.')
+    @click.option('--seed', default=0, show_default=True, help='Random seed, for reproducible datasets.')
+    @click.option('--password', default='synthetic-password', show_default=True, help='Password shared by every generated user.')
+    def generate_data(users, runs_per_user, history_days, strava_share, chunk_size, seed, password):
+        """Fill the database with a realistic synthetic population"""
+        # Imported here, numpy would otherwise add to every worker's start
+        from synthetic_data import SyntheticDataGenerator
+        
+        started = time.monotonic()
+        counts = SyntheticDataGenerator(
+            users, runs_per_user=runs_per_user, history_days=history_days, strava_share=strava_share,
+            chunk_size=chunk_size, seed=seed, password=password
+        ).run()
+        print(", ".join(f"{key}={value}" for key, value in counts.items()) + f" in {time.monotonic() - started:.1f}s")
+    
+    @app.cli.command('rebuild-run-stats')
+    def rebuild_run_stats():
+        """Recompute every user's running aggregates from their run history, creating missing rows"""
+        from models import User
+        from utils import rebuild_user_run_stats
+        
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+        for user_id in user_ids:
+            rebuild_user_run_stats(user_id)
+            db.session.commit()
+        
+        print(f"Rebuilt running stats for {len(user_ids)} users")
+    
+    @app.cli.command('recompute-rules')
+    @click.option('--apply', is_flag=True, help='Write the changes instead of only reporting them.')
+    @click.option('--chunk-size', default=500, show_default=True, help='Users per batch.')
+    def recompute_rules(apply, chunk_size):
+        """Recompute coins, garden XP and plant growth from run history"""
+        from rules_engine import RulesRecomputation
+        
+        summary = RulesRecomputation(chunk_size=chunk_size, dry_run=not apply).run()
+        for line in summary.pop('samples'):
+            print(line)
+        print(("Applied: " if apply else "Dry run: ") + ", ".join(f"{key}={value}" for key, value in summary.items()))
+    
     return app
 
 app = create_app()
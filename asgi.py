@@ -0,0 +1,5 @@
+"""ASGI entry point for SERVING_MODE=async, see strava_async.py"""
+from app import app as flask_app
+from strava_async import AsyncStravaServer
+
+app = AsyncStravaServer(flask_app)
@@ -3,6 +3,9 @@ from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identi
 from app import db
 from models import User, CoinWallet, Garden, Seed, StravaAccount
 from strava_service import strava_service
+from strava_tasks import strava_bound, strava_call
+from replicas import replica_reads
+from utils import new_user_run_stats
 from datetime import datetime, timezone, timedelta
 import re
 import os
@@ -16,6 +19,10 @@ def validate_email(email):
 def validate_password(password):
     return len(password) >= 8
 
+def current_user_id():
+    """The signed-in user's id, which tokens carry as a string subject"""
+    return int(get_jwt_identity())
+
 @auth_bp.route('/register', methods=['POST'])
 def register():
     try:
@@ -67,10 +74,13 @@ def register():
         garden.user_id = user.id
         db.session.add(garden)
         
+        # Create running aggregates
+        new_user_run_stats(user.id)
+        
         db.session.commit()
         
         # Create access token
-        access_token = create_access_token(identity=user.id)
+        access_token = create_access_token(identity=str(user.id))
         
         return jsonify({
             'message': 'User registered successfully',
@@ -105,8 +115,11 @@ def login():
         if not user.is_active:
             return jsonify({'error': 'Account is deactivated'}), 401
         
+        # Save the hash if check_password upgraded it
+        db.session.commit()
+        
         # Create access token
-        access_token = create_access_token(identity=user.id)
+        access_token = create_access_token(identity=str(user.id))
         
         return jsonify({
             'message': 'Login successful',
@@ -119,9 +132,10 @@ def login():
 
 @auth_bp.route('/profile', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_profile():
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         user = User.query.get(user_id)
         
         if not user:
@@ -194,10 +208,11 @@ def strava_callback():
 
 @auth_bp.route('/strava/link', methods=['POST'])
 @jwt_required()
+@strava_bound
 def link_strava_account():
     """Link Strava account to user profile"""
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         data = request.get_json()
         
         if not data or 'access_token' not in data:
@@ -209,9 +224,7 @@ def link_strava_account():
         # In a real implementation, you'd get the full token data from the callback
         # For now, we'll create a placeholder for the missing fields
         try:
-            from stravalib.client import Client
-            client = Client(access_token=access_token)
-            athlete = client.get_athlete()
+            athlete = yield strava_call('get_athlete', access_token)
         except Exception as e:
             return jsonify({'error': f'Invalid access token: {str(e)}'}), 400
         
@@ -277,7 +290,7 @@ def link_strava_account():
 def disconnect_strava():
     """Disconnect Strava account"""
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         
         strava_account = StravaAccount.query.filter_by(
             user_id=user_id,
@@ -302,7 +315,7 @@ def disconnect_strava():
 def strava_status():
     """Get Strava connection status"""
     try:
-        user_id = get_jwt_identity()
+        user_id = current_user_id()
         
         strava_account = StravaAccount.query.filter_by(
             user_id=user_id,
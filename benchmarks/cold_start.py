@@ -0,0 +1,185 @@
+"""Cold start benchmark: how long until a fresh process serves its first request?
+
+Prepares a migrated SQLite database with one user, then starts --runs fresh
+Python processes that each:
+- import main, which builds the app and checks the schema (import_ms);
+- serve GET /api/stats through the test client, cold then warm (first_request_ms, second_request_ms).
+The wall time of the whole process is recorded too (process_ms), and so is
+whether stravalib got imported along the way.
+
+With gunicorn installed it also starts `gunicorn main:app` the way the
+deployment does, picking up gunicorn.conf.py, and records the time from spawn
+to the first 200 (gunicorn_first_response_ms).
+
+Medians are compared with benchmarks/cold_start_baseline.json and the script
+exits non-zero when one is worse than --tolerance allows. Timings are machine
+specific, refresh them with --update-baseline on the machine that runs the check.
+--root measures another checkout, e.g. a git worktree of an older commit.
+
+    python benchmarks/cold_start.py [--runs 5] [--workers 2] [--root PATH] [--update-baseline]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_baseline.json')
+
+SETUP = '''
+import json
+from main import app
+with app.test_client() as client:
+    client.post('/auth/register', json={'email': 'cold@start.example', 'username': 'coldstart', 'password': 'cold-start-password'})
+from models import User
+with app.app_context():
+    print(json.dumps({'user_id': User.query.filter_by(username='coldstart').first().id}))
+'''
+
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+
+from flask_jwt_extended import create_access_token
+with app.app_context():
+    headers = {'Authorization': 'Bearer ' + create_access_token(identity=sys.argv[1])}
+
+client = app.test_client()
+timings = []
+for _ in range(2):
+    began = time.perf_counter()
+    response = client.get('/api/stats', headers=headers)
+    timings.append(time.perf_counter() - began)
+    assert response.status_code == 200, response.status_code
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': timings[0] * 1000,
+    'second_request_ms': timings[1] * 1000,
+    'stravalib_imported': 'stravalib' in sys.modules,
+}))
+'''
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_python(code, root, env, *args):
+    result = subprocess.run([sys.executable, '-c', code, *args], cwd=root, env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(f'Benchmark process failed:\n{result.stderr[-3000:]}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure_process(root, env, user_id):
+    started = time.perf_counter()
+    sample = run_python(CHILD, root, env, str(user_id))
+    sample['process_ms'] = (time.perf_counter() - started) * 1000
+    return sample
+
+def measure_gunicorn(root, env, workers):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers), 'main:app'],
+        cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < 60:
+            try:
+                if requests.get(f'http://127.0.0.1:{port}/docs', timeout=5).status_code == 200:
+                    return (time.perf_counter() - started) * 1000
+            except requests.RequestException:
+                if server.poll() is not None:
+                    break
+            time.sleep(0.01)
+        sys.exit('gunicorn did not start')
+    finally:
+        server.terminate()
+        server.wait()
+
+def summarize(samples):
+    return {
+        key: round(statistics.median(sample[key] for sample in samples), 1)
+        for key in samples[0] if key.endswith('_ms')
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes to measure')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--root', default=ROOT, help='Checkout to measure')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Allowed growth factor of each median')
+    parser.add_argument('--slack-ms', type=float, default=50, help='Allowed growth on top of the factor')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cold-start-benchmark-')
+    env = dict(
+        os.environ,
+        DATABASE_URL='sqlite:///' + os.path.join(workdir, 'cold_start.db'),
+        PASSWORD_HASH_EAGER='true',
+        PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+    )
+    try:
+        user_id = run_python(SETUP, args.root, env)['user_id']
+        samples = [measure_process(args.root, env, user_id) for _ in range(args.runs)]
+        results = summarize(samples)
+        if importlib.util.find_spec('gunicorn'):
+            results['gunicorn_first_response_ms'] = round(statistics.median(
+                measure_gunicorn(args.root, env, args.workers) for _ in range(args.runs)
+            ), 1)
+        else:
+            print('gunicorn is not installed, skipping the gunicorn run')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for key, value in results.items():
+        print(f'{key:<28}{value:>10.1f}')
+    print(f"{'stravalib imported':<28}{str(any(sample['stravalib_imported'] for sample in samples)):>10}")
+
+    output = {
+        'meta': {'runs': args.runs, 'workers': args.workers, 'python': platform.python_version(), 'machine': platform.machine()},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2)
+            f.write('\n')
+        print(f'Wrote {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = [
+        f'{key}: {value} ms, baseline {baseline[key]} ms'
+        for key, value in results.items()
+        if key in baseline and value > baseline[key] * args.tolerance + args.slack_ms
+    ]
+    if regressions:
+        print(f'\n{len(regressions)} regressions against {args.baseline}:')
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,472 @@
+"""Endpoint benchmark: every auth and api route against a generated dataset.
+
+Generates a SQLite dataset with SyntheticDataGenerator and stubs Strava with
+FakeStravaClient. It then runs one scenario per route twice:
+- through the Flask test client, recording latency, throughput and SQL statements per request;
+- through a real gunicorn, configured like the Procfile, recording latency and throughput
+  under concurrent clients.
+
+The acting user is a Strava-connected user at the 90th percentile of run
+history. Syncs and webhook events are processed inline (STRAVA_SYNC_EAGER) so
+their cost lands in the measured request.
+
+Results are compared with benchmarks/baseline.json and the script exits non-zero on:
+- a route without a scenario;
+- an unexpected status;
+- more SQL statements per request than the baseline;
+- latency or throughput worse than the tolerance allows, on every retry. Client
+  runs are gated on p95. gunicorn runs are gated on p50 and throughput, because
+  their tails mostly measure how busy the machine is.
+
+Latency baselines are machine specific. Refresh them with --update-baseline
+on the machine that runs the check. Statement counts are not machine specific.
+
+    python benchmarks/endpoints.py [--mode client|gunicorn|both] [--users 600] [--requests 30] [--gunicorn-requests 100] [--update-baseline]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn_conf.py')
+WEBHOOK_VERIFY_TOKEN = 'benchmark-verify-token'
+PASSWORD = 'synthetic-password'
+
+# The latency percentile checked against the baseline, and how much worse it may get, per mode
+GATED_LATENCY = {'client': 'p95_ms', 'gunicorn': 'p50_ms'}
+TOLERANCE = {'client': 1.5, 'gunicorn': 2.0}
+
+class Scenario:
+    """One benchmarked request.
+
+    path, body and headers are values or callables of (i, fixture, state),
+    where state is what prepare(fixture, count) returned before the batch.
+    """
+    def __init__(self, name, method, path, body=None, headers=None, status=200, auth=True, prepare=None):
+        self.name = name
+        self.endpoint = name.split(' ')[0]
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.status = status
+        self.auth = auth
+        self.prepare = prepare
+
+    def build(self, i, fixture, state):
+        resolve = lambda value: value(i, fixture, state) if callable(value) else value
+        headers = dict(fixture.headers) if self.auth else {}
+        headers.update(resolve(self.headers) or {})
+        return self.method, resolve(self.path), resolve(self.body), headers
+
+def build_fixture(app):
+    """Pick the acting user and mint the tokens the scenarios need"""
+    from flask_jwt_extended import create_access_token
+    from sqlalchemy import func, select
+    from app import db
+    from models import Garden, Plant, Run, StravaAccount, User
+
+    accounts = db.session.execute(
+        select(StravaAccount.user_id, StravaAccount.strava_athlete_id, func.count(Run.id))
+        .join(Run, Run.user_id == StravaAccount.user_id)
+        .group_by(StravaAccount.user_id, StravaAccount.strava_athlete_id)
+        .order_by(func.count(Run.id), StravaAccount.user_id)
+    ).all()
+    if len(accounts) < 2:
+        sys.exit('The dataset has too few Strava users, raise --users')
+    user_id, athlete_id, run_count = accounts[int(len(accounts) * 0.9)]
+
+    user = db.session.get(User, user_id)
+    garden = Garden.query.filter_by(user_id=user_id).first()
+    plant_ids = [plant_id for (plant_id,) in db.session.query(Plant.id).filter_by(garden_id=garden.id).order_by(Plant.id)]
+    if not plant_ids:
+        sys.exit('The acting user has no plants, use another --seed')
+
+    return argparse.Namespace(
+        user_id=user_id,
+        email=user.email,
+        athlete_id=athlete_id,
+        run_count=run_count,
+        garden_id=garden.id,
+        plant_ids=plant_ids,
+        headers={'Authorization': 'Bearer ' + create_access_token(identity=str(user_id))},
+        other_user_ids=[account[0] for account in accounts if account[0] != user_id],
+        client=app.test_client(),
+    )
+
+def prepare_disconnect(fixture, count):
+    """Every disconnect needs its own connected user"""
+    from flask_jwt_extended import create_access_token
+    from app import db
+    from models import StravaAccount
+
+    if len(fixture.other_user_ids) < count:
+        sys.exit(f'auth.disconnect_strava needs {count} other Strava users, raise --users')
+    user_ids = fixture.other_user_ids[:count]
+    StravaAccount.query.filter(StravaAccount.user_id.in_(user_ids)).update({'is_active': True}, synchronize_session=False)
+    db.session.commit()
+    return [{'Authorization': 'Bearer ' + create_access_token(identity=str(user_id))} for user_id in user_ids]
+
+def prepare_buy(fixture, count):
+    """Clear plants bought by earlier batches, fund the wallet and list free cells"""
+    from app import db
+    import coin_ledger
+    from entity_versions import bump_versions
+    from models import Garden, Plant, Seed
+
+    Plant.query.filter(Plant.garden_id == fixture.garden_id, Plant.id.notin_(fixture.plant_ids)).delete(synchronize_session=False)
+    bump_versions(db.session.connection(), Garden, [fixture.garden_id])
+
+    seed = Seed.query.filter_by(is_available=True).order_by(Seed.cost_coins, Seed.id).first()
+    coin_ledger.credit(fixture.user_id, seed.cost_coins * count, coin_ledger.ADJUSTMENT)
+    coin_ledger.compact([fixture.user_id])
+
+    garden = db.session.get(Garden, fixture.garden_id)
+    occupied = {(x, y) for x, y in db.session.query(Plant.position_x, Plant.position_y).filter_by(garden_id=garden.id)}
+    if garden.size_x * garden.size_y < len(occupied) + count:
+        # Enough room for the batch, whatever the user's level
+        garden.size_y = math.ceil((len(occupied) + count) / garden.size_x)
+    db.session.commit()
+
+    cells = [(x, y) for y in range(garden.size_y) for x in range(garden.size_x) if (x, y) not in occupied]
+    return seed.id, cells[:count]
+
+def prepare_sync_job(fixture, count):
+    response = fixture.client.post('/api/strava/sync', json={}, headers=fixture.headers)
+    return response.get_json()['job']['id']
+
+def prepare_etag(path):
+    """A client that already holds the current representation"""
+    def prepare(fixture, count):
+        return fixture.client.get(path, headers=fixture.headers).headers['ETag']
+    return prepare
+
+def build_scenarios():
+    from fake_strava import ACTIVITIES_PER_SYNC, activity_ids
+
+    run = lambda i: {'distance_km': 3 + i % 10, 'duration_minutes': 18 + 5 * (i % 10), 'intensity': 'moderate'}
+    if_none_match = lambda i, fixture, state: {'If-None-Match': state}
+
+    return [
+        Scenario('auth.register', 'POST', '/auth/register', auth=False, status=201, body=lambda i, fixture, state: {
+            'email': f'bench{time.time_ns()}-{i}@benchmark.example', 'username': f'b{time.time_ns() % 10**12}{i}', 'password': PASSWORD
+        }),
+        Scenario('auth.login', 'POST', '/auth/login', auth=False,
+                 body=lambda i, fixture, state: {'email': fixture.email, 'password': PASSWORD}),
+        Scenario('auth.get_profile', 'GET', '/auth/profile'),
+        Scenario('auth.connect_strava', 'GET', '/auth/strava/connect'),
+        Scenario('auth.strava_callback', 'GET', lambda i, fixture, state: f'/auth/strava/callback?code=synthetic-code-{fixture.athlete_id}', auth=False),
+        Scenario('auth.link_strava_account', 'POST', '/auth/strava/link',
+                 body=lambda i, fixture, state: {'access_token': f'synthetic-access-{fixture.athlete_id}'}),
+        Scenario('auth.strava_status', 'GET', '/auth/strava/status'),
+        Scenario('auth.disconnect_strava', 'POST', '/auth/strava/disconnect', auth=False,
+                 prepare=prepare_disconnect, headers=lambda i, fixture, state: state[i]),
+        Scenario('api.get_runs', 'GET', '/api/runs?per_page=20'),
+        Scenario('api.get_runs deep', 'GET', '/api/runs?per_page=20&page=10'),
+        Scenario('api.log_run', 'POST', '/api/runs', status=201, body=lambda i, fixture, state: run(i)),
+        Scenario('api.log_runs_batch', 'POST', '/api/runs/batch', status=201,
+                 body=lambda i, fixture, state: {'runs': [run(i + j) for j in range(20)]}),
+        Scenario('api.get_wallet', 'GET', '/api/wallet'),
+        Scenario('api.get_wallet 304', 'GET', '/api/wallet', status=304, prepare=prepare_etag('/api/wallet'), headers=if_none_match),
+        Scenario('api.get_seeds', 'GET', '/api/seeds'),
+        Scenario('api.get_seeds 304', 'GET', '/api/seeds', status=304, prepare=prepare_etag('/api/seeds'), headers=if_none_match),
+        Scenario('api.buy_seed', 'POST', lambda i, fixture, state: f'/api/seeds/{state[0]}/buy', status=201, prepare=prepare_buy,
+                 body=lambda i, fixture, state: {'position_x': state[1][i][0], 'position_y': state[1][i][1]}),
+        Scenario('api.get_garden', 'GET', '/api/garden'),
+        Scenario('api.get_garden 304', 'GET', '/api/garden', status=304, prepare=prepare_etag('/api/garden'), headers=if_none_match),
+        Scenario('api.update_garden', 'PUT', '/api/garden', body=lambda i, fixture, state: {'name': f'Benchmark garden {i % 2}'}),
+        Scenario('api.update_plant', 'PUT', lambda i, fixture, state: f'/api/plants/{fixture.plant_ids[0]}',
+                 body=lambda i, fixture, state: {'name': f'Benchmark plant {i % 2}'}),
+        Scenario('api.get_stats', 'GET', '/api/stats'),
+        Scenario('api.get_stats 304', 'GET', '/api/stats', status=304, prepare=prepare_etag('/api/stats'), headers=if_none_match),
+        Scenario('api.sync_strava_activities', 'POST', '/api/strava/sync', status=202, body={'days_back': 7}),
+        Scenario('api.get_strava_sync_job', 'GET', lambda i, fixture, state: f'/api/strava/sync/{state}', prepare=prepare_sync_job),
+        Scenario('api.get_strava_stats', 'GET', '/api/strava/stats'),
+        Scenario('api.verify_strava_webhook', 'GET', auth=False,
+                 path=f'/api/strava/webhook?hub.mode=subscribe&hub.verify_token={WEBHOOK_VERIFY_TOKEN}&hub.challenge=benchmark'),
+        Scenario('api.receive_strava_webhook', 'POST', '/api/strava/webhook', auth=False, body=lambda i, fixture, state: {
+            'object_type': 'activity', 'aspect_type': 'update', 'owner_id': fixture.athlete_id,
+            'object_id': activity_ids(fixture.athlete_id)[i % ACTIVITIES_PER_SYNC], 'event_time': int(time.time())
+        }),
+    ]
+
+def missing_routes(app, scenarios):
+    covered = {scenario.endpoint for scenario in scenarios}
+    return sorted({
+        rule.endpoint for rule in app.url_map.iter_rules()
+        if rule.endpoint.split('.')[0] in ('auth', 'api') and rule.endpoint not in covered
+    })
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] * 1e3
+
+def summarize(latencies, elapsed, queries=None):
+    return {
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'rps': round(len(latencies) / elapsed, 1),
+        'queries': sorted(queries)[len(queries) // 2] if queries else None,
+    }
+
+def check_status(scenario, status, body, errors):
+    if status != scenario.status:
+        errors.append(f'{scenario.name}: expected {scenario.status}, got {status} {body[:200]!r}')
+
+def run_client(app, scenarios, fixture, count, warmup, errors):
+    """Drive each scenario sequentially through the test client, counting SQL statements"""
+    from sqlalchemy import event
+    from app import db
+
+    statements = [0]
+    def count_statement(*args):
+        statements[0] += 1
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    results = {}
+    try:
+        for scenario in scenarios:
+            state = scenario.prepare(fixture, warmup + count) if scenario.prepare else None
+            latencies, queries = [], []
+            for i in range(warmup + count):
+                method, path, body, headers = scenario.build(i, fixture, state)
+                statements[0] = 0
+                start = time.perf_counter()
+                response = fixture.client.open(path, method=method, json=body, headers=headers)
+                elapsed = time.perf_counter() - start
+                check_status(scenario, response.status_code, response.get_data(as_text=True), errors)
+                if i >= warmup:
+                    latencies.append(elapsed)
+                    queries.append(statements[0])
+            results[scenario.name] = summarize(latencies, sum(latencies), queries)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+    return results
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(workers):
+    port = free_port()
+    env = dict(os.environ, BENCHMARK_BIND=f'127.0.0.1:{port}', BENCHMARK_WORKERS=str(workers))
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', GUNICORN_CONF, 'app:create_app()'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(150):
+        try:
+            requests.get(base_url + '/docs', timeout=5)
+            return server, base_url
+        except requests.RequestException:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    sys.exit('gunicorn did not start')
+
+def run_gunicorn(scenarios, fixture, count, warmup, concurrency, workers, errors):
+    """Drive each scenario from concurrent clients against a real gunicorn"""
+    server, base_url = start_gunicorn(workers)
+    sessions = threading.local()
+
+    def send(scenario, i, state):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        method, path, body, headers = scenario.build(i, fixture, state)
+        start = time.perf_counter()
+        response = sessions.session.request(method, base_url + path, json=body, headers=headers)
+        elapsed = time.perf_counter() - start
+        check_status(scenario, response.status_code, response.text, errors)
+        return elapsed
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for scenario in scenarios:
+                state = scenario.prepare(fixture, warmup + count) if scenario.prepare else None
+                for i in range(warmup):
+                    send(scenario, i, state)
+                start = time.perf_counter()
+                latencies = list(pool.map(lambda i: send(scenario, i, state), range(warmup, warmup + count)))
+                results[scenario.name] = summarize(latencies, time.perf_counter() - start)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+def compare(results, baseline, tolerances, slack_ms):
+    """List regressions against the baseline as (mode, scenario name, timing only, message).
+
+    Statement counts must not grow. The gated latency may grow by the tolerance
+    factor plus slack_ms, and gunicorn throughput may drop by the same factor
+    plus slack_ms per request, so sub-millisecond routes don't fail on noise.
+    """
+    regressions = []
+    for mode, scenarios in results.items():
+        for name, result in scenarios.items():
+            base = baseline.get(mode, {}).get(name)
+            if not base:
+                continue
+            if result['queries'] is not None and base.get('queries') is not None and result['queries'] > base['queries']:
+                regressions.append((mode, name, False, f"{result['queries']} SQL statements per request, baseline {base['queries']}"))
+            latency = GATED_LATENCY[mode]
+            tolerance = tolerances[mode]
+            if result[latency] > base[latency] * tolerance + slack_ms:
+                regressions.append((mode, name, True, f"{latency[:3]} {result[latency]:.1f} ms, baseline {base[latency]:.1f} ms"))
+            # Sequential client throughput is only the mean latency again
+            if mode != 'client' and result['rps'] * tolerance < base['rps'] and 1e3 / result['rps'] - 1e3 / base['rps'] > slack_ms:
+                regressions.append((mode, name, True, f"{result['rps']:.1f} requests/s, baseline {base['rps']:.1f}"))
+    return regressions
+
+def print_results(mode, results, baseline):
+    print(f'\n{mode}')
+    print(f"{'scenario':32} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'SQL':>5} {'base ' + GATED_LATENCY[mode][:3]:>9} {'base SQL':>9}")
+    for name, result in results.items():
+        base = baseline.get(mode, {}).get(name, {})
+        queries = '' if result['queries'] is None else result['queries']
+        print(
+            f"{name:32} {result['p50_ms']:8.1f} {result['p95_ms']:8.1f} {result['p99_ms']:8.1f} {result['rps']:8.1f} {queries!s:>5} "
+            f"{base.get(GATED_LATENCY[mode], ''):>9} {'' if base.get('queries') is None else base['queries']!s:>9}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'both'], default='both')
+    parser.add_argument('--users', type=int, default=600, help='Size of the generated dataset')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the generated dataset')
+    parser.add_argument('--requests', type=int, default=30, help='Measured requests per scenario')
+    parser.add_argument('--gunicorn-requests', type=int, default=100, help='Measured requests per scenario against gunicorn')
+    parser.add_argument('--warmup', type=int, default=3, help='Unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients against gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--tolerance', type=float, help='Allowed latency growth / throughput drop factor, for every mode')
+    parser.add_argument('--retries', type=int, default=2, help='Times a scenario that got slower is measured again')
+    parser.add_argument('--slack-ms', type=float, default=5, help='Allowed latency growth on top of the factor')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    # Configure the app before it is imported, gunicorn inherits the same environment
+    workdir = tempfile.mkdtemp(prefix='endpoint-benchmark-')
+    os.environ.update(
+        DATABASE_URL='sqlite:///' + os.path.join(workdir, 'benchmark.db'),
+        STRAVA_SYNC_EAGER='true',
+        STRAVA_WEBHOOK_VERIFY_TOKEN=WEBHOOK_VERIFY_TOKEN,
+        STRAVA_CLIENT_ID='1',
+        STRAVA_CLIENT_SECRET='benchmark',
+    )
+    os.environ.pop('STRAVA_WEBHOOK_SUBSCRIPTION_ID', None)
+    sys.path.insert(0, ROOT)
+
+    from fake_strava import FakeStravaClient
+    from app import app
+    from strava_service import strava_service
+    from synthetic_data import SyntheticDataGenerator
+    logging.disable(logging.WARNING)
+    strava_service.client_class = FakeStravaClient
+
+    try:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        meta = {'users': args.users, 'seed': args.seed, 'requests': args.requests, 'gunicorn_requests': args.gunicorn_requests, 'concurrency': args.concurrency, 'workers': args.workers}
+        if baseline and baseline.get('meta', {}).get('dataset') != meta:
+            print(f"Baseline was recorded with {baseline.get('meta', {}).get('dataset')}, comparing with {meta}")
+
+        scenarios = build_scenarios()
+        missing = missing_routes(app, scenarios)
+        if missing:
+            sys.exit('Routes without a benchmark scenario: ' + ', '.join(missing))
+
+        with app.app_context():
+            started = time.monotonic()
+            counts = SyntheticDataGenerator(args.users, seed=args.seed).run()
+            fixture = build_fixture(app)
+            print(f"Generated {counts['users']} users and {counts['runs']} runs in {time.monotonic() - started:.1f}s, "
+                  f"acting as user {fixture.user_id} with {fixture.run_count} runs")
+
+            def measure(mode, scenarios):
+                if mode == 'client':
+                    return run_client(app, scenarios, fixture, args.requests, args.warmup, errors)
+                return run_gunicorn(scenarios, fixture, args.gunicorn_requests, args.warmup, args.concurrency, args.workers, errors)
+
+            modes = ['client', 'gunicorn'] if args.mode == 'both' else [args.mode]
+            if 'gunicorn' in modes and not importlib.util.find_spec('gunicorn'):
+                if args.mode == 'gunicorn':
+                    sys.exit('gunicorn is not installed')
+                print('gunicorn is not installed, skipping the gunicorn run')
+                modes.remove('gunicorn')
+
+            errors = []
+            results = {mode: measure(mode, scenarios) for mode in modes}
+
+            tolerances = {mode: args.tolerance or tolerance for mode, tolerance in TOLERANCE.items()}
+            for _ in range(0 if args.update_baseline else args.retries):
+                # A slowdown must survive a second measurement, a busy machine is not a regression
+                slower = {}
+                for mode, name, timing, message in compare(results, baseline, tolerances, args.slack_ms):
+                    if timing:
+                        slower.setdefault(mode, set()).add(name)
+                if not slower:
+                    break
+                for mode, names in slower.items():
+                    print(f"Measuring {len(names)} slower {mode} scenarios again")
+                    for name, result in measure(mode, [scenario for scenario in scenarios if scenario.name in names]).items():
+                        if result[GATED_LATENCY[mode]] < results[mode][name][GATED_LATENCY[mode]]:
+                            results[mode][name] = result
+
+        for mode, mode_results in results.items():
+            print_results(mode, mode_results, baseline)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'meta': {'dataset': meta}, **results}, f, indent=2, sort_keys=True)
+
+        if errors:
+            print(f'\n{len(errors)} requests returned an unexpected status:')
+            for error in errors[:20]:
+                print('  ' + error)
+            sys.exit(1)
+
+        if args.update_baseline:
+            # Keep the modes that weren't run this time
+            baseline.update(results)
+            baseline['meta'] = {'dataset': meta, 'python': platform.python_version(), 'machine': platform.machine()}
+            with open(args.baseline, 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write('\n')
+            print(f'\nWrote {args.baseline}')
+            return
+
+        regressions = compare(results, baseline, tolerances, args.slack_ms)
+        if regressions:
+            print(f'\n{len(regressions)} regressions against {args.baseline}:')
+            for mode, name, timing, message in regressions:
+                print(f'  {mode} {name}: {message}')
+            sys.exit(1)
+        print('\nNo regressions' if baseline else '\nNo baseline to compare with, run with --update-baseline')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
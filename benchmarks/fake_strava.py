@@ -0,0 +1,117 @@
+"""A local stand-in for stravalib's Client, so benchmarks never call Strava.
+
+Install it with strava_service.client_class = FakeStravaClient, or for the
+async serving mode with strava_async.transport = fake_transport(). Tokens follow
+the synthetic dataset's 'synthetic-access-<athlete id>' scheme, and every
+athlete has the same ACTIVITIES_PER_SYNC recent runs with stable ids, so a
+repeated sync finds them already imported. Set LATENCY to make every API call
+take that many seconds, like a real round trip to Strava.
+"""
+import asyncio
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+ACTIVITIES_PER_SYNC = 20
+ACTIVITY_ID_STRIDE = 1000
+DEFAULT_ATHLETE_ID = 1
+
+# Seconds each API call takes
+LATENCY = 0
+
+def athlete_id_for_token(access_token):
+    try:
+        return int(str(access_token).rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return DEFAULT_ATHLETE_ID
+
+def activity_ids(athlete_id):
+    """Ids of an athlete's recent activities, clear of the dataset's own ids"""
+    return [athlete_id * ACTIVITY_ID_STRIDE + i for i in range(ACTIVITIES_PER_SYNC)]
+
+class FakeStravaClient:
+    def __init__(self, access_token=None, requests_session=None):
+        self.access_token = access_token
+        self.athlete_id = athlete_id_for_token(access_token)
+
+    def authorization_url(self, client_id, redirect_uri, scope=None, **kwargs):
+        return f'https://www.strava.com/oauth/authorize?client_id={client_id}&redirect_uri={redirect_uri}'
+
+    def exchange_code_for_token(self, client_id, client_secret, code):
+        athlete_id = athlete_id_for_token(code)
+        return {
+            'access_token': f'synthetic-access-{athlete_id}',
+            'refresh_token': f'synthetic-refresh-{athlete_id}',
+            'expires_at': int(time.time()) + 6 * 3600,
+            'athlete': {'id': athlete_id, 'firstname': 'Synthetic', 'lastname': f'Athlete {athlete_id}',
+                        'city': 'Utrecht', 'country': 'Netherlands'}
+        }
+
+    def get_athlete(self):
+        time.sleep(LATENCY)
+        return athlete(self.athlete_id)
+
+    def get_activity(self, activity_id):
+        time.sleep(LATENCY)
+        return activity(activity_id)
+
+    def get_activities(self, after=None, limit=None):
+        time.sleep(LATENCY)
+        return [activity(activity_id) for activity_id in activity_ids(self.athlete_id)[:limit]]
+
+    def get_athlete_stats(self, athlete_id):
+        time.sleep(LATENCY)
+        return athlete_stats()
+
+def athlete(athlete_id):
+    return SimpleNamespace(
+        id=athlete_id, firstname='Synthetic', lastname=f'Athlete {athlete_id}',
+        city='Utrecht', country='Netherlands', profile=None
+    )
+
+def activity(activity_id):
+    index = activity_id % ACTIVITY_ID_STRIDE
+    # Anchored to the hour so the same activity keeps its start time within a run
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=6 * (index + 1))
+    return SimpleNamespace(
+        id=activity_id, type='Run', name=f'Synthetic run {index}',
+        start_date=start, start_date_local=start.replace(tzinfo=None),
+        distance=4000.0 + 250 * index, moving_time=timedelta(minutes=22 + index)
+    )
+
+def athlete_stats():
+    totals = SimpleNamespace(count=ACTIVITIES_PER_SYNC, distance=135000.0, moving_time=44000,
+                             elapsed_time=46000, elevation_gain=800.0)
+    return SimpleNamespace(recent_run_totals=totals, all_run_totals=totals)
+
+def activity_json(strava_activity):
+    """An activity as the Strava API returns it"""
+    return {
+        'id': strava_activity.id, 'type': strava_activity.type, 'name': strava_activity.name,
+        'start_date': strava_activity.start_date.isoformat().replace('+00:00', 'Z'),
+        'start_date_local': strava_activity.start_date_local.isoformat() + 'Z',
+        'distance': strava_activity.distance, 'moving_time': int(strava_activity.moving_time.total_seconds())
+    }
+
+def fake_transport():
+    """An httpx transport answering the Strava API calls strava_async makes with FakeStravaClient's data"""
+    import httpx
+
+    async def handle(request):
+        await asyncio.sleep(LATENCY)
+        athlete_id = athlete_id_for_token(request.headers.get('Authorization', '').removeprefix('Bearer '))
+        path = request.url.path.removeprefix('/api/v3')
+        if path == '/athlete':
+            return httpx.Response(200, json=vars(athlete(athlete_id)))
+        if path == '/athlete/activities':
+            per_page = int(request.url.params.get('per_page', 30))
+            page = int(request.url.params.get('page', 1))
+            ids = activity_ids(athlete_id)[(page - 1) * per_page:page * per_page]
+            return httpx.Response(200, json=[activity_json(activity(activity_id)) for activity_id in ids])
+        if re.fullmatch(r'/athletes/\d+/stats', path):
+            totals = vars(athlete_stats().recent_run_totals)
+            return httpx.Response(200, json={'recent_run_totals': totals, 'all_run_totals': totals})
+        return httpx.Response(404, json={'message': 'Record Not Found'})
+
+    return httpx.MockTransport(handle)
@@ -0,0 +1,25 @@
+"""gunicorn settings for the benchmarks: the deployment's worker model, Strava stubbed"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+bind = os.environ.get('BENCHMARK_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('BENCHMARK_WORKERS', 2))
+loglevel = 'warning'
+
+serving_mode = os.environ.get('SERVING_MODE', 'sync').lower()
+if serving_mode == 'async':
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    worker_class = 'gthread'
+    threads = 8
+
+def post_worker_init(worker):
+    import fake_strava
+    from strava_service import strava_service
+    fake_strava.LATENCY = float(os.environ.get('BENCHMARK_STRAVA_LATENCY_MS', 0)) / 1000
+    strava_service.client_class = fake_strava.FakeStravaClient
+    if serving_mode == 'async':
+        import strava_async
+        strava_async.transport = fake_strava.fake_transport()
@@ -0,0 +1,205 @@
+"""Stress test: do concurrent credits and spends on one wallet add up?
+
+Runs --writers threads per user against the coin ledger, each one crediting or
+spending a few coins per transaction, while a compactor folds pending credits
+into the wallets. Afterwards every wallet must equal its opening balance plus
+the committed credits minus the successful spends, never be negative, and
+match the sum of its ledger entries.
+
+--naive runs the same load through the read-modify-write the API used before
+the ledger, to show the lost updates and overdrafts it allows.
+
+    python benchmarks/ledger_stress.py [--users 2] [--writers 50] [--ops 40] [--naive]
+
+Uses DATABASE_URL when set (point it at a disposable Postgres database to
+measure real contention), otherwise a temporary SQLite file.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+OPENING_BALANCE = 100
+MAX_CREDIT = 10
+MAX_SPEND = 20
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] * 1e3 if samples else float('nan')
+
+def create_users(count):
+    from app import db
+    import coin_ledger
+    from models import User, CoinWallet
+
+    user_ids = []
+    suffix = time.time_ns()
+    for i in range(count):
+        user = User(email=f'ledger{suffix}-{i}@stress.example', username=f'ledger{suffix}-{i}', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(CoinWallet(user_id=user.id, balance=0, total_earned=0, total_spent=0))
+        db.session.flush()
+        coin_ledger.credit(user.id, OPENING_BALANCE, coin_ledger.OPENING)
+        coin_ledger.compact([user.id])
+        user_ids.append(user.id)
+    db.session.commit()
+    return user_ids
+
+def naive_transaction(user_id, amount):
+    """The read-modify-write the API used before the ledger"""
+    from app import db
+    from models import CoinWallet
+
+    wallet = CoinWallet.query.filter_by(user_id=user_id).first()
+    if amount > 0:
+        wallet.balance += amount
+        wallet.total_earned += amount
+    elif wallet.balance >= -amount:
+        wallet.balance += amount
+        wallet.total_spent -= amount
+    else:
+        return False
+    db.session.commit()
+    return True
+
+def ledger_transaction(user_id, amount):
+    from app import db
+    import coin_ledger
+
+    if amount > 0:
+        coin_ledger.credit(user_id, amount, coin_ledger.ADJUSTMENT)
+    elif not coin_ledger.spend(user_id, -amount, coin_ledger.ADJUSTMENT):
+        db.session.rollback()
+        return False
+    db.session.commit()
+    return True
+
+def writer(app, user_id, ops, naive, seed, results, start):
+    from app import db
+
+    transaction = naive_transaction if naive else ledger_transaction
+    rng = random.Random(seed)
+    result = {'credited': 0, 'spent': 0, 'declined': 0, 'errors': 0, 'latencies': []}
+    with app.app_context():
+        start.wait()
+        for _ in range(ops):
+            amount = rng.randint(1, MAX_CREDIT) if rng.random() < 0.5 else -rng.randint(1, MAX_SPEND)
+            began = time.perf_counter()
+            try:
+                if transaction(user_id, amount):
+                    result['credited' if amount > 0 else 'spent'] += abs(amount)
+                else:
+                    result['declined'] += 1
+            except Exception:
+                db.session.rollback()
+                result['errors'] += 1
+            result['latencies'].append(time.perf_counter() - began)
+        db.session.remove()
+    results[user_id].append(result)
+
+def compactor(app, stop, interval):
+    from app import db
+    import coin_ledger
+
+    with app.app_context():
+        while not stop.wait(interval):
+            try:
+                coin_ledger.compact_pending()
+            except Exception:
+                db.session.rollback()
+        db.session.remove()
+
+def check(user_ids, results):
+    """Compare each wallet with what the writers committed, returning the problems found"""
+    from app import db
+    import coin_ledger
+    from sqlalchemy import func
+    from models import CoinWallet, CoinTransaction
+
+    coin_ledger.compact_pending()
+    problems = []
+    for user_id in user_ids:
+        credited = sum(result['credited'] for result in results[user_id])
+        spent = sum(result['spent'] for result in results[user_id])
+        expected = OPENING_BALANCE + credited - spent
+        wallet = CoinWallet.query.filter_by(user_id=user_id).first()
+        if wallet.balance != expected:
+            problems.append(f'user {user_id}: balance {wallet.balance}, expected {expected} '
+                            f'({OPENING_BALANCE} + {credited} credited - {spent} spent)')
+        if wallet.balance < 0:
+            problems.append(f'user {user_id}: negative balance {wallet.balance}')
+        if wallet.total_spent != spent:
+            problems.append(f'user {user_id}: total_spent {wallet.total_spent}, expected {spent}')
+        ledger_sum = db.session.query(func.sum(CoinTransaction.amount)).filter_by(user_id=user_id).scalar()
+        if ledger_sum != wallet.balance:
+            problems.append(f'user {user_id}: ledger sums to {ledger_sum}, wallet holds {wallet.balance}')
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--writers', type=int, default=50, help='Parallel writers per user.')
+    parser.add_argument('--ops', type=int, default=40, help='Transactions per writer.')
+    parser.add_argument('--compact-ms', type=float, default=50, help='Pause between compaction passes.')
+    parser.add_argument('--naive', action='store_true', help='Use read-modify-write instead of the ledger.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    threads = args.users * args.writers
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ledger.db'))
+    # Waiting on the wallet row is the point here, not worth a log line per statement
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    # One connection per writer, so the database rather than the pool decides who waits
+    os.environ['DATABASE_POOL_SIZE'] = str(threads + 2)
+    sys.path.insert(0, ROOT)
+    from app import app, db
+
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        user_ids = create_users(args.users)
+
+    results = defaultdict(list)
+    start = threading.Barrier(threads + 1)
+    workers = [
+        threading.Thread(target=writer, args=(app, user_id, args.ops, args.naive, args.seed * 100000 + i, results, start))
+        for user_id in user_ids for i in range(args.writers)
+    ]
+    stop = threading.Event()
+    compaction = threading.Thread(target=compactor, args=(app, stop, args.compact_ms / 1000))
+    for thread in workers:
+        thread.start()
+    if not args.naive:
+        compaction.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    stop.set()
+    if not args.naive:
+        compaction.join()
+
+    with app.app_context():
+        problems = check(user_ids, results)
+
+    all_results = [result for user_results in results.values() for result in user_results]
+    latencies = [latency for result in all_results for latency in result['latencies']]
+    declined = sum(result['declined'] for result in all_results)
+    errors = sum(result['errors'] for result in all_results)
+    print(f"{'naive read-modify-write' if args.naive else 'ledger'} on {dialect}: "
+          f"{args.users} users x {args.writers} writers x {args.ops} transactions")
+    print(f"  {len(latencies) / elapsed:.0f} transactions/s, p50 {percentile(latencies, 50):.1f} ms, "
+          f"p95 {percentile(latencies, 95):.1f} ms, {declined} spends declined, {errors} errors")
+    for problem in problems:
+        print('  ' + problem)
+    print('  consistent' if not problems else f'  {len(problems)} inconsistencies')
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Load test: does a login burst slow down unrelated requests?
+
+Starts the app in a threaded server twice, once hashing passwords inline
+(PASSWORD_HASH_EAGER=true) and once in the hashing pool, and measures GET /docs
+latency from probe threads while other threads log in as fast as they can.
+
+    python benchmarks/login_load.py [--duration 15] [--login-threads 8] [--probe-threads 4] [--think-ms 50]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+USERS = 8
+PASSWORD = 'correct horse battery'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(eager, workers):
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load.db'),
+        PASSWORD_HASH_EAGER='true' if eager else 'false',
+        PASSWORD_HASH_WORKERS=str(workers),
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'main', 'run', '--port', str(port), '--with-threads'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(base_url + '/docs', timeout=1)
+            return server, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    sys.exit('Server did not start')
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] * 1e3 if samples else float('nan')
+
+def probe(base_url, stop, latencies, think_time):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        session.get(base_url + '/docs')
+        latencies.append(time.perf_counter() - start)
+        # Clients poll, they don't hammer
+        stop.wait(think_time)
+
+def log_in(base_url, stop, latencies, index):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = session.post(base_url + '/auth/login', json={'email': f'load{index % USERS}@example.com', 'password': PASSWORD})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+def measure(base_url, duration, probe_threads, login_threads, think_time):
+    stop = threading.Event()
+    probe_latencies, login_latencies = [], []
+    threads = [threading.Thread(target=probe, args=(base_url, stop, probe_latencies, think_time)) for _ in range(probe_threads)]
+    threads += [threading.Thread(target=log_in, args=(base_url, stop, login_latencies, i)) for i in range(login_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return probe_latencies, login_latencies
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--login-threads', type=int, default=8)
+    parser.add_argument('--probe-threads', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1, help='Hashing pool size')
+    parser.add_argument('--think-ms', type=float, default=50, help='Pause between probe requests')
+    args = parser.parse_args()
+
+    for label, eager in [('inline', True), ('pool', False)]:
+        server, base_url = start_server(eager, args.workers)
+        try:
+            for i in range(USERS):
+                requests.post(base_url + '/auth/register', json={
+                    'email': f'load{i}@example.com', 'username': f'load{i}', 'password': PASSWORD
+                }).raise_for_status()
+
+            idle, _ = measure(base_url, args.duration / 3, args.probe_threads, 0, args.think_ms / 1e3)
+            busy, logins = measure(base_url, args.duration, args.probe_threads, args.login_threads, args.think_ms / 1e3)
+            print(
+                f'{label:6}  /docs idle p50 {percentile(idle, 50):6.1f} ms p99 {percentile(idle, 99):6.1f} ms | '
+                f'during logins p50 {percentile(busy, 50):6.1f} ms p99 {percentile(busy, 99):6.1f} ms | '
+                f'logins {len(logins) / args.duration:5.1f}/s p99 {percentile(logins, 99):7.1f} ms'
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
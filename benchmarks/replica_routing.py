@@ -0,0 +1,143 @@
+"""Replica routing check: which database each request reads from.
+
+Generates a SQLite dataset as the primary and copies it to a replica file,
+which then stands for a replica that stopped replicating: anything written
+afterwards exists only on the primary. Requests go through the Flask test
+client while SQL statements are counted per engine, and the script checks that:
+- the read-only views run every statement on the replica;
+- writes and other views use the primary;
+- after a write the same client reads from the primary, found by its user or,
+  as another worker would, by its cookie or the user's last write time on the
+  primary, until --sticky-seconds have passed;
+- so does a token issued by a registration within that window;
+- other users keep reading from the replica meanwhile.
+
+It exits non-zero when a request reads from the wrong database. --primary-url
+and --replica-url check a real pair instead, e.g. two Postgres databases with
+streaming replication, in which case the data is not generated or copied.
+
+    python benchmarks/replica_routing.py [--users 200] [--sticky-seconds 1] [--primary-url URL --replica-url URL]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+READ_PATHS = ['/api/garden', '/api/wallet', '/api/stats', '/api/seeds', '/api/runs', '/auth/profile']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200, help='Users in the generated dataset')
+    parser.add_argument('--sticky-seconds', type=float, default=1, help='REPLICA_STICKY_SECONDS for the check')
+    parser.add_argument('--primary-url', help='Primary database, with --replica-url')
+    parser.add_argument('--replica-url', help='Replica of the primary database')
+    args = parser.parse_args()
+    if bool(args.primary_url) != bool(args.replica_url):
+        sys.exit('--primary-url and --replica-url go together')
+
+    # Configure the app before it is imported
+    workdir = tempfile.mkdtemp(prefix='replica-routing-check-')
+    primary_path = os.path.join(workdir, 'primary.db')
+    replica_path = os.path.join(workdir, 'replica.db')
+    os.environ.update(
+        DATABASE_URL=args.primary_url or 'sqlite:///' + primary_path,
+        DATABASE_REPLICA_URLS=args.replica_url or 'sqlite:///' + replica_path,
+        REPLICA_STICKY_SECONDS=str(args.sticky_seconds),
+        PASSWORD_HASH_EAGER='true',
+        PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+    )
+    sys.path.insert(0, ROOT)
+
+    from flask_jwt_extended import create_access_token
+    from sqlalchemy import event
+    from app import app, db
+    from models import User
+    import replicas
+    logging.disable(logging.WARNING)
+
+    failures = []
+    try:
+        with app.app_context():
+            if not args.primary_url:
+                from synthetic_data import SyntheticDataGenerator
+                SyntheticDataGenerator(args.users, runs_per_user=20, history_days=120, seed=0).run()
+                for engine in db.engines.values():
+                    engine.dispose()
+                shutil.copyfile(primary_path, replica_path)
+
+            user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id).limit(2)]
+            if len(user_ids) < 2:
+                sys.exit('The database needs at least two users')
+            headers = {user_id: {'Authorization': 'Bearer ' + create_access_token(identity=str(user_id))} for user_id in user_ids}
+
+            # Statements per engine, counted on the engines the session picks
+            names = {db.engines[None]: 'primary', **{db.engines[bind]: bind for bind in app.config['DATABASE_REPLICA_BINDS']}}
+            counts = Counter()
+            for engine, name in names.items():
+                event.listen(engine, 'before_cursor_execute', lambda *args, name=name: counts.update([name]))
+
+        def check(label, method, path, user_id, expected, client=None, body=None, status=None):
+            client = client or app.test_client(use_cookies=False)
+            counts.clear()
+            started = time.perf_counter()
+            response = client.open(path, method=method, json=body, headers=headers[user_id])
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            used = {name for name in counts if counts[name]}
+            if expected != 'primary' and counts['primary'] == 1:
+                # The user's last write time, looked up before reading from a replica
+                used.discard('primary')
+            ok = used == {expected} and (status is None or response.status_code == status)
+            print(f"{'ok ' if ok else 'FAIL'} {label:<52}{response.status_code:>5}{elapsed_ms:>9.1f} ms  "
+                  + ', '.join(f'{name}={counts[name]}' for name in sorted(counts)))
+            if not ok:
+                failures.append(label)
+            return response
+
+        # A registration returns a new token, which reads from the primary for the sticky window
+        registered = app.test_client(use_cookies=False).post('/auth/register', json={
+            'email': 'replica@check.example', 'username': 'replicacheck', 'password': 'replica-check-password'
+        }).get_json()
+        headers['new user'] = {'Authorization': 'Bearer ' + registered['access_token']}
+        check('GET /auth/profile with a new token', 'GET', '/auth/profile', 'new user', 'primary', status=200)
+
+        # The tokens minted above are as new
+        time.sleep(args.sticky_seconds)
+        reader, writer = user_ids
+        for path in READ_PATHS:
+            check(f'GET {path}', 'GET', path, reader, 'replica_1', status=200)
+
+        check('GET /auth/strava/status, not marked', 'GET', '/auth/strava/status', reader, 'primary', status=200)
+
+        client = app.test_client()
+        run = {'distance_km': 5, 'duration_minutes': 30, 'intensity': 'moderate'}
+        check('POST /api/runs', 'POST', '/api/runs', writer, 'primary', client=client, body=run, status=201)
+        total = check('GET /api/stats right after, same client', 'GET', '/api/stats', writer, 'primary', client=client, status=200)
+        check('GET /api/stats right after, no cookie', 'GET', '/api/stats', writer, 'primary', status=200)
+        # Another worker only has the cookie to go by
+        replicas._last_writes.clear()
+        check('GET /api/stats right after, cookie only', 'GET', '/api/stats', writer, 'primary', client=client, status=200)
+        # Nor does a client without cookies, which only the primary's record covers
+        replicas._last_writes.clear()
+        check('GET /api/stats right after, another worker', 'GET', '/api/stats', writer, 'primary', status=200)
+        check('GET /api/stats right after, another user', 'GET', '/api/stats', reader, 'replica_1', status=200)
+
+        time.sleep(args.sticky_seconds)
+        stale = check('GET /api/stats after the sticky window', 'GET', '/api/stats', writer, 'replica_1', client=client, status=200)
+        if not args.primary_url:
+            runs = lambda response: response.get_json()['running_stats']['total_runs']
+            print(f"     the stopped replica is {runs(total) - runs(stale)} run behind the primary, as expected")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        sys.exit(f'{len(failures)} requests read from the wrong database')
+    print('Every request read from the expected database')
+
+if __name__ == '__main__':
+    main()
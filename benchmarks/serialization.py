@@ -0,0 +1,91 @@
+"""Microbenchmark: ORM hydration + to_dict() + stdlib JSON against the projected rows + orjson path.
+
+Builds a throwaway SQLite database, checks both paths produce identical bodies,
+then times GET /api/runs and GET /api/garden payload generation.
+
+    python benchmarks/serialization.py [--runs 5000] [--plants 400] [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5000)
+    parser.add_argument('--plants', type=int, default=400)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    from flask.json.provider import DefaultJSONProvider
+    from app import app, db
+    from models import User, Garden, Plant, Run, IntensityLevel, PlantStage
+    from serializers import run_rows_to_dicts, garden_dict
+    from sqlalchemy.orm import selectinload
+    from utils import page_user_runs
+
+    with app.test_request_context():
+        user = User(email='bench@example.com', username='bench')
+        user.password_hash = 'x'
+        db.session.add(user)
+        db.session.flush()
+        garden = Garden(user_id=user.id, size_x=20, size_y=20)
+        db.session.add(garden)
+        db.session.flush()
+
+        start = datetime(2025, 1, 1)
+        intensities = list(IntensityLevel)
+        db.session.execute(Run.__table__.insert(), [{
+            'user_id': user.id, 'distance_km': 3 + i % 20 * 0.7, 'duration_minutes': 20 + i % 60,
+            'intensity': intensities[i % 4].name, 'pace_min_per_km': 5.25 + i % 7 * 0.1,
+            'coins_earned': 30 + i % 50, 'created_at': start + timedelta(minutes=37 * i),
+        } for i in range(args.runs)])
+        db.session.execute(Plant.__table__.insert(), [{
+            'garden_id': garden.id, 'seed_id': 1 + i % 6, 'name': f'Plant {i}', 'stage': list(PlantStage)[i % 5].name,
+            'growth_progress': i % 100 + 0.5, 'health': 100.0, 'planted_at': start + timedelta(hours=i),
+            'last_watered': start + timedelta(hours=i, minutes=5) if i % 2 else None,
+            'position_x': i % 20, 'position_y': i // 20,
+        } for i in range(min(args.plants, 400))])
+        db.session.commit()
+        user_id = user.id
+
+        stdlib = DefaultJSONProvider(app)
+        fast = app.json
+
+        def runs_before():
+            db.session.expunge_all()
+            runs = Run.query.filter_by(user_id=user_id).order_by(Run.created_at.desc(), Run.id.desc()).limit(args.page_size).all()
+            return stdlib.response({'runs': [run.to_dict() for run in runs]}).get_data()
+
+        def runs_after():
+            rows, _ = page_user_runs(user_id, args.page_size)
+            return fast.response({'runs': run_rows_to_dicts(rows)}).get_data()
+
+        def garden_before():
+            db.session.expunge_all()
+            garden = Garden.query.options(
+                selectinload(Garden.plants).selectinload(Plant.seed)
+            ).filter_by(user_id=user_id).first()
+            return stdlib.response({'garden': garden.to_dict()}).get_data()
+
+        def garden_after():
+            return fast.response({'garden': garden_dict(user_id)}).get_data()
+
+        for name, before, after in [('runs page', runs_before, runs_after), ('garden', garden_before, garden_after)]:
+            if before() != after():
+                sys.exit(f'{name}: response bodies differ')
+            before_s = min(timeit.repeat(before, number=args.repeat, repeat=3)) / args.repeat
+            after_s = min(timeit.repeat(after, number=args.repeat, repeat=3)) / args.repeat
+            print(f'{name:10} before {before_s * 1e3:7.2f} ms  after {after_s * 1e3:7.2f} ms  {before_s / after_s:4.1f}x  (bodies identical)')
+
+if __name__ == '__main__':
+    main()
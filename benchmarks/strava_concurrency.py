@@ -0,0 +1,179 @@
+"""Strava-bound concurrency benchmark: how many requests waiting on Strava one worker keeps in flight.
+
+Generates a SQLite dataset and starts a single gunicorn worker in each serving
+mode, with Strava stubbed to answer every call after --latency-ms:
+- sync: the gthread worker with 8 threads, as deployed today;
+- async: SERVING_MODE=async, a uvicorn worker driving Strava calls on the event loop.
+
+At each --concurrency level that many clients call GET /api/strava/stats, as
+different Strava users, back to back for --duration seconds. Reported per mode
+and level are throughput, latency percentiles and the Strava calls in flight on
+average (throughput x Strava latency), which is what a worker sustains.
+
+    python benchmarks/strava_concurrency.py [--latency-ms 200] [--concurrency 8 32 128] [--duration 5] [--output results.json]
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn_conf.py')
+MODES = ['sync', 'async']
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(mode, latency_ms, async_concurrency):
+    port = free_port()
+    env = dict(
+        os.environ, SERVING_MODE=mode, BENCHMARK_BIND=f'127.0.0.1:{port}', BENCHMARK_WORKERS='1',
+        BENCHMARK_STRAVA_LATENCY_MS=str(latency_ms), STRAVA_ASYNC_CONCURRENCY=str(async_concurrency)
+    )
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', GUNICORN_CONF, 'main:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(150):
+        try:
+            httpx.get(base_url + '/docs', timeout=5)
+            return server, base_url
+        except httpx.HTTPError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    sys.exit(f'gunicorn did not start in {mode} mode')
+
+async def get(reader, writer, path, headers):
+    """A GET over a keep-alive connection, returning status and body. Leaner than an HTTP
+    client library, so the clients leave the shared CPU to the worker being measured."""
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: benchmark\r\n{headers}\r\n'.encode())
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin1').split('\r\n')
+    length = next(int(line.split(':', 1)[1]) for line in lines if line.lower().startswith('content-length:'))
+    return int(lines[0].split(' ')[1]), await reader.readexactly(length)
+
+async def load(base_url, headers, concurrency, duration):
+    """Keep concurrency clients calling the endpoint for duration seconds, returning latencies and failures"""
+    host, port = base_url.removeprefix('http://').split(':')
+    latencies = []
+    failures = []
+    deadline = time.perf_counter() + duration
+
+    async def client(i):
+        reader, writer = await asyncio.open_connection(host, int(port))
+        auth = ''.join(f'{name}: {value}\r\n' for name, value in headers[i % len(headers)].items())
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                status, body = await get(reader, writer, '/api/strava/stats', auth)
+                if status != 200:
+                    failures.append(f'{status} {body[:200]}')
+                latencies.append(time.perf_counter() - started)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return latencies, time.perf_counter() - started, failures
+
+def summarize(latencies, elapsed, latency_ms):
+    ordered = sorted(latencies)
+    throughput = len(latencies) / elapsed
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(throughput, 1),
+        'p50_ms': round(statistics.median(ordered) * 1000, 1),
+        'p95_ms': round(ordered[int(len(ordered) * 0.95) - 1] * 1000, 1),
+        'strava_in_flight': round(throughput * latency_ms / 1000, 1),
+    }
+
+def build_headers(app, count):
+    """Auth headers of up to count Strava-connected users"""
+    from flask_jwt_extended import create_access_token
+    from models import StravaAccount
+
+    with app.app_context():
+        user_ids = [user_id for (user_id,) in StravaAccount.query.with_entities(StravaAccount.user_id).limit(count)]
+        return [{'Authorization': 'Bearer ' + create_access_token(identity=str(user_id))} for user_id in user_ids]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency-ms', type=float, default=200, help='Time the stubbed Strava takes per call')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 32, 128], help='Concurrent clients, one run each')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds per run')
+    parser.add_argument('--async-concurrency', type=int, default=50, help='STRAVA_ASYNC_CONCURRENCY of the async worker')
+    parser.add_argument('--users', type=int, default=400, help='Users in the generated dataset')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    for module in ['gunicorn', 'uvicorn_worker']:
+        if not importlib.util.find_spec(module):
+            sys.exit(f'{module} is not installed')
+
+    # Configure the app before it is imported, gunicorn inherits the same environment
+    workdir = tempfile.mkdtemp(prefix='strava-concurrency-benchmark-')
+    os.environ.update(
+        DATABASE_URL='sqlite:///' + os.path.join(workdir, 'benchmark.db'),
+        STRAVA_CLIENT_ID='1',
+        STRAVA_CLIENT_SECRET='benchmark',
+    )
+    os.environ.pop('SERVING_MODE', None)
+    sys.path.insert(0, ROOT)
+
+    from app import app
+    from synthetic_data import SyntheticDataGenerator
+    logging.disable(logging.WARNING)
+
+    results = {mode: {} for mode in args.modes}
+    try:
+        with app.app_context():
+            SyntheticDataGenerator(args.users, runs_per_user=10, history_days=60, seed=0).run()
+        headers = build_headers(app, max(args.concurrency))
+
+        for mode in args.modes:
+            server, base_url = start_gunicorn(mode, args.latency_ms, args.async_concurrency)
+            try:
+                # Warm up the worker's connections, clients and caches
+                asyncio.run(load(base_url, headers, min(args.concurrency), 1))
+                for concurrency in args.concurrency:
+                    latencies, elapsed, failures = asyncio.run(load(base_url, headers, concurrency, args.duration))
+                    if failures:
+                        sys.exit(f'{len(failures)} failed requests in {mode} mode, e.g. {failures[0]}')
+                    results[mode][str(concurrency)] = summarize(latencies, elapsed, args.latency_ms)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"One worker, Strava answering in {args.latency_ms:.0f} ms\n")
+    print(f"{'mode':<8}{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'in flight':>11}")
+    for mode, levels in results.items():
+        for concurrency, summary in levels.items():
+            print(f"{mode:<8}{concurrency:>8}{summary['throughput_rps']:>10.1f}{summary['p50_ms']:>10.1f}"
+                  f"{summary['p95_ms']:>10.1f}{summary['strava_in_flight']:>11.1f}")
+
+    if args.output:
+        meta = {'latency_ms': args.latency_ms, 'duration': args.duration, 'async_concurrency': args.async_concurrency,
+                'users': args.users, 'python': platform.python_version(), 'machine': platform.machine()}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
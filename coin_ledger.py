@@ -0,0 +1,153 @@
+import time
+import click
+from collections import defaultdict
+from datetime import datetime, timezone
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, func, insert, select, update
+from app import db
+from models import CoinWallet, CoinTransaction
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Transaction kinds
+OPENING = 'opening'
+RUN = 'run'
+STRAVA = 'strava'
+PURCHASE = 'purchase'
+ADJUSTMENT = 'adjustment'
+
+def credit(user_id, amount, kind):
+    """Record coins earned by a user.
+
+    Only a ledger row is inserted, so concurrent credits for the same user never
+    wait on each other or on spends. compact() moves them into the wallet later.
+    """
+    if amount:
+        db.session.add(CoinTransaction(user_id=user_id, amount=amount, kind=kind, applied=False))
+
+def spend(user_id, amount, kind=PURCHASE):
+    """Take coins from a user's wallet if the balance covers them, returning whether it did.
+
+    The check and the deduction are one conditional UPDATE, so concurrent spends
+    can never take the balance below zero. Pending credits are compacted first
+    when the wallet alone falls short. The caller commits.
+    """
+    wallet = CoinWallet.__table__
+    for attempt in range(2):
+        result = db.session.execute(
+            update(wallet)
+            .where(wallet.c.user_id == user_id, wallet.c.balance >= amount)
+            .values(
+                balance=wallet.c.balance - amount,
+                total_spent=wallet.c.total_spent + amount,
+                version=wallet.c.version + 1,
+                updated_at=datetime.now(timezone.utc)
+            )
+        )
+        if result.rowcount:
+            db.session.add(CoinTransaction(user_id=user_id, amount=-amount, kind=kind, applied=True))
+            return True
+        if attempt or not compact([user_id]):
+            return False
+    return False
+
+def compact(user_ids):
+    """Fold pending credits of the given users into their wallets, returning the coins applied per user.
+
+    Marking the entries applied and reading their amounts is one statement, so
+    a credit is applied exactly once even with several compactors running.
+    """
+    if not user_ids:
+        return {}
+    ledger = CoinTransaction.__table__
+    applied = db.session.execute(
+        update(ledger)
+        .where(ledger.c.user_id.in_(list(user_ids)), ledger.c.applied.is_(False))
+        .values(applied=True)
+        .returning(ledger.c.user_id, ledger.c.amount)
+    ).all()
+
+    amounts = defaultdict(int)
+    for user_id, amount in applied:
+        amounts[user_id] += amount
+    if not amounts:
+        return {}
+
+    wallet = CoinWallet.__table__
+    now = datetime.now(timezone.utc)
+    existing = set(db.session.execute(select(wallet.c.user_id).where(wallet.c.user_id.in_(list(amounts)))).scalars())
+    missing = [
+        {'user_id': user_id, 'balance': amount, 'total_earned': amount, 'total_spent': 0, 'updated_at': now}
+        for user_id, amount in amounts.items() if user_id not in existing
+    ]
+    if missing:
+        db.session.execute(insert(wallet), missing)
+
+    # In user order, so compactors running together lock wallets in the same order
+    changes = [{'wallet_user_id': user_id, 'amount': amounts[user_id]} for user_id in sorted(existing)]
+    if changes:
+        db.session.execute(
+            update(wallet)
+            .where(wallet.c.user_id == bindparam('wallet_user_id'))
+            .values(
+                balance=wallet.c.balance + bindparam('amount'),
+                total_earned=wallet.c.total_earned + bindparam('amount'),
+                version=wallet.c.version + 1,
+                updated_at=now
+            ),
+            changes
+        )
+    return dict(amounts)
+
+def pending_credits(user_id):
+    """Coins credited to a user and not yet compacted into their wallet, as a column to select alongside the wallet"""
+    return func.coalesce(
+        select(func.sum(CoinTransaction.amount))
+        .where(CoinTransaction.user_id == user_id, CoinTransaction.applied.is_(False))
+        .scalar_subquery(),
+        0
+    )
+
+def balance(user_id):
+    """A user's spendable coins: their wallet balance plus pending credits"""
+    wallet_balance = select(CoinWallet.balance).where(CoinWallet.user_id == user_id).scalar_subquery()
+    return db.session.execute(select(func.coalesce(wallet_balance, 0) + pending_credits(user_id))).scalar()
+
+def users_with_pending_credits(limit):
+    return list(db.session.execute(
+        select(CoinTransaction.user_id).where(CoinTransaction.applied.is_(False))
+        .group_by(CoinTransaction.user_id).order_by(CoinTransaction.user_id).limit(limit)
+    ).scalars())
+
+def compact_pending(batch_size=500):
+    """Compact every user with pending credits, one batch per transaction. Returns users and coins applied."""
+    users = coins = 0
+    while True:
+        user_ids = users_with_pending_credits(batch_size)
+        if not user_ids:
+            break
+        amounts = compact(user_ids)
+        db.session.commit()
+        users += len(amounts)
+        coins += sum(amounts.values())
+        if len(user_ids) < batch_size:
+            break
+    return users, coins
+
+@click.command('compact-coin-ledger')
+@click.option('--interval', default=60, show_default=True, help='Seconds between passes.')
+@click.option('--batch-size', default=500, show_default=True, help='Users per transaction.')
+@click.option('--once', is_flag=True, help='Run a single pass and exit.')
+@with_appcontext
+def compact_coin_ledger_command(interval, batch_size, once):
+    """Periodically fold pending coin credits into wallet balances"""
+    while True:
+        users, coins = compact_pending(batch_size)
+        if users:
+            logger.info(f"Compacted {coins} coins for {users} users")
+        # Release the connection and identity map between passes
+        db.session.remove()
+        if once:
+            break
+        time.sleep(interval)
@@ -0,0 +1,69 @@
+from itertools import chain
+from app import db
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import Session
+from models import User, CoinWallet, CoinTransaction, Garden, Plant, UserRunStats, CatalogVersion
+from seed_catalog import CATALOG_NAME
+
+# Models whose version column is bumped whenever one of their rows changes
+VERSIONED_MODELS = (CoinWallet, Garden, UserRunStats)
+
+def bump_versions(conn, model, ids):
+    """Bump the version of rows changed outside the ORM unit of work, e.g. by bulk UPDATEs"""
+    ids = list(ids)
+    if ids:
+        conn.execute(update(model.__table__).where(model.__table__.c.id.in_(ids)).values(version=model.__table__.c.version + 1))
+
+@event.listens_for(Session, 'before_flush')
+def _bump_modified_rows(session, flush_context, instances):
+    for instance in session.dirty:
+        if isinstance(instance, VERSIONED_MODELS) and session.is_modified(instance):
+            instance.version = type(instance).version + 1
+
+@event.listens_for(Session, 'after_flush')
+def _bump_gardens_of_changed_plants(session, flush_context):
+    # A garden's payload includes its plants
+    garden_ids = {
+        instance.garden_id for instance in chain(session.new, session.dirty, session.deleted)
+        if isinstance(instance, Plant) and (instance not in session.dirty or session.is_modified(instance))
+    }
+    bump_versions(session.connection(), Garden, garden_ids)
+
+def _catalog_version():
+    return select(CatalogVersion.version).where(CatalogVersion.name == CATALOG_NAME).scalar_subquery()
+
+def _latest_pending_credit(user_id):
+    # Credits reach the wallet version only once compacted
+    return (
+        select(func.max(CoinTransaction.id))
+        .where(CoinTransaction.user_id == user_id, CoinTransaction.applied.is_(False))
+        .scalar_subquery()
+    )
+
+def wallet_etag(user_id):
+    """ETag for GET /api/wallet, or None if the user has no wallet yet"""
+    row = db.session.execute(
+        select(CoinWallet.version, _latest_pending_credit(user_id)).where(CoinWallet.user_id == user_id)
+    ).first()
+    return f'wallet-{user_id}-{row[0]}-{row[1] or 0}' if row else None
+
+def garden_etag(user_id):
+    """ETag for GET /api/garden; plants embed their seed, so the seed catalog version counts too"""
+    row = db.session.execute(
+        select(Garden.version, _catalog_version()).where(Garden.user_id == user_id)
+    ).first()
+    return f'garden-{user_id}-{row[0]}-{row[1] or 0}' if row else None
+
+def stats_etag(user_id):
+    """ETag for GET /api/stats, which combines the run aggregates, wallet and garden"""
+    row = db.session.execute(
+        select(UserRunStats.version, CoinWallet.version, _latest_pending_credit(user_id), Garden.version)
+        .select_from(User)
+        .outerjoin(UserRunStats, UserRunStats.user_id == User.id)
+        .outerjoin(CoinWallet, CoinWallet.user_id == User.id)
+        .outerjoin(Garden, Garden.user_id == User.id)
+        .where(User.id == user_id)
+    ).first()
+    if not row or row[0] is None:
+        return None
+    return f'stats-{user_id}-' + '-'.join(str(version or 0) for version in row)
@@ -0,0 +1,38 @@
+import glob
+import os
+import sys
+
+# Set PROMETHEUS_MULTIPROC_DIR so /metrics reports every worker, not only the one that answers it
+multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Threads wait on the database and Strava, so each worker serves several requests at once.
+# SERVING_MODE=async (main:app is then the ASGI app) waits on Strava in an event loop instead.
+if os.environ.get('SERVING_MODE', 'sync').lower() == 'async':
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    worker_class = 'gthread'
+    threads = 8
+
+# Import the app and check the schema once in the master, so a new worker only forks.
+# Not with --reload, where workers have to import the changed code themselves.
+preload_app = '--reload' not in sys.argv
+
+def on_starting(server):
+    # Samples left by a previous run would be added to this one's
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+def child_exit(server, worker):
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+def post_fork(server, worker):
+    # Database connections opened while preloading belong to the master
+    if server.cfg.preload_app:
+        from app import app, db
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
@@ -0,0 +1,25 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson.
+
+    Keys are sorted like the default provider and datetimes, dates and enums
+    are encoded natively, so rows can be passed straight through without
+    calling isoformat() or .value first. Parsing is left to the default provider.
+    """
+
+    def _options(self, pretty=False):
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        if pretty:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options(kwargs.get('indent') is not None)).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._options(pretty)) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -1,4 +1,11 @@
-from app import app
+import os
+from app import app as flask_app
+
+# Under SERVING_MODE=async gunicorn runs uvicorn workers, which serve the ASGI app (see strava_async.py)
+if os.environ.get('SERVING_MODE', 'sync').lower() == 'async':
+    from asgi import app
+else:
+    app = flask_app
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    flask_app.run(host='0.0.0.0', port=5000, debug=True)
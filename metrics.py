@@ -0,0 +1,156 @@
+import os
+import re
+import time
+from urllib.parse import urlsplit
+import orjson
+from flask import Response, current_app, g, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152)
+
+REQUESTS = Counter('http_requests_total', 'Requests handled', ['endpoint', 'method', 'status'])
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Time to produce a response', ['endpoint', 'method'])
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Response body size', ['endpoint'], buckets=SIZE_BUCKETS)
+REQUEST_STATEMENTS = Histogram('http_request_db_statements', 'SQL statements run per request', ['endpoint'],
+                               buckets=STATEMENT_BUCKETS)
+REQUEST_DB_DURATION = Histogram('http_request_db_duration_seconds', 'Time spent in the database per request', ['endpoint'])
+SLOW_STATEMENTS = Counter('db_slow_statements_total', 'SQL statements slower than SLOW_QUERY_MS', ['endpoint'])
+STRAVA_DURATION = Histogram('strava_request_duration_seconds', 'Outbound Strava API call latency', ['operation', 'status'])
+STRAVA_RESPONSE_SIZE = Histogram('strava_response_size_bytes', 'Strava API response body size', ['operation'],
+                                 buckets=SIZE_BUCKETS)
+
+# Set from SLOW_QUERY_MS by init_metrics
+_slow_statement_seconds = float('inf')
+
+class RequestStats:
+    """What one request spent, collected on flask.g"""
+    __slots__ = ('started', 'statements', 'db_seconds', 'strava_calls', 'strava_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.strava_calls = 0
+        self.strava_seconds = 0.0
+
+def _request_stats():
+    return g.get('request_stats') if has_request_context() else None
+
+def _current_endpoint():
+    return (request.endpoint or 'unmatched') if has_request_context() else 'background'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_started'].pop()
+
+    stats = _request_stats()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+
+    if elapsed >= _slow_statement_seconds:
+        endpoint = _current_endpoint()
+        SLOW_STATEMENTS.labels(endpoint).inc()
+        # Parameters can hold emails, tokens and password hashes, so only their number is logged
+        parameter_count = len(parameters) if isinstance(parameters, (list, tuple, dict)) else 0
+        logger.warning(orjson.dumps({
+            'event': 'slow_statement',
+            'endpoint': endpoint,
+            'duration_ms': round(elapsed * 1000, 1),
+            'statement': ' '.join(statement.split())[:2000],
+            'parameters': f'{parameter_count} redacted',
+            'executemany': executemany,
+        }).decode())
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('statement_started'):
+        connection.info['statement_started'].pop()
+
+def strava_operation(url):
+    """Label an outbound Strava URL by its route, e.g. /api/v3/activities/:id"""
+    return re.sub(r'/\d+(?=/|$)', '/:id', urlsplit(url).path) or '/'
+
+def observe_strava_call(url, response, elapsed):
+    """Record an outbound Strava API call; response is None when it failed"""
+    operation = strava_operation(url)
+    STRAVA_DURATION.labels(operation, str(response.status_code) if response is not None else 'error').observe(elapsed)
+    if response is not None and response.headers.get('Content-Length', '').isdigit():
+        STRAVA_RESPONSE_SIZE.labels(operation).observe(int(response.headers['Content-Length']))
+
+    stats = _request_stats()
+    if stats is not None:
+        stats.strava_calls += 1
+        stats.strava_seconds += elapsed
+
+def _start_request():
+    g.request_stats = RequestStats()
+
+def _finish_request(response):
+    stats = g.pop('request_stats', None)
+    if stats is None or request.endpoint == 'metrics':
+        return response
+
+    elapsed = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    size = response.calculate_content_length()
+
+    REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    REQUEST_DURATION.labels(endpoint, request.method).observe(elapsed)
+    REQUEST_STATEMENTS.labels(endpoint).observe(stats.statements)
+    REQUEST_DB_DURATION.labels(endpoint).observe(stats.db_seconds)
+    if size is not None:
+        RESPONSE_SIZE.labels(endpoint).observe(size)
+
+    if elapsed * 1000 >= current_app.config['SLOW_REQUEST_MS']:
+        logger.warning(orjson.dumps({
+            'event': 'slow_request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 1),
+            'db_statements': stats.statements,
+            'db_ms': round(stats.db_seconds * 1000, 1),
+            'strava_calls': stats.strava_calls,
+            'strava_ms': round(stats.strava_seconds * 1000, 1),
+            'response_bytes': size,
+        }).decode())
+
+    return response
+
+def metrics_registry():
+    """The registry to expose, merging every worker's samples under gunicorn's multiprocess mode"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+def init_metrics(app):
+    """Track every request and expose the metrics at /metrics"""
+    global _slow_statement_seconds
+    _slow_statement_seconds = app.config['SLOW_QUERY_MS'] / 1000
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    @app.route('/metrics')
+    def metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
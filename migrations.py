@@ -0,0 +1,249 @@
+import click
+from datetime import datetime, timezone
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, literal, select, text, true, tuple_, update
+from sqlalchemy.exc import DBAPIError
+from app import db
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the Postgres advisory lock held while migrating
+MIGRATION_LOCK_KEY = 7_351_264
+
+def add_column(conn, table, column, ddl_type):
+    """Add a column unless the table already has it (e.g. created from the current models)"""
+    columns = {existing['name'] for existing in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl_type}'))
+
+def create_index(conn, name, table, columns, unique=False, where=None):
+    conn.execute(text(
+        f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {name} ON "{table}" ({", ".join(columns)})'
+        + (f' WHERE {where}' if where else '')
+    ))
+
+def ensure_no_duplicates(conn, table, columns):
+    """Refuse to add a uniqueness constraint that existing rows would violate"""
+    column_list = ', '.join(columns)
+    duplicates = conn.execute(text(
+        f'SELECT {column_list}, COUNT(*) FROM "{table}" GROUP BY {column_list} HAVING COUNT(*) > 1'
+    )).fetchmany(5)
+    if duplicates:
+        raise RuntimeError(
+            f"Cannot add unique index on {table} ({column_list}): duplicate rows exist, e.g. {duplicates}. "
+            "Merge or remove them and run the migration again."
+        )
+
+def initial_schema(conn):
+    """Create any missing tables from the models"""
+    import models  # noqa: F401 - registers the tables on the metadata
+    db.metadata.create_all(conn)
+
+def add_run_strava_activity_id(conn):
+    add_column(conn, 'run', 'strava_activity_id', 'BIGINT')
+    create_index(conn, 'ix_run_strava_activity_id', 'run', ['strava_activity_id'], unique=True)
+
+def add_hot_path_indexes(conn):
+    create_index(conn, 'ix_run_user_id_created_at', 'run', ['user_id', 'created_at'])
+    create_index(conn, 'ix_plant_garden_id_stage', 'plant', ['garden_id', 'stage'])
+    create_index(conn, 'ix_strava_account_user_id_is_active', 'strava_account', ['user_id', 'is_active'])
+    create_index(conn, 'ix_sync_job_user_id_status', 'sync_job', ['user_id', 'status'])
+
+    ensure_no_duplicates(conn, 'coin_wallet', ['user_id'])
+    create_index(conn, 'uq_coin_wallet_user_id', 'coin_wallet', ['user_id'], unique=True)
+    ensure_no_duplicates(conn, 'garden', ['user_id'])
+    create_index(conn, 'uq_garden_user_id', 'garden', ['user_id'], unique=True)
+    ensure_no_duplicates(conn, 'plant', ['garden_id', 'position_x', 'position_y'])
+    create_index(conn, 'uq_plant_garden_id_position', 'plant', ['garden_id', 'position_x', 'position_y'], unique=True)
+
+def add_seed_catalog(conn):
+    """Version the seed catalog and stock it at migration time rather than on first request"""
+    from models import CatalogVersion
+    from seed_catalog import bump_catalog_version
+    from utils import create_default_seeds
+
+    CatalogVersion.__table__.create(conn, checkfirst=True)
+    create_default_seeds(conn)
+    bump_catalog_version(conn)
+
+def add_entity_versions(conn):
+    for table in ('coin_wallet', 'garden', 'user_run_stats'):
+        add_column(conn, table, 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+def add_coin_ledger(conn):
+    """Create the coin ledger, opening it with every wallet's current balance"""
+    from models import CoinWallet, CoinTransaction
+    from coin_ledger import OPENING
+
+    CoinTransaction.__table__.create(conn, checkfirst=True)
+    wallet = CoinWallet.__table__
+    conn.execute(CoinTransaction.__table__.insert().from_select(
+        ['user_id', 'amount', 'kind', 'applied', 'created_at'],
+        select(wallet.c.user_id, wallet.c.balance, literal(OPENING), true(), literal(datetime.now(timezone.utc)))
+        .where(wallet.c.balance != 0)
+    ))
+
+def add_one_active_sync_job_per_user(conn):
+    """Fail all but each user's newest queued or running sync job, then allow only one"""
+    from models import SyncJob, SyncJobStatus, ACTIVE_SYNC_JOB_CONDITION
+
+    jobs = SyncJob.__table__
+    active = conn.execute(
+        select(jobs.c.id, jobs.c.user_id).where(text(ACTIVE_SYNC_JOB_CONDITION))
+        .order_by(jobs.c.user_id, jobs.c.created_at.desc())
+    ).all()
+    seen = set()
+    superseded = []
+    for job_id, user_id in active:
+        if user_id in seen:
+            superseded.append(job_id)
+        seen.add(user_id)
+    if superseded:
+        conn.execute(update(jobs).where(jobs.c.id.in_(superseded)).values(
+            status=SyncJobStatus.FAILED, error='Superseded by a newer sync job', finished_at=datetime.now(timezone.utc)
+        ))
+    create_index(conn, 'uq_sync_job_active_user_id', 'sync_job', ['user_id'], unique=True, where=ACTIVE_SYNC_JOB_CONDITION)
+
+def add_strava_sync_backoff(conn):
+    add_column(conn, 'strava_account', 'last_sync_attempt', 'TIMESTAMP')
+    add_column(conn, 'strava_account', 'sync_failures', 'INTEGER NOT NULL DEFAULT 0')
+
+def add_run_client_id(conn):
+    add_column(conn, 'run', 'client_id', 'VARCHAR(64)')
+    create_index(conn, 'uq_run_user_id_client_id', 'run', ['user_id', 'client_id'], unique=True)
+
+def add_webhook_event_claims(conn):
+    add_column(conn, 'strava_webhook_event', 'claimed_at', 'TIMESTAMP')
+
+def add_user_last_write_at(conn):
+    add_column(conn, 'user', 'last_write_at', 'TIMESTAMP')
+
+# Applied in order; each one must be safe to run on a database created from the current models
+MIGRATIONS = [
+    (1, 'Initial schema', initial_schema),
+    (2, 'Strava activity id on runs', add_run_strava_activity_id),
+    (3, 'Hot path indexes, one wallet and garden per user, one plant per cell', add_hot_path_indexes),
+    (4, 'Versioned seed catalog with the default seeds', add_seed_catalog),
+    (5, 'Version counters on wallets, gardens and run stats', add_entity_versions),
+    (6, 'Coin ledger opened with the current balances', add_coin_ledger),
+    (7, 'One queued or running sync job per user', add_one_active_sync_job_per_user),
+    (8, 'Backoff for failing Strava syncs', add_strava_sync_backoff),
+    (9, 'Client ids on runs, unique per user', add_run_client_id),
+    (10, 'Claim times on Strava webhook events', add_webhook_event_claims),
+    (11, 'Last write time per user, for replica routing', add_user_last_write_at),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    if not inspect(conn).has_table('schema_version'):
+        return 0
+    return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+def schema_is_current(engine):
+    """One cheap query, so workers booting against an up-to-date database skip the migration lock and DDL"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() == LATEST_VERSION
+    except DBAPIError:
+        # No schema_version table yet
+        return False
+
+def upgrade_schema(engine=None):
+    """Apply pending migrations, returning the versions applied"""
+    engine = engine or db.engine
+    if schema_is_current(engine):
+        return []
+    applied = []
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Workers booting together wait here instead of racing on DDL
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_version ('
+            'version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at TIMESTAMP)'
+        ))
+        version = current_version(conn)
+
+        for migration_version, description, migrate in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.info(f"Applying migration {migration_version}: {description}")
+            migrate(conn)
+            conn.execute(
+                text('INSERT INTO schema_version (version, description, applied_at) VALUES (:version, :description, :applied_at)'),
+                {'version': migration_version, 'description': description, 'applied_at': datetime.now(timezone.utc)}
+            )
+            applied.append(migration_version)
+
+    return applied
+
+def hot_queries():
+    """The lookups every request path depends on"""
+    from models import User, Run, CoinWallet, CoinTransaction, Garden, Plant, PlantStage, StravaAccount
+
+    return {
+        'runs by user, newest first': select(Run).where(Run.user_id == 1).order_by(Run.created_at.desc()).limit(20),
+        'runs by user, after a cursor': select(Run).where(
+            Run.user_id == 1, tuple_(Run.created_at, Run.id) < (datetime(2024, 1, 1), 1)
+        ).order_by(Run.created_at.desc(), Run.id.desc()).limit(21),
+        'run by Strava activity': select(Run.id).where(Run.strava_activity_id == 1),
+        'wallet by user': select(CoinWallet).where(CoinWallet.user_id == 1),
+        'pending coin credits by user': select(CoinTransaction.amount).where(
+            CoinTransaction.user_id == 1, CoinTransaction.applied.is_(False)
+        ),
+        'garden by user': select(Garden).where(Garden.user_id == 1),
+        'Strava account by user': select(StravaAccount).where(
+            StravaAccount.user_id == 1, StravaAccount.is_active.is_(True)
+        ),
+        'plant by cell': select(Plant).where(Plant.garden_id == 1, Plant.position_x == 0, Plant.position_y == 0),
+        'plants by stage': select(Plant.id).where(Plant.garden_id == 1, Plant.stage == PlantStage.SEED),
+        'user by email': select(User).where(User.email == 'runner@example.com'),
+    }
+
+def explain_query(conn, query):
+    """EXPLAIN a query, returning (uses_index, plan)"""
+    dialect = conn.dialect
+    sql = str(query.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+    if dialect.name == 'sqlite':
+        plan = [row[3] for row in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+        full_scan = any(line.startswith('SCAN') and 'USING' not in line for line in plan)
+        sorts = any('TEMP B-TREE' in line for line in plan)
+    elif dialect.name == 'postgresql':
+        # Small tables make sequential scans cheapest, so force the planner to show its index choice
+        with conn.begin():
+            conn.execute(text('SET LOCAL enable_seqscan = off'))
+            plan = [row[0] for row in conn.execute(text(f'EXPLAIN {sql}'))]
+        full_scan = any('Seq Scan' in line for line in plan)
+        sorts = any(line.strip().startswith('Sort') or '->  Sort' in line for line in plan)
+    else:
+        raise RuntimeError(f"Query plan checks are not supported on {dialect.name}")
+
+    return not full_scan and not sorts, '\n'.join(plan)
+
+def explain_hot_queries(engine=None):
+    """EXPLAIN each hot query, returning (name, uses_index, plan) tuples"""
+    engine = engine or db.engine
+    with engine.connect() as conn:
+        return [(name, *explain_query(conn, query)) for name, query in hot_queries().items()]
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade_command():
+    """Apply pending schema migrations"""
+    applied = upgrade_schema()
+    print(f"Applied migrations {applied}" if applied else f"Schema is up to date (version {LATEST_VERSION})")
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """Check that every hot query is served by an index"""
+    failures = 0
+    for name, uses_index, plan in explain_hot_queries():
+        print(f"{'ok  ' if uses_index else 'FAIL'} {name}\n     {plan.replace(chr(10), chr(10) + '     ')}")
+        failures += not uses_index
+    if failures:
+        raise click.ClickException(f"{failures} hot queries are not using an index")
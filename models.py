@@ -1,6 +1,6 @@
 from app import db
 from datetime import datetime, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import hash_password, verify_password
 from sqlalchemy import func
 import enum
 
@@ -17,6 +17,36 @@ class PlantStage(enum.Enum):
     MATURE = "mature"
     BLOOMING = "blooming"
 
+# Economy rules, shared by the request handlers and the recomputation engine
+INTENSITY_MULTIPLIERS = {
+    IntensityLevel.LOW: 1.0,
+    IntensityLevel.MODERATE: 1.2,
+    IntensityLevel.HIGH: 1.5,
+    IntensityLevel.EXTREME: 2.0
+}
+XP_PER_KM = 10
+XP_PER_LEVEL = 1000
+BASE_GARDEN_SIZE = 10
+MAX_GARDEN_SIZE = 20
+GROWTH_PER_KM = 2
+MAX_GROWTH = 100.0
+# Growth progress at which a plant reaches each stage, highest first
+STAGE_THRESHOLDS = [
+    (80, PlantStage.BLOOMING),
+    (60, PlantStage.MATURE),
+    (40, PlantStage.SAPLING),
+    (20, PlantStage.SPROUT)
+]
+
+class SyncJobStatus(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+# Sync jobs still to finish, as stored (enum names); a user has at most one
+ACTIVE_SYNC_JOB_CONDITION = "status IN ('QUEUED', 'RUNNING')"
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -24,6 +54,7 @@ class User(db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     is_active = db.Column(db.Boolean, default=True)
+    last_write_at = db.Column(db.DateTime)  # Last request that wrote for the user, see replicas
     
     # Relationships
     runs = db.relationship('Run', backref='user', lazy=True, cascade='all, delete-orphan')
@@ -31,10 +62,14 @@ class User(db.Model):
     garden = db.relationship('Garden', backref='user', uselist=False, cascade='all, delete-orphan')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check a password, upgrading the stored hash if the configured work factors changed"""
+        valid, needs_rehash = verify_password(self.password_hash, password)
+        if needs_rehash:
+            self.password_hash = hash_password(password)
+        return valid
     
     def to_dict(self):
         return {
@@ -46,8 +81,15 @@ class User(db.Model):
         }
 
 class Run(db.Model):
+    __table_args__ = (
+        db.Index('ix_run_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('uq_run_user_id_client_id', 'user_id', 'client_id', unique=True),  # Replayed uploads are stored once
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    strava_activity_id = db.Column(db.BigInteger, unique=True, index=True)  # Source activity for synced runs
+    client_id = db.Column(db.String(64))  # Id an offline client gave the run, see POST /api/runs/batch
     distance_km = db.Column(db.Float, nullable=False)  # Distance in kilometers
     duration_minutes = db.Column(db.Integer, nullable=False)  # Duration in minutes
     intensity = db.Column(db.Enum(IntensityLevel), nullable=False)
@@ -69,40 +111,53 @@ class Run(db.Model):
             'intensity': self.intensity.value,
             'pace_min_per_km': self.pace_min_per_km,
             'coins_earned': self.coins_earned,
+            'strava_activity_id': self.strava_activity_id,
+            'client_id': self.client_id,
             'created_at': self.created_at.isoformat()
         }
 
 class CoinWallet(db.Model):
+    __table_args__ = (
+        db.Index('uq_coin_wallet_user_id', 'user_id', unique=True),  # One wallet per user
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     balance = db.Column(db.Integer, default=0)
     total_earned = db.Column(db.Integer, default=0)
     total_spent = db.Column(db.Integer, default=0)
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)  # Bumped on every balance change
     
-    def add_coins(self, amount):
-        self.balance += amount
-        self.total_earned += amount
-        self.updated_at = datetime.now(timezone.utc)
-    
-    def spend_coins(self, amount):
-        if self.balance >= amount:
-            self.balance -= amount
-            self.total_spent += amount
-            self.updated_at = datetime.now(timezone.utc)
-            return True
-        return False
-    
-    def to_dict(self):
+    def to_dict(self, pending_credits=0):
+        # Credits still in the ledger count as earned and spendable
         return {
             'id': self.id,
             'user_id': self.user_id,
-            'balance': self.balance,
-            'total_earned': self.total_earned,
+            'balance': self.balance + pending_credits,
+            'total_earned': self.total_earned + pending_credits,
             'total_spent': self.total_spent,
             'updated_at': self.updated_at.isoformat()
         }
 
+class CoinTransaction(db.Model):
+    """Append-only record of every coin earned or spent.
+    
+    Credits are inserted without touching the wallet row and folded into it
+    later by compaction (applied). Spends are taken from the wallet at once
+    and recorded as applied. A user's entries always sum to their balance.
+    """
+    __table_args__ = (
+        db.Index('ix_coin_transaction_user_id_applied', 'user_id', 'applied', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # Positive when earned, negative when spent
+    kind = db.Column(db.String(20), nullable=False)  # run, strava, purchase, adjustment or opening
+    applied = db.Column(db.Boolean, default=False, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
 class Seed(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -128,7 +183,17 @@ class Seed(db.Model):
             'is_available': self.is_available
         }
 
+class CatalogVersion(db.Model):
+    """Counter bumped whenever a shared catalog such as the seeds changes"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
 class Plant(db.Model):
+    __table_args__ = (
+        db.Index('uq_plant_garden_id_position', 'garden_id', 'position_x', 'position_y', unique=True),  # One plant per cell
+        db.Index('ix_plant_garden_id_stage', 'garden_id', 'stage'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     garden_id = db.Column(db.Integer, db.ForeignKey('garden.id'), nullable=False)
     seed_id = db.Column(db.Integer, db.ForeignKey('seed.id'), nullable=False)
@@ -141,34 +206,30 @@ class Plant(db.Model):
     position_x = db.Column(db.Integer, default=0)  # Garden position
     position_y = db.Column(db.Integer, default=0)  # Garden position
     
-    def water(self, run_distance, run_intensity):
-        """Update plant growth based on running activity"""
+    @staticmethod
+    def growth_boost(run_distance, run_intensity):
+        """Growth points a single run gives every plant"""
         # Base growth from distance
-        growth_boost = run_distance * 2  # 2 points per km
+        growth_boost = run_distance * GROWTH_PER_KM
         
         # Intensity multiplier
-        intensity_multipliers = {
-            IntensityLevel.LOW: 1.0,
-            IntensityLevel.MODERATE: 1.2,
-            IntensityLevel.HIGH: 1.5,
-            IntensityLevel.EXTREME: 2.0
-        }
-        
-        growth_boost *= intensity_multipliers.get(run_intensity, 1.0)
-        
+        return growth_boost * INTENSITY_MULTIPLIERS.get(run_intensity, 1.0)
+    
+    def water(self, run_distance, run_intensity):
+        """Update plant growth based on running activity"""
+        self.grow(self.growth_boost(run_distance, run_intensity))
+    
+    def grow(self, growth_boost):
+        """Apply growth points, e.g. the summed boost of several runs"""
         # Add to growth progress
-        self.growth_progress = min(100.0, self.growth_progress + growth_boost)
+        self.growth_progress = min(MAX_GROWTH, self.growth_progress + growth_boost)
         self.last_watered = datetime.now(timezone.utc)
         
         # Update stage based on progress
-        if self.growth_progress >= 80:
-            self.stage = PlantStage.BLOOMING
-        elif self.growth_progress >= 60:
-            self.stage = PlantStage.MATURE
-        elif self.growth_progress >= 40:
-            self.stage = PlantStage.SAPLING
-        elif self.growth_progress >= 20:
-            self.stage = PlantStage.SPROUT
+        for threshold, stage in STAGE_THRESHOLDS:
+            if self.growth_progress >= threshold:
+                self.stage = stage
+                break
     
     def to_dict(self):
         return {
@@ -187,6 +248,10 @@ class Plant(db.Model):
         }
 
 class StravaAccount(db.Model):
+    __table_args__ = (
+        db.Index('ix_strava_account_user_id_is_active', 'user_id', 'is_active'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     strava_athlete_id = db.Column(db.BigInteger, unique=True, nullable=False)
@@ -200,6 +265,8 @@ class StravaAccount(db.Model):
     athlete_profile_picture = db.Column(db.String(500))
     connected_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     last_sync = db.Column(db.DateTime)
+    last_sync_attempt = db.Column(db.DateTime)  # Last failed fleet sync, see sync_scheduler
+    sync_failures = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # Failed syncs since the last success
     is_active = db.Column(db.Boolean, default=True)
     
     # Relationship
@@ -207,7 +274,11 @@ class StravaAccount(db.Model):
     
     def is_token_expired(self):
         """Check if the access token is expired"""
-        return datetime.now(timezone.utc) > self.expires_at
+        expires_at = self.expires_at
+        if expires_at.tzinfo is None:
+            # DateTime columns come back naive, values are stored in UTC
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) > expires_at
     
     def to_dict(self):
         return {
@@ -224,6 +295,10 @@ class StravaAccount(db.Model):
         }
 
 class Garden(db.Model):
+    __table_args__ = (
+        db.Index('uq_garden_user_id', 'user_id', unique=True),  # One garden per user
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name = db.Column(db.String(100), default='My Mystical Garden')
@@ -232,19 +307,20 @@ class Garden(db.Model):
     level = db.Column(db.Integer, default=1)
     experience_points = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)  # Bumped whenever the garden or its plants change
     
     # Relationships
-    plants = db.relationship('Plant', backref='garden', lazy=True, cascade='all, delete-orphan')
+    plants = db.relationship('Plant', backref='garden', lazy=True, cascade='all, delete-orphan', order_by='Plant.id')
     
     def add_experience(self, points):
         self.experience_points += points
         # Level up every 1000 XP
-        new_level = (self.experience_points // 1000) + 1
+        new_level = (self.experience_points // XP_PER_LEVEL) + 1
         if new_level > self.level:
             self.level = new_level
             # Expand garden size with each level
-            self.size_x = min(20, 10 + self.level)
-            self.size_y = min(20, 10 + self.level)
+            self.size_x = min(MAX_GARDEN_SIZE, BASE_GARDEN_SIZE + self.level)
+            self.size_y = min(MAX_GARDEN_SIZE, BASE_GARDEN_SIZE + self.level)
     
     def to_dict(self):
         return {
@@ -258,3 +334,98 @@ class Garden(db.Model):
             'created_at': self.created_at.isoformat(),
             'plants': [plant.to_dict() for plant in self.plants] if self.plants else []
         }
+
+class UserRunStats(db.Model):
+    """Running aggregates for a user, kept up to date as runs are logged or synced"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
+    total_runs = db.Column(db.Integer, default=0, nullable=False)
+    total_distance_km = db.Column(db.Float, default=0.0, nullable=False)
+    total_duration_minutes = db.Column(db.Integer, default=0, nullable=False)
+    total_coins_earned = db.Column(db.Integer, default=0, nullable=False)
+    best_pace_min_per_km = db.Column(db.Float)  # Fastest pace across all runs
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)  # Bumped whenever the aggregates change
+    # Plant counts per PlantStage for the user's garden
+    plants_seed = db.Column(db.Integer, default=0, nullable=False)
+    plants_sprout = db.Column(db.Integer, default=0, nullable=False)
+    plants_sapling = db.Column(db.Integer, default=0, nullable=False)
+    plants_mature = db.Column(db.Integer, default=0, nullable=False)
+    plants_blooming = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    def add_run(self, run):
+        """Fold a newly created run into the totals"""
+        self.total_runs += 1
+        self.total_distance_km += run.distance_km
+        self.total_duration_minutes += run.duration_minutes
+        self.total_coins_earned += run.coins_earned or 0
+        if run.pace_min_per_km and run.pace_min_per_km > 0:
+            if self.best_pace_min_per_km is None or run.pace_min_per_km < self.best_pace_min_per_km:
+                self.best_pace_min_per_km = run.pace_min_per_km
+        self.updated_at = datetime.now(timezone.utc)
+    
+    def add_plant(self, stage=PlantStage.SEED):
+        column = f'plants_{stage.value}'
+        setattr(self, column, getattr(self, column) + 1)
+        self.updated_at = datetime.now(timezone.utc)
+    
+    def set_plant_counts(self, plants):
+        """Recount plants per stage from already loaded plants"""
+        counts = {stage: 0 for stage in PlantStage}
+        for plant in plants:
+            counts[plant.stage] += 1
+        for stage, count in counts.items():
+            setattr(self, f'plants_{stage.value}', count)
+        self.updated_at = datetime.now(timezone.utc)
+    
+    def plants_by_stage(self):
+        return {stage.value: getattr(self, f'plants_{stage.value}') for stage in PlantStage}
+
+class SyncJob(db.Model):
+    """A background Strava sync requested by a user"""
+    __table_args__ = (
+        db.Index('ix_sync_job_user_id_status', 'user_id', 'status'),
+        db.Index('uq_sync_job_active_user_id', 'user_id', unique=True,
+                 sqlite_where=db.text(ACTIVE_SYNC_JOB_CONDITION), postgresql_where=db.text(ACTIVE_SYNC_JOB_CONDITION)),
+    )
+    
+    id = db.Column(db.String(32), primary_key=True)  # Opaque job id returned to clients
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status = db.Column(db.Enum(SyncJobStatus), default=SyncJobStatus.QUEUED, nullable=False)
+    days_back = db.Column(db.Integer, default=7)
+    result = db.Column(db.JSON)  # Summary returned by the sync
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status.value,
+            'days_back': self.days_back,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class StravaWebhookEvent(db.Model):
+    """A Strava push-subscription event waiting to be processed"""
+    __table_args__ = (
+        db.Index('ix_strava_webhook_event_status_owner', 'status', 'owner_id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.BigInteger, nullable=False)  # Strava athlete id
+    object_type = db.Column(db.String(20), nullable=False)  # activity or athlete
+    object_id = db.Column(db.BigInteger, nullable=False)
+    aspect_type = db.Column(db.String(20), nullable=False)  # create, update or delete
+    updates = db.Column(db.JSON)
+    event_time = db.Column(db.DateTime)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, processing, processed, failed
+    error = db.Column(db.Text)
+    received_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    claimed_at = db.Column(db.DateTime)  # When a processor took it, see strava_webhooks
+    processed_at = db.Column(db.DateTime)
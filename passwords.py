@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# werkzeug's own default, with its work factors spelled out
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+# How much lower than the web workers the hashing processes are scheduled
+HASH_PROCESS_NICENESS = 5
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def normalize_method(method):
+    """Spell out werkzeug's implied work factors so stored hashes can be compared with the config"""
+    parts = method.split(':')
+    if parts[0] == 'scrypt' and len(parts) == 1:
+        return DEFAULT_METHOD
+    if parts[0] == 'pbkdf2':
+        hash_name = parts[1] if len(parts) > 1 else 'sha256'
+        iterations = parts[2] if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    return method
+
+def _lower_priority():
+    # Under a login burst, the API requests waiting in the web workers should win the CPU
+    try:
+        os.nice(HASH_PROCESS_NICENESS)
+    except OSError:
+        pass
+
+def get_executor(app):
+    """Get the process-wide hashing pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+                # Forking a threaded web worker is unsafe, so start clean processes
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_lower_priority
+            )
+        return _executor
+
+def _reset_executor(broken):
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+
+def _run(fn, *args):
+    """Run a hashing function in the pool, waiting for the result without holding the GIL"""
+    app = current_app._get_current_object()
+    if app.config.get('PASSWORD_HASH_EAGER'):
+        return fn(*args)
+
+    executor = get_executor(app)
+    try:
+        return executor.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A hashing process died; start a fresh pool next time and don't fail this request
+        logger.warning("Password hashing pool broke, hashing inline")
+        _reset_executor(executor)
+        return fn(*args)
+
+def hash_password(password):
+    return _run(generate_password_hash, password, current_app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD))
+
+def verify_password(password_hash, password):
+    """Check a password against a stored hash, returning (valid, needs_rehash)"""
+    valid = _run(check_password_hash, password_hash, password)
+    stored_method = password_hash.split('$', 1)[0]
+    configured_method = normalize_method(current_app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD))
+    return valid, valid and normalize_method(stored_method) != configured_method
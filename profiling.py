@@ -0,0 +1,164 @@
+import glob
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+import orjson
+from flask import abort, current_app, g, request, send_file
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Header carrying PROFILE_TOKEN, both to profile a request and to read the captures
+PROFILE_HEADER = 'X-Profile'
+
+_frame_labels = {}
+
+def frame_label(code):
+    """Name a function the way flame graph tools expect, e.g. get_stats (api.py:612)"""
+    label = _frame_labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        for prefix in sorted(sys.path, key=len, reverse=True):
+            if prefix and filename.startswith(prefix + os.sep):
+                filename = filename[len(prefix) + 1:]
+                break
+        label = _frame_labels[code] = f'{code.co_name} ({filename}:{code.co_firstlineno})'
+    return label
+
+def collapse(frame):
+    """The stack below a frame as one collapsed-stack line, outermost call first"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+class StackSampler(threading.Thread):
+    """Samples one thread's stack at a fixed interval from a background thread.
+
+    The profiled thread runs untouched, so the cost is one sys._current_frames()
+    call per interval while a capture is running and nothing otherwise.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            self.stacks[collapse(frame)] += 1
+
+    def finish(self):
+        self._done.set()
+        self.join()
+        return self.stacks
+
+def _should_profile():
+    token = current_app.config.get('PROFILE_TOKEN')
+    if token and request.headers.get(PROFILE_HEADER) == token:
+        return True
+    return random.random() < current_app.config['PROFILE_SAMPLE_RATE']
+
+def _start_profile():
+    if request.endpoint and not request.endpoint.startswith('profiles') and _should_profile():
+        g.profile_started = time.perf_counter()
+        g.profile_sampler = StackSampler(threading.get_ident(), current_app.config['PROFILE_INTERVAL_MS'] / 1000)
+        g.profile_sampler.start()
+
+def _finish_profile(response):
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return response
+
+    stacks = sampler.finish()
+    duration_ms = round((time.perf_counter() - g.pop('profile_started')) * 1000, 1)
+    try:
+        profile_id = save_capture(stacks, {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': duration_ms,
+            'samples': sum(stacks.values()),
+            'interval_ms': current_app.config['PROFILE_INTERVAL_MS'],
+        })
+        response.headers['X-Profile-Id'] = profile_id
+    except OSError as e:
+        logger.error(f"Failed to save profile: {str(e)}")
+    return response
+
+def save_capture(stacks, meta):
+    """Write a capture as a collapsed-stack file plus its metadata, keeping the newest PROFILE_KEEP"""
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+
+    # Ids sort by creation time, across workers
+    profile_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+    meta = {'id': profile_id, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), **meta}
+    # Rooted at the endpoint so captures of different routes can be merged into one graph
+    with open(os.path.join(directory, f'{profile_id}.collapsed'), 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{meta['endpoint']};{stack} {count}\n")
+    with open(os.path.join(directory, f'{profile_id}.json'), 'wb') as f:
+        f.write(orjson.dumps(meta))
+
+    for old in list_captures(directory)[current_app.config['PROFILE_KEEP']:]:
+        for extension in ('json', 'collapsed'):
+            try:
+                os.remove(os.path.join(directory, f"{old['id']}.{extension}"))
+            except FileNotFoundError:
+                pass
+    return profile_id
+
+def list_captures(directory):
+    """Metadata of the saved captures, newest first"""
+    captures = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.json')), reverse=True):
+        try:
+            with open(path, 'rb') as f:
+                captures.append(orjson.loads(f.read()))
+        except (OSError, orjson.JSONDecodeError):
+            # Another worker is writing or pruning it
+            continue
+    return captures
+
+def _require_token():
+    token = current_app.config.get('PROFILE_TOKEN')
+    if not token or request.headers.get(PROFILE_HEADER) != token:
+        abort(404)
+
+def init_profiling(app):
+    """Profile requests that carry PROFILE_TOKEN or are picked by PROFILE_SAMPLE_RATE.
+
+    Nothing is registered unless one of them is configured, so a disabled
+    profiler costs nothing per request.
+    """
+    if not app.config.get('PROFILE_TOKEN') and not app.config['PROFILE_SAMPLE_RATE']:
+        return
+
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+
+    @app.route('/admin/profiles', endpoint='profiles')
+    def profiles():
+        _require_token()
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        return {'profiles': list_captures(app.config['PROFILE_DIR'])[:limit]}
+
+    @app.route('/admin/profiles/<profile_id>', endpoint='profiles_download')
+    def profile_download(profile_id):
+        _require_token()
+        path = os.path.join(app.config['PROFILE_DIR'], f'{os.path.basename(profile_id)}.collapsed')
+        if not os.path.exists(path):
+            abort(404)
+        return send_file(path, mimetype='text/plain', as_attachment=True, download_name=f'{profile_id}.collapsed')
@@ -0,0 +1,119 @@
+"""Read replica routing.
+
+Each URL in DATABASE_REPLICA_URLS becomes a bind. Views marked replica_reads
+run their queries on a random replica, until the session writes or locks rows;
+from then on the request uses the primary, as does everything else.
+
+A client that wrote in the last REPLICA_STICKY_SECONDS reads from the primary
+too, so it sees its own writes while the replicas catch up. The time of its
+last write is kept per user on the primary (User.last_write_at), which every
+worker and instance can see, and checked with one primary key lookup before a
+read goes to a replica. The worker's own record and a cookie answer first
+when they can. A token issued within the window counts as a write too, for
+the account a registration just created.
+"""
+import math
+import random
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from datetime import datetime, timezone
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from app import db
+from models import User
+
+STICKY_COOKIE = 'db_write_at'
+
+# Last write time by user id, pruned of expired entries past this size
+_last_writes = {}
+_last_writes_lock = threading.Lock()
+MAX_TRACKED_WRITERS = 10000
+
+@event.listens_for(Session, 'after_flush')
+def _mark_flush(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(Session, 'do_orm_execute')
+def _mark_statement(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['wrote'] = True
+
+def _current_token():
+    """The request's (claims, user id), empty outside JWT protected views"""
+    try:
+        return get_jwt(), int(get_jwt_identity())
+    except RuntimeError:
+        return {}, None
+
+def wrote_recently():
+    """Whether the client made a write within the sticky window"""
+    window = current_app.config['REPLICA_STICKY_SECONDS']
+    now = time.time()
+    try:
+        if now - float(request.cookies.get(STICKY_COOKIE, 0)) < window:
+            return True
+    except ValueError:
+        pass
+    # A token that new was issued by a registration or login, which may have written the user
+    claims, user_id = _current_token()
+    if now - claims.get('iat', 0) < window:
+        return True
+    if user_id is None:
+        return False
+    if now - _last_writes.get(user_id, 0) < window:
+        return True
+    # Another worker may have served the write, so ask the primary
+    with db.engine.connect() as conn:
+        last_write = conn.execute(select(User.last_write_at).where(User.id == user_id)).scalar()
+    if last_write is None:
+        return False
+    if last_write.tzinfo is None:
+        last_write = last_write.replace(tzinfo=timezone.utc)
+    return now - last_write.timestamp() < window
+
+def choose_replica():
+    """The engine of a random replica, or None when the request has to read from the primary"""
+    binds = current_app.config['DATABASE_REPLICA_BINDS']
+    if not binds or wrote_recently():
+        return None
+    return db.engines[random.choice(binds)]
+
+def replica_reads(view):
+    """Send a read-only view's queries to a replica, see the module docstring"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        replica = choose_replica()
+        if replica is not None:
+            db.session.info['replica'] = replica
+        return view(*args, **kwargs)
+    return wrapper
+
+def _remember_write(response):
+    if not db.session.info.get('wrote'):
+        return response
+
+    window = current_app.config['REPLICA_STICKY_SECONDS']
+    now = time.time()
+    _, user_id = _current_token()
+    if user_id is not None:
+        with _last_writes_lock:
+            if len(_last_writes) >= MAX_TRACKED_WRITERS:
+                for key, written in list(_last_writes.items()):
+                    if now - written >= window:
+                        del _last_writes[key]
+            _last_writes[user_id] = now
+        # On its own connection, after the view's transaction has committed
+        with db.engine.begin() as conn:
+            conn.execute(update(User).where(User.id == user_id).values(
+                last_write_at=datetime.fromtimestamp(now, timezone.utc)
+            ))
+    response.set_cookie(STICKY_COOKIE, f'{now:.3f}', max_age=max(math.ceil(window), 1), httponly=True, samesite='Lax')
+    return response
+
+def init_replicas(app):
+    """Track writers for read-your-writes, only when replicas are configured"""
+    if app.config['DATABASE_REPLICA_BINDS']:
+        app.after_request(_remember_write)
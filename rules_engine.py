@@ -0,0 +1,297 @@
+import random
+import numpy as np
+from sqlalchemy import func, update
+from app import db
+from models import (User, Run, CoinWallet, CoinTransaction, Garden, Plant, UserRunStats, PlantStage,
+                    INTENSITY_MULTIPLIERS, XP_PER_KM, GROWTH_PER_KM, MAX_GROWTH, STAGE_THRESHOLDS,
+                    XP_PER_LEVEL, BASE_GARDEN_SIZE, MAX_GARDEN_SIZE)
+from utils import calculate_coins_for_run, COINS_PER_KM, DISTANCE_BONUSES
+from entity_versions import VERSIONED_MODELS, bump_versions
+import coin_ledger
+
+# Growth changes smaller than this are float noise, not a rules change
+GROWTH_TOLERANCE = 1e-9
+
+# Stages in threshold order, indexed by how many thresholds a plant has passed
+STAGE_ORDER = [PlantStage.SEED] + [stage for _, stage in sorted(STAGE_THRESHOLDS, key=lambda item: item[0])]
+THRESHOLDS = np.array(sorted(threshold for threshold, _ in STAGE_THRESHOLDS), dtype=float)
+
+def intensity_multipliers(intensities):
+    return np.array([INTENSITY_MULTIPLIERS.get(intensity, 1.0) for intensity in intensities], dtype=float)
+
+def coins_for_runs(distance_km, multipliers):
+    """Array version of calculate_coins_for_run"""
+    base_coins = np.trunc(distance_km * COINS_PER_KM)
+    total_coins = np.trunc(base_coins * multipliers)
+    for min_distance_km, bonus in DISTANCE_BONUSES:
+        total_coins += np.where(distance_km >= min_distance_km, bonus, 0)
+    return total_coins.astype(np.int64)
+
+def growth_for_runs(distance_km, multipliers):
+    """Array version of Plant.growth_boost"""
+    return distance_km * GROWTH_PER_KM * multipliers
+
+def stages_for_growth(growth_progress):
+    """Array version of the stage thresholds in Plant.grow, as indexes into STAGE_ORDER"""
+    return np.searchsorted(THRESHOLDS, growth_progress, side='right')
+
+def to_microseconds(datetimes):
+    return np.array(datetimes, dtype='datetime64[us]').astype(np.int64)
+
+class RulesRecomputation:
+    """Recomputes coins, garden XP and plant growth for every user from run history.
+
+    The canonical rules are the ones every way of recording a run applies: each
+    run earns calculate_coins_for_run coins and XP_PER_KM XP per km, and waters
+    each plant planted by the time it happened, as in utils.water_garden_with_runs.
+    Recomputing with unchanged rules changes nothing. Wallets keep what was spent.
+    Gardens never shrink below their current size, so existing plants stay in bounds.
+    """
+
+    def __init__(self, chunk_size=500, dry_run=True, sample_size=10):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.sample_size = sample_size
+        self.summary = {
+            'users': 0,
+            'runs': 0,
+            'runs_changed': 0,
+            'wallets_changed': 0,
+            'gardens_changed': 0,
+            'plants_changed': 0,
+            'coin_delta': 0,
+            'samples': []
+        }
+
+    def run(self):
+        """Process all users in chunks, returning a summary of the changes"""
+        last_id = 0
+        while True:
+            user_ids = [user_id for (user_id,) in db.session.query(User.id).filter(
+                User.id > last_id
+            ).order_by(User.id).limit(self.chunk_size)]
+            if not user_ids:
+                break
+
+            self.process_chunk(user_ids)
+            if self.dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+            # Keep memory flat between chunks
+            db.session.expunge_all()
+            last_id = user_ids[-1]
+
+        return self.summary
+
+    def process_chunk(self, user_ids):
+        ids = np.array(user_ids, dtype=np.int64)
+        self.summary['users'] += len(user_ids)
+
+        # Runs, ordered per user by time
+        runs = db.session.query(
+            Run.id, Run.user_id, Run.distance_km, Run.intensity, Run.coins_earned, Run.created_at
+        ).filter(Run.user_id.in_(user_ids)).order_by(Run.user_id, Run.created_at, Run.id).all()
+        self.summary['runs'] += len(runs)
+
+        if runs:
+            run_ids, run_users, distances, intensities, old_coins, created = zip(*runs)
+        else:
+            run_ids, run_users, distances, intensities, old_coins, created = [], [], [], [], [], []
+        run_ids = np.array(run_ids, dtype=np.int64)
+        run_user_idx = np.searchsorted(ids, np.array(run_users, dtype=np.int64))
+        distances = np.array(distances, dtype=float)
+        multipliers = intensity_multipliers(intensities)
+        old_coins = np.array([coins or 0 for coins in old_coins], dtype=np.int64)
+
+        new_coins = coins_for_runs(distances, multipliers)
+        experience = np.trunc(distances * XP_PER_KM).astype(np.int64)
+        growth = growth_for_runs(distances, multipliers)
+
+        # Per-user totals
+        coins_by_user = np.bincount(run_user_idx, weights=new_coins, minlength=len(ids)).astype(np.int64)
+        xp_by_user = np.bincount(run_user_idx, weights=experience, minlength=len(ids)).astype(np.int64)
+
+        changed_runs = np.nonzero(new_coins != old_coins)[0]
+        self.summary['runs_changed'] += len(changed_runs)
+        self.summary['coin_delta'] += int(new_coins.sum() - old_coins.sum())
+
+        self.write(Run, [
+            {'id': int(run_ids[i]), 'coins_earned': int(new_coins[i])} for i in changed_runs
+        ])
+        self.recompute_wallets(ids, coins_by_user)
+        gardens = self.recompute_gardens(ids, xp_by_user)
+        plant_counts = self.recompute_plants(ids, gardens, run_user_idx, created, growth)
+        self.recompute_stats(ids, coins_by_user, plant_counts)
+
+    def recompute_wallets(self, ids, coins_by_user):
+        # Wallets must hold every credit before they are compared with the run history
+        if self.dry_run:
+            pending = dict(db.session.query(CoinTransaction.user_id, func.sum(CoinTransaction.amount)).filter(
+                CoinTransaction.user_id.in_(ids.tolist()), CoinTransaction.applied.is_(False)
+            ).group_by(CoinTransaction.user_id).all())
+        else:
+            coin_ledger.compact(ids.tolist())
+            pending = {}
+
+        wallets = db.session.query(
+            CoinWallet.id, CoinWallet.user_id, CoinWallet.balance, CoinWallet.total_earned, CoinWallet.total_spent
+        ).filter(CoinWallet.user_id.in_(ids.tolist())).all()
+
+        updates = []
+        adjustments = []
+        for wallet_id, user_id, balance, total_earned, total_spent in wallets:
+            balance = (balance or 0) + pending.get(user_id, 0)
+            total_earned = (total_earned or 0) + pending.get(user_id, 0)
+            new_earned = int(coins_by_user[np.searchsorted(ids, user_id)])
+            new_balance = max(0, new_earned - (total_spent or 0))
+            if new_earned != total_earned or new_balance != balance:
+                updates.append({'id': wallet_id, 'total_earned': new_earned, 'balance': new_balance})
+                if new_balance != balance:
+                    # Keeps each user's ledger summing to their balance
+                    adjustments.append(CoinTransaction(
+                        user_id=user_id, amount=new_balance - balance, kind=coin_ledger.ADJUSTMENT, applied=True
+                    ))
+                if len(self.summary['samples']) < self.sample_size:
+                    self.summary['samples'].append(
+                        f"user {user_id}: balance {balance} -> {new_balance}, earned {total_earned} -> {new_earned}"
+                    )
+
+        self.summary['wallets_changed'] += len(updates)
+        self.write(CoinWallet, updates)
+        if not self.dry_run:
+            db.session.add_all(adjustments)
+
+    def recompute_gardens(self, ids, xp_by_user):
+        gardens = db.session.query(
+            Garden.id, Garden.user_id, Garden.experience_points, Garden.level, Garden.size_x, Garden.size_y
+        ).filter(Garden.user_id.in_(ids.tolist())).all()
+
+        updates = []
+        for garden_id, user_id, xp, level, size_x, size_y in gardens:
+            new_xp = int(xp_by_user[np.searchsorted(ids, user_id)])
+            new_level = new_xp // XP_PER_LEVEL + 1
+            size = min(MAX_GARDEN_SIZE, BASE_GARDEN_SIZE + new_level) if new_level > 1 else BASE_GARDEN_SIZE
+            new_size_x, new_size_y = max(size, size_x or 0), max(size, size_y or 0)
+            if (new_xp, new_level, new_size_x, new_size_y) != (xp, level, size_x, size_y):
+                updates.append({
+                    'id': garden_id, 'experience_points': new_xp, 'level': new_level,
+                    'size_x': new_size_x, 'size_y': new_size_y
+                })
+
+        self.summary['gardens_changed'] += len(updates)
+        self.write(Garden, updates)
+        return {garden_id: user_id for garden_id, user_id, *_ in gardens}
+
+    def recompute_plants(self, ids, gardens, run_user_idx, created, growth):
+        """Recompute growth from the runs after each plant was planted.
+
+        Returns plant counts per user and stage index.
+        """
+        plant_counts = np.zeros((len(ids), len(STAGE_ORDER)), dtype=np.int64)
+        if not gardens:
+            return plant_counts
+
+        plants = db.session.query(
+            Plant.id, Plant.garden_id, Plant.planted_at, Plant.growth_progress, Plant.stage
+        ).filter(Plant.garden_id.in_(list(gardens))).all()
+        if not plants:
+            return plant_counts
+
+        plant_ids, garden_ids, planted, old_growth, old_stages = zip(*plants)
+        plant_user_idx = np.searchsorted(ids, np.array([gardens[garden_id] for garden_id in garden_ids], dtype=np.int64))
+
+        if len(run_user_idx):
+            # Key runs and plants by (user, time) so one searchsorted covers every user
+            run_times = to_microseconds(created)
+            start = run_times.min()
+            span = int(run_times.max() - start) + 2
+            run_keys = run_user_idx * span + (run_times - start)
+            plant_times = np.clip(to_microseconds(planted) - start, 0, span - 1)
+            plant_keys = plant_user_idx * span + plant_times
+
+            cumulative = np.concatenate([[0.0], np.cumsum(growth)])
+            first_run = np.searchsorted(run_keys, plant_keys, side='left')
+            user_end = np.searchsorted(run_user_idx, plant_user_idx, side='right')
+            new_growth = np.minimum(MAX_GROWTH, cumulative[user_end] - cumulative[first_run])
+        else:
+            new_growth = np.zeros(len(plants))
+
+        new_stage_idx = stages_for_growth(new_growth)
+        np.add.at(plant_counts, (plant_user_idx, new_stage_idx), 1)
+
+        updates = []
+        changed_gardens = set()
+        for i, plant_id in enumerate(plant_ids):
+            new_stage = STAGE_ORDER[new_stage_idx[i]]
+            if abs(new_growth[i] - (old_growth[i] or 0.0)) > GROWTH_TOLERANCE or new_stage != old_stages[i]:
+                updates.append({'id': plant_id, 'growth_progress': float(new_growth[i]), 'stage': new_stage})
+                changed_gardens.add(garden_ids[i])
+
+        self.summary['plants_changed'] += len(updates)
+        self.write(Plant, updates)
+        if not self.dry_run:
+            bump_versions(db.session.connection(), Garden, changed_gardens)
+        return plant_counts
+
+    def recompute_stats(self, ids, coins_by_user, plant_counts):
+        columns = ['total_coins_earned'] + [f'plants_{stage.value}' for stage in STAGE_ORDER]
+        stats = db.session.query(
+            UserRunStats.id, UserRunStats.user_id, *[getattr(UserRunStats, column) for column in columns]
+        ).filter(UserRunStats.user_id.in_(ids.tolist())).all()
+
+        updates = []
+        for stats_id, user_id, *old_values in stats:
+            idx = np.searchsorted(ids, user_id)
+            new_values = [int(coins_by_user[idx])] + [int(count) for count in plant_counts[idx]]
+            # Unchanged rows keep their version, so clients don't refetch them
+            if new_values != old_values:
+                updates.append({'id': stats_id, **dict(zip(columns, new_values))})
+
+        self.write(UserRunStats, updates)
+
+    def write(self, model, updates):
+        """Bulk update rows by primary key"""
+        if updates and not self.dry_run:
+            db.session.execute(update(model), updates)
+            if model in VERSIONED_MODELS:
+                bump_versions(db.session.connection(), model, [row['id'] for row in updates])
+
+def verify_parity(sample_size=1000, seed=0):
+    """Check the array rules against calculate_coins_for_run and Plant.grow on random runs.
+
+    Returns a list of mismatches, empty when the two agree.
+    """
+    rng = random.Random(seed)
+    intensities = list(INTENSITY_MULTIPLIERS)
+    distances = [round(rng.uniform(0.1, 60), rng.choice([0, 1, 2, 3])) for _ in range(sample_size)]
+    # Include every bonus boundary exactly
+    distances += [min_distance_km for min_distance_km, _ in DISTANCE_BONUSES]
+    run_intensities = [rng.choice(intensities) for _ in distances]
+
+    distance_array = np.array(distances, dtype=float)
+    multipliers = intensity_multipliers(run_intensities)
+    mismatches = []
+
+    vector_coins = coins_for_runs(distance_array, multipliers)
+    for i, (distance_km, intensity) in enumerate(zip(distances, run_intensities)):
+        expected = calculate_coins_for_run(distance_km, intensity)
+        if expected != vector_coins[i]:
+            mismatches.append(f"coins for {distance_km}km {intensity.value}: {expected} != {vector_coins[i]}")
+
+    # Water fresh plants run by run and compare with the capped cumulative growth
+    growth = growth_for_runs(distance_array, multipliers)
+    for start in range(0, len(distances), 8):
+        plant = Plant(growth_progress=0.0, stage=PlantStage.SEED)
+        cumulative = np.minimum(MAX_GROWTH, np.cumsum(growth[start:start + 8]))
+        stage_idx = stages_for_growth(cumulative)
+        for offset, i in enumerate(range(start, min(start + 8, len(distances)))):
+            plant.water(distances[i], run_intensities[i])
+            expected_stage = STAGE_ORDER[stage_idx[offset]]
+            if abs(plant.growth_progress - cumulative[offset]) > 1e-6 or plant.stage != expected_stage:
+                mismatches.append(
+                    f"growth after run {i}: {plant.growth_progress} {plant.stage.value} "
+                    f"!= {cumulative[offset]} {expected_stage.value}"
+                )
+
+    return mismatches
@@ -0,0 +1,55 @@
+import threading
+from flask import current_app
+from app import db
+from sqlalchemy import event, select, update, insert
+from sqlalchemy.orm import Session
+from models import Seed, CatalogVersion
+
+CATALOG_NAME = 'seeds'
+
+def bump_catalog_version(conn):
+    """Mark the seed catalog as changed for every process"""
+    result = conn.execute(
+        update(CatalogVersion).where(CatalogVersion.name == CATALOG_NAME).values(version=CatalogVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        conn.execute(insert(CatalogVersion).values(name=CATALOG_NAME, version=1))
+
+@event.listens_for(Session, 'after_flush')
+def _bump_on_seed_change(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(instance, Seed) for instance in changed):
+        bump_catalog_version(session.connection())
+
+class SeedCatalog:
+    """Process-local copy of the seed catalog, reloaded when its version moves"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (version, seeds by id, serialized GET /api/seeds body), swapped as a whole
+        self._snapshot = (None, {}, None)
+
+    def _current_version(self):
+        return db.session.execute(
+            select(CatalogVersion.version).where(CatalogVersion.name == CATALOG_NAME)
+        ).scalar() or 0
+
+    def snapshot(self):
+        """The catalog as of its current version, costing one primary key lookup when unchanged"""
+        version = self._current_version()
+        snapshot = self._snapshot
+        if snapshot[0] == version:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot[0] != version:
+                seeds = {seed.id: seed.to_dict() for seed in Seed.query.order_by(Seed.id)}
+                available = [seed for seed in seeds.values() if seed['is_available']]
+                self._snapshot = (version, seeds, current_app.json.dumps({'seeds': available}))
+            return self._snapshot
+
+    def get_seed(self, seed_id):
+        """A seed as a dict, or None if it doesn't exist"""
+        return self.snapshot()[1].get(seed_id)
+
+seed_catalog = SeedCatalog()
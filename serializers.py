@@ -0,0 +1,95 @@
+from app import db
+from sqlalchemy import select
+from models import Run, Garden, Plant, Seed
+
+# Column-projected versions of the models' to_dict(), for read endpoints that
+# return many rows. They select only the columns a response needs and leave
+# datetimes and enums for the JSON provider, skipping ORM hydration entirely.
+
+RUN_FIELDS = {
+    'id': Run.id,
+    'user_id': Run.user_id,
+    'distance_km': Run.distance_km,
+    'duration_minutes': Run.duration_minutes,
+    'intensity': Run.intensity,
+    'pace_min_per_km': Run.pace_min_per_km,
+    'coins_earned': Run.coins_earned,
+    'strava_activity_id': Run.strava_activity_id,
+    'client_id': Run.client_id,
+    'created_at': Run.created_at,
+}
+
+GARDEN_FIELDS = {
+    'id': Garden.id,
+    'user_id': Garden.user_id,
+    'name': Garden.name,
+    'size_x': Garden.size_x,
+    'size_y': Garden.size_y,
+    'level': Garden.level,
+    'experience_points': Garden.experience_points,
+    'created_at': Garden.created_at,
+}
+
+PLANT_FIELDS = {
+    'id': Plant.id,
+    'garden_id': Plant.garden_id,
+    'seed_id': Plant.seed_id,
+    'name': Plant.name,
+    'stage': Plant.stage,
+    'growth_progress': Plant.growth_progress,
+    'health': Plant.health,
+    'last_watered': Plant.last_watered,
+    'planted_at': Plant.planted_at,
+    'position_x': Plant.position_x,
+    'position_y': Plant.position_y,
+}
+
+SEED_FIELDS = {
+    'id': Seed.id,
+    'name': Seed.name,
+    'description': Seed.description,
+    'cost_coins': Seed.cost_coins,
+    'growth_requirements': Seed.growth_requirements,
+    'rarity': Seed.rarity,
+    'plant_type': Seed.plant_type,
+    'is_available': Seed.is_available,
+}
+
+def select_runs():
+    """SELECT of the columns in Run.to_dict(), ready for filters"""
+    return select(*RUN_FIELDS.values())
+
+def run_rows_to_dicts(rows):
+    keys = list(RUN_FIELDS)
+    return [dict(zip(keys, row)) for row in rows]
+
+def garden_dict(user_id):
+    """The user's garden shaped like Garden.to_dict(), or None if they have none"""
+    garden_row = db.session.execute(
+        select(*GARDEN_FIELDS.values()).where(Garden.user_id == user_id)
+    ).first()
+    if not garden_row:
+        return None
+
+    garden = dict(zip(GARDEN_FIELDS, garden_row))
+    plant_keys = list(PLANT_FIELDS)
+    plants = [
+        dict(zip(plant_keys, row)) for row in db.session.execute(
+            select(*PLANT_FIELDS.values()).where(Plant.garden_id == garden['id']).order_by(Plant.id)
+        )
+    ]
+
+    # A garden holds few distinct seeds, so load each once and share it between plants
+    seed_ids = {plant['seed_id'] for plant in plants}
+    seeds = {}
+    if seed_ids:
+        seed_keys = list(SEED_FIELDS)
+        seeds = {
+            row.id: dict(zip(seed_keys, row))
+            for row in db.session.execute(select(*SEED_FIELDS.values()).where(Seed.id.in_(seed_ids)))
+        }
+    for plant in plants:
+        plant['seed'] = seeds.get(plant['seed_id'])
+
+    garden['plants'] = plants
+    return garden
@@ -0,0 +1,380 @@
+"""Async serving mode, so requests waiting on Strava don't hold a worker thread.
+
+SERVING_MODE=async makes gunicorn.conf.py serve asgi:app on uvicorn workers.
+Views marked strava_bound (see strava_tasks) are driven on the event loop:
+their database steps run on a pool of ASYNC_WORKER_THREADS threads, and the
+Strava calls they yield wait on an async HTTP client with at most
+STRAVA_ASYNC_CONCURRENCY calls in flight per worker. Background sync jobs run
+the same way. Every other request is served by the Flask app on the thread pool.
+"""
+import asyncio
+import contextvars
+import copy
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import httpx
+from flask import g
+from werkzeug.exceptions import HTTPException
+from metrics import observe_strava_call
+from strava_http import STRAVA_HTTP_TIMEOUT
+from strava_service import rate_limit_exceeded
+import strava_tasks
+import logging
+
+logger = logging.getLogger(__name__)
+
+# httpx logs every request at INFO, requests only at DEBUG
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+STRAVA_API_URL = 'https://www.strava.com/api/v3'
+
+# httpx transport for the Strava client, swapped for a local fake in benchmarks
+transport = None
+
+# Seconds a shutting down worker waits for background syncs to finish
+SHUTDOWN_GRACE = 30
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+def _namespace(data, *fields):
+    """A Strava JSON object as attributes, like stravalib's models, with the given fields always present"""
+    values = dict.fromkeys(fields)
+    for key, value in data.items():
+        values[key] = _namespace(value) if isinstance(value, dict) else value
+    return SimpleNamespace(**values)
+
+def _activity(data):
+    activity = _namespace(data, 'id', 'type', 'distance', 'moving_time', 'start_date', 'start_date_local')
+    activity.start_date = _parse_time(activity.start_date)
+    if activity.start_date_local:
+        # Local wall-clock time, naive as stravalib returns it
+        activity.start_date_local = _parse_time(activity.start_date_local).replace(tzinfo=None)
+    if activity.moving_time is not None:
+        activity.moving_time = timedelta(seconds=activity.moving_time)
+    return activity
+
+class AsyncStravaClient:
+    """The Strava calls tasks make, answered like stravalib's Client, with bounded concurrency"""
+
+    def __init__(self, concurrency=50, transport=None, timeout=STRAVA_HTTP_TIMEOUT):
+        connect_timeout, read_timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.http = httpx.AsyncClient(
+            base_url=STRAVA_API_URL,
+            transport=transport,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        )
+
+    async def call(self, call):
+        """Make a call yielded by a task"""
+        return await getattr(self, call.method)(call.access_token, *call.args, **call.kwargs)
+
+    async def get(self, path, access_token, params=None):
+        async with self.semaphore:
+            started = time.perf_counter()
+            try:
+                response = await self.http.get(path, params=params, headers={'Authorization': f'Bearer {access_token}'})
+            except Exception:
+                observe_strava_call(STRAVA_API_URL + path, None, time.perf_counter() - started)
+                raise
+            observe_strava_call(str(response.url), response, time.perf_counter() - started)
+
+        if response.status_code == 429:
+            raise rate_limit_exceeded()(f'Rate limit exceeded: {response.text}')
+        response.raise_for_status()
+        return response.json()
+
+    async def get_athlete(self, access_token):
+        data = await self.get('/athlete', access_token)
+        return _namespace(data, 'id', 'firstname', 'lastname', 'city', 'country', 'profile')
+
+    async def get_athlete_stats(self, access_token, athlete_id):
+        data = await self.get(f'/athletes/{athlete_id}/stats', access_token)
+        return _namespace(data, 'recent_run_totals', 'all_run_totals')
+
+    async def get_activities(self, access_token, after=None, limit=None):
+        params = {'per_page': min(limit or 200, 200)}
+        if after:
+            params['after'] = int(after.timestamp())
+
+        activities = []
+        page = 1
+        while limit is None or len(activities) < limit:
+            batch = await self.get('/athlete/activities', access_token, {**params, 'page': page})
+            activities.extend(_activity(data) for data in batch)
+            if len(batch) < params['per_page']:
+                break
+            page += 1
+        return activities[:limit]
+
+    async def aclose(self):
+        await self.http.aclose()
+
+class AsyncStravaServer:
+    """ASGI app serving a Flask app, with its Strava-bound views driven on the event loop"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        # Applies the app's WSGI middleware, such as ProxyFix, to the environs of views driven here
+        self.middleware = self.wrap_middleware(flask_app.wsgi_app)
+        self.loop = None
+        self.client = None
+        self.executor = None
+        self.background = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+
+        self.start()
+        environ = self.environ(scope, await self.read_body(receive))
+        context = contextvars.Context()
+        if self.is_strava_bound(environ):
+            status, headers, body = await self.respond(environ, context)
+        else:
+            status, headers, body = await self.in_thread(context, self.serve_wsgi, environ)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start(self):
+        """Create the client and threads on the worker's event loop, once"""
+        if self.loop is not None:
+            return
+        config = self.flask_app.config
+        self.loop = asyncio.get_running_loop()
+        self.client = AsyncStravaClient(config['STRAVA_ASYNC_CONCURRENCY'], transport=transport)
+        self.executor = ThreadPoolExecutor(config['ASYNC_WORKER_THREADS'], thread_name_prefix='async-worker')
+        strava_tasks.async_server = self
+
+    async def stop(self):
+        strava_tasks.async_server = None
+        if self.background:
+            await asyncio.wait(self.background, timeout=SHUTDOWN_GRACE)
+        await self.client.aclose()
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    @staticmethod
+    def environ(scope, body):
+        """A WSGI environ for an ASGI request"""
+        script_name = scope.get('root_path', '')
+        path = scope['path']
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name.encode('utf8').decode('latin1'),
+            'PATH_INFO': path.encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('ascii'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            value = value.decode('latin1')
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+        return environ
+
+    @classmethod
+    def wrap_middleware(cls, wsgi_app):
+        """Copy werkzeug-style middleware, which keeps the app it wraps as .app, down to the Flask app,
+        which is replaced by an app returning the environ it gets instead of serving it"""
+        if not hasattr(wsgi_app, 'app'):
+            return lambda environ, start_response: environ
+        middleware = copy.copy(wsgi_app)
+        middleware.app = cls.wrap_middleware(wsgi_app.app)
+        return middleware
+
+    def is_strava_bound(self, environ):
+        adapter = self.flask_app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, _ = adapter.match()
+        except HTTPException:
+            return False
+        return getattr(self.flask_app.view_functions.get(endpoint), 'strava_bound', False)
+
+    def in_thread(self, context, function, *args):
+        """Run a blocking step on the thread pool, in the request's context"""
+        return self.loop.run_in_executor(self.executor, context.run, function, *args)
+
+    def serve_wsgi(self, environ):
+        """Serve a request with the WSGI app, returning the buffered response"""
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+
+        result = self.flask_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started[0], started[1], body
+
+    async def respond(self, environ, context):
+        """Serve a request whose view returns a task, awaiting the task's Strava calls.
+
+        Each step on the thread pool runs up to the task's next call, or on through the response.
+        """
+        request_context = self.flask_app.request_context(self.middleware(environ, None))
+        task = None
+        step = self.in_thread(context, self.begin, request_context)
+        try:
+            # Shielded, so a cancelled request still learns how far its step got
+            done, value = await asyncio.shield(step)
+            while not done:
+                task, call = value
+                send, result = await self.call(task, call, context)
+                step = self.in_thread(context, self.advance, request_context, task, send, result)
+                done, value = await asyncio.shield(step)
+            return value
+        finally:
+            # If the client went away or a step failed, pop the request once its step is done
+            if step.done():
+                self.abandon_unfinished(request_context, context, step, task)
+            else:
+                step.add_done_callback(lambda step: self.abandon_unfinished(request_context, context, step, task))
+
+    def abandon_unfinished(self, request_context, context, step, task):
+        """Close a request's task and pop its context, unless its last step finished the response"""
+        if step.cancelled():
+            return
+        if step.exception() is None:
+            done, value = step.result()
+            if done:
+                return
+            task = value[0]
+        self.in_thread(context, self.abandon, request_context, task)
+
+    def begin(self, request_context):
+        """Push the request and dispatch it as Flask does, with the view returning its task"""
+        request_context.push()
+        try:
+            rv = self.flask_app.preprocess_request()
+            if rv is None:
+                g.defer_strava_calls = True
+                rv = self.flask_app.dispatch_request()
+        except Exception as e:
+            rv = self.recover(e)
+        if hasattr(rv, 'send'):
+            return self.advance(request_context, rv, rv.send, None)
+        return True, self.finish(request_context, rv)
+
+    def advance(self, request_context, task, send, value):
+        try:
+            done, rv = strava_tasks.step(task, send, value)
+        except Exception as e:
+            done, rv = True, self.recover(e)
+        if done:
+            return True, self.finish(request_context, rv)
+        return False, (task, rv)
+
+    def abandon(self, request_context, task):
+        try:
+            if task is not None:
+                task.close()
+        except Exception as e:
+            logger.error(f"Abandoned Strava task failed to close: {str(e)}")
+        finally:
+            request_context.pop()
+
+    def recover(self, e):
+        """Turn an exception raised by a view into a response, called while it is being handled"""
+        try:
+            return self.flask_app.handle_user_exception(e)
+        except Exception as unhandled:
+            return self.flask_app.handle_exception(unhandled)
+
+    def finish(self, request_context, rv):
+        try:
+            try:
+                response = self.flask_app.finalize_request(rv)
+            except Exception as e:
+                response = self.recover(e)
+            return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+        finally:
+            request_context.pop()
+
+    async def call(self, task, call, context):
+        """Make a task's Strava call, returning how to resume the task with the outcome"""
+        try:
+            # In the task's context, so the call is counted in its request's metrics
+            return task.send, await asyncio.create_task(self.client.call(call), context=context)
+        except Exception as e:
+            return task.throw, e
+
+    async def drive(self, task, context):
+        """Run a task to its end: its steps on the thread pool, its Strava calls on the event loop"""
+        send, value = task.send, None
+        while True:
+            done, call = await self.in_thread(context, strava_tasks.step, task, send, value)
+            if done:
+                return call
+            send, value = await self.call(task, call, context)
+
+    def submit_background(self, app, task):
+        """Run a task in an app context on the event loop, from any thread"""
+        self.loop.call_soon_threadsafe(self.spawn_background, app, task)
+
+    def spawn_background(self, app, task):
+        context = contextvars.Context()
+        job = self.loop.create_task(self.run_background(app, task, context))
+        self.background.add(job)
+        job.add_done_callback(self.background.discard)
+
+    async def run_background(self, app, task, context):
+        app_context = app.app_context()
+        await self.in_thread(context, app_context.push)
+        try:
+            await self.drive(task, context)
+        except Exception as e:
+            logger.error(f"Background Strava task failed: {str(e)}")
+        finally:
+            await self.in_thread(context, app_context.pop)
@@ -0,0 +1,34 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import observe_strava_call
+
+# Seconds to wait for Strava to connect and respond
+STRAVA_HTTP_TIMEOUT = (5, 15)
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Connection pool adapter that applies a default timeout to every request and times it"""
+    
+    def __init__(self, *args, timeout=STRAVA_HTTP_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+    
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        started = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            observe_strava_call(request.url, None, time.perf_counter() - started)
+            raise
+        observe_strava_call(request.url, response, time.perf_counter() - started)
+        return response
+
+def create_http_session(pool_size=10):
+    """Keep-alive session shared by all Strava calls"""
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -1,31 +1,80 @@
 import os
 import time
-import requests
+import threading
 from datetime import datetime, timezone, timedelta
-from stravalib.client import Client
-from stravalib import exc
 from app import db
-from models import StravaAccount, User, Run, IntensityLevel
-from utils import calculate_coins_for_run
+from models import StravaAccount, User, Run, IntensityLevel, XP_PER_KM
+from utils import as_utc, calculate_coins_for_run, get_user_run_stats, water_garden_with_runs
+import coin_ledger
+from strava_tasks import strava_call
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# How long an authenticated client is reused for the same token
+CLIENT_CACHE_TTL = 300
+
+# Strava activity types imported as runs
+RUN_ACTIVITY_TYPES = ['run', 'virtualrun']
+
+# Token refresh locks, shared by users with the same id modulo this
+REFRESH_LOCK_STRIPES = 64
+
+def is_run_activity(activity):
+    return (str(activity.type).lower() if activity.type else '') in RUN_ACTIVITY_TYPES
+
+def rate_limit_exceeded():
+    """stravalib's rate limit error; except clauses evaluate this only once an exception is raised"""
+    from stravalib.exc import RateLimitExceeded
+    return RateLimitExceeded
+
 class StravaService:
     def __init__(self):
         self.client_id = os.environ.get('STRAVA_CLIENT_ID', '167433')
         self.client_secret = os.environ.get('STRAVA_CLIENT_SECRET', '15e7b8ff9efa35ec7e4d770d7161b3ae7b52f526')
         self.redirect_uri = None  # Will be set dynamically
         
+        # stravalib and requests are imported on first use, they are most of the app's import time
+        self._client_class = None
+        self._http = None
+        self._http_lock = threading.Lock()
+        
+        # Authenticated clients by access token, as (created, client)
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        
+        # One refresh in flight per user, from a fixed set of locks so memory stays bounded
+        self._refresh_locks = [threading.Lock() for _ in range(REFRESH_LOCK_STRIPES)]
+        
         if not self.client_id or not self.client_secret:
             logger.warning("Strava credentials not found in environment variables")
     
+    @property
+    def client_class(self):
+        """stravalib's Client unless swapped for a local fake in tests"""
+        if self._client_class is None:
+            from stravalib.client import Client
+            self._client_class = Client
+        return self._client_class
+    
+    @client_class.setter
+    def client_class(self, client_class):
+        self._client_class = client_class
+    
+    @property
+    def http(self):
+        """Keep-alive session shared by all Strava calls"""
+        if self._http is None:
+            with self._http_lock:
+                if self._http is None:
+                    from strava_http import create_http_session
+                    self._http = create_http_session(int(os.environ.get('STRAVA_HTTP_POOL_SIZE', 10)))
+        return self._http
+    
     def get_authorization_url(self, redirect_uri):
         """Generate Strava OAuth authorization URL"""
         self.redirect_uri = redirect_uri
-        client = Client()
+        client = self.client_for_token()
         
         auth_url = client.authorization_url(
             client_id=int(self.client_id),
@@ -37,7 +86,7 @@ class StravaService:
     
     def exchange_code_for_token(self, code, redirect_uri):
         """Exchange authorization code for access token"""
-        client = Client()
+        client = self.client_for_token()
         
         try:
             token_response = client.exchange_code_for_token(
@@ -66,7 +115,7 @@ class StravaService:
                 'grant_type': 'refresh_token'
             }
             
-            response = requests.post('https://www.strava.com/oauth/token', data=payload)
+            response = self.http.post('https://www.strava.com/oauth/token', data=payload)
             response.raise_for_status()
             
             token_data = response.json()
@@ -80,8 +129,39 @@ class StravaService:
             logger.error(f"Failed to refresh token: {str(e)}")
             raise
     
-    def get_client_for_user(self, user_id):
-        """Get authenticated Strava client for user"""
+    def client_for_token(self, access_token=None):
+        """Create a Strava client that uses the shared connection pool"""
+        return self.client_class(access_token=access_token, requests_session=self.http)
+    
+    def _refresh_lock(self, user_id):
+        # Users sharing a stripe only wait on each other's refreshes, which are rare
+        return self._refresh_locks[user_id % REFRESH_LOCK_STRIPES]
+    
+    def _refresh_tokens(self, user_id, strava_account):
+        """Refresh a user's tokens unless a concurrent request already did"""
+        with self._refresh_lock(user_id):
+            # Re-read under a row lock so other workers wait for the refresh to commit
+            strava_account = StravaAccount.query.filter_by(
+                id=strava_account.id
+            ).populate_existing().with_for_update().first()
+            if not strava_account.is_token_expired():
+                db.session.commit()
+                return strava_account
+            
+            new_tokens = self.refresh_access_token(strava_account.refresh_token)
+            
+            # Update tokens in database
+            strava_account.access_token = new_tokens['access_token']
+            strava_account.refresh_token = new_tokens['refresh_token']
+            strava_account.expires_at = new_tokens['expires_at']
+            
+            db.session.commit()
+            
+            logger.info(f"Refreshed Strava token for user {user_id}")
+            return strava_account
+    
+    def account_for_user(self, user_id):
+        """Get a user's active Strava account with a valid access token, refreshing it if needed"""
         strava_account = StravaAccount.query.filter_by(user_id=user_id, is_active=True).first()
         
         if not strava_account:
@@ -90,123 +170,224 @@ class StravaService:
         # Check if token needs refresh
         if strava_account.is_token_expired():
             try:
-                new_tokens = self.refresh_access_token(strava_account.refresh_token)
-                
-                # Update tokens in database
-                strava_account.access_token = new_tokens['access_token']
-                strava_account.refresh_token = new_tokens['refresh_token']
-                strava_account.expires_at = new_tokens['expires_at']
-                
-                db.session.commit()
-                
-                logger.info(f"Refreshed Strava token for user {user_id}")
+                strava_account = self._refresh_tokens(user_id, strava_account)
             except Exception as e:
+                db.session.rollback()
                 logger.error(f"Failed to refresh token for user {user_id}: {str(e)}")
                 return None
         
-        # Create authenticated client
-        client = Client(access_token=strava_account.access_token)
+        return strava_account
+    
+    def cached_client(self, access_token):
+        """Get a recent client built for the same token, or a new one"""
+        now = time.monotonic()
+        with self._clients_lock:
+            cached = self._clients.get(access_token)
+            if cached and now - cached[0] < CLIENT_CACHE_TTL:
+                return cached[1]
+        
+        client = self.client_for_token(access_token)
+        with self._clients_lock:
+            # Drop expired entries so the cache stays bounded by active users
+            self._clients = {
+                key: value for key, value in self._clients.items() if now - value[0] < CLIENT_CACHE_TTL
+            }
+            self._clients[access_token] = (now, client)
         return client
     
+    def get_client_for_user(self, user_id):
+        """Get authenticated Strava client for user"""
+        strava_account = self.account_for_user(user_id)
+        if not strava_account:
+            return None
+        return self.cached_client(strava_account.access_token)
+    
+    def activity_to_run_row(self, user_id, activity):
+        """Convert a Strava activity to column values for a Run"""
+        distance_km = float(activity.distance or 0) / 1000  # Convert meters to km
+        moving_time = activity.moving_time
+        if moving_time and hasattr(moving_time, 'total_seconds'):
+            duration_minutes = int(moving_time.total_seconds() / 60)
+        else:
+            duration_minutes = 0
+        
+        # Determine intensity based on pace
+        pace_min_per_km = duration_minutes / distance_km if distance_km > 0 else 0
+        
+        if pace_min_per_km <= 4:
+            intensity = IntensityLevel.EXTREME
+        elif pace_min_per_km <= 5:
+            intensity = IntensityLevel.HIGH
+        elif pace_min_per_km <= 6.5:
+            intensity = IntensityLevel.MODERATE
+        else:
+            intensity = IntensityLevel.LOW
+        
+        return {
+            'user_id': user_id,
+            'strava_activity_id': activity.id,
+            'distance_km': distance_km,
+            'duration_minutes': duration_minutes,
+            'intensity': intensity,
+            'pace_min_per_km': pace_min_per_km,
+            'coins_earned': calculate_coins_for_run(distance_km, intensity),
+            'created_at': activity.start_date or datetime.now(timezone.utc)
+        }
+    
+    def insert_runs(self, rows):
+        """Bulk insert run rows, ignoring activities that another sync already stored.
+        
+        Returns the rows that were actually inserted.
+        """
+        if not rows:
+            return []
+        
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            # No upsert support, rely on the pre-check and the unique index
+            runs = [Run(**row) for row in rows]
+            db.session.add_all(runs)
+            db.session.flush()
+            return runs
+        
+        stmt = insert(Run).values(rows).on_conflict_do_nothing(
+            index_elements=['strava_activity_id']
+        ).returning(
+            Run.distance_km, Run.duration_minutes, Run.intensity,
+            Run.pace_min_per_km, Run.coins_earned, Run.created_at
+        )
+        return db.session.execute(stmt).all()
+    
+    def import_activities(self, user_id, activities):
+        """Store new running activities as runs and apply their coins, XP and watering.
+        
+        Activities already stored are skipped. The caller commits.
+        Returns (synced_count, skipped_count).
+        """
+        stats = get_user_run_stats(user_id)
+        
+        # Convert running activities to run rows, keyed by Strava activity id
+        rows = {}
+        legacy_starts = {}
+        for activity in activities:
+            # Only sync running activities
+            if not is_run_activity(activity):
+                continue
+            
+            rows[activity.id] = self.activity_to_run_row(user_id, activity)
+            
+            # Runs imported before activity ids were stored were keyed by local start time
+            if activity.start_date_local:
+                legacy_starts[activity.start_date_local.replace(tzinfo=None)] = activity.id
+        
+        # Check every fetched id against the table in one query
+        if rows:
+            existing_ids = {
+                activity_id for (activity_id,) in db.session.query(Run.strava_activity_id)
+                .filter(Run.strava_activity_id.in_(list(rows)))
+            }
+            
+            # Back-fill ids on matching legacy runs so they are deduplicated by id from now on
+            if legacy_starts:
+                legacy_runs = Run.query.filter(
+                    Run.user_id == user_id,
+                    Run.strava_activity_id.is_(None),
+                    Run.created_at.in_([start.replace(tzinfo=timezone.utc) for start in legacy_starts])
+                ).all()
+                for run in legacy_runs:
+                    activity_id = legacy_starts.get(run.created_at.replace(tzinfo=None))
+                    if activity_id is not None and activity_id not in existing_ids:
+                        run.strava_activity_id = activity_id
+                        existing_ids.add(activity_id)
+            
+            new_rows = [row for activity_id, row in rows.items() if activity_id not in existing_ids]
+        else:
+            new_rows = []
+        
+        inserted_runs = self.insert_runs(new_rows)
+        synced_count = len(inserted_runs)
+        skipped_count = len(rows) - synced_count
+        
+        # Effects of the newly imported runs, applied once below
+        new_coins = 0
+        new_experience = 0
+        for run in inserted_runs:
+            stats.add_run(run)
+            new_coins += run.coins_earned
+            new_experience += int(run.distance_km * XP_PER_KM)
+        
+        # Apply only the deltas of the newly imported runs
+        if synced_count > 0:
+            from models import Garden
+            
+            coin_ledger.credit(user_id, new_coins, coin_ledger.STRAVA)
+            
+            # Update garden experience
+            garden = Garden.query.filter_by(user_id=user_id).first()
+            if garden:
+                garden.add_experience(new_experience)
+                
+                # Every imported run waters the plants planted by the time it happened
+                plants = water_garden_with_runs(garden.id, inserted_runs)
+                
+                stats.set_plant_counts(plants)
+        
+        return synced_count, skipped_count
+    
+    def update_activities(self, user_id, activities):
+        """Apply edits of activities already stored as runs.
+        
+        A run takes the activity's new values, or is deleted if the activity is
+        no longer a run. As with deleted activities, coins, XP and watering
+        already applied are kept; the caller rebuilds the running aggregates and
+        commits. Returns (activities not stored yet, whether any run changed).
+        """
+        pending = {activity.id: activity for activity in activities}
+        if not pending:
+            return [], False
+        
+        changed = False
+        runs = Run.query.filter(Run.user_id == user_id, Run.strava_activity_id.in_(list(pending))).all()
+        for run in runs:
+            activity = pending.pop(run.strava_activity_id)
+            if not is_run_activity(activity):
+                db.session.delete(run)
+                changed = True
+                continue
+            
+            # Most edits only rename the activity, which leaves the run as it is
+            row = self.activity_to_run_row(user_id, activity)
+            row['created_at'] = as_utc(row['created_at'])
+            for column in ('distance_km', 'duration_minutes', 'intensity', 'pace_min_per_km', 'coins_earned', 'created_at'):
+                old_value = as_utc(run.created_at) if column == 'created_at' else getattr(run, column)
+                if old_value != row[column]:
+                    setattr(run, column, row[column])
+                    changed = True
+        
+        return list(pending.values()), changed
+    
     def sync_recent_activities(self, user_id, days_back=7):
-        """Sync recent activities from Strava"""
-        client = self.get_client_for_user(user_id)
-        if not client:
+        """Sync recent activities from Strava, as a task (see strava_tasks)"""
+        strava_account = self.account_for_user(user_id)
+        if not strava_account:
             return {"error": "No valid Strava connection"}
         
         try:
             # Get activities from the last week
             after_date = datetime.now(timezone.utc) - timedelta(days=days_back)
-            activities = client.get_activities(after=after_date, limit=50)
+            activities = yield strava_call('get_activities', strava_account.access_token, after=after_date, limit=50)
             
-            synced_count = 0
-            skipped_count = 0
+            synced_count, skipped_count = self.import_activities(user_id, activities)
             
-            for activity in activities:
-                # Only sync running activities
-                activity_type = str(activity.type).lower() if activity.type else ''
-                if activity_type not in ['run', 'virtualrun']:
-                    continue
-                
-                # Check if activity already exists
-                start_date = activity.start_date_local
-                if start_date and hasattr(start_date, 'replace'):
-                    start_date = start_date.replace(tzinfo=timezone.utc)
-                else:
-                    start_date = datetime.now(timezone.utc)
-                
-                existing_run = Run.query.filter_by(
-                    user_id=user_id,
-                    created_at=start_date
-                ).first()
-                
-                if existing_run:
-                    skipped_count += 1
-                    continue
-                
-                # Convert Strava activity to our Run model
-                distance_km = float(activity.distance or 0) / 1000  # Convert meters to km
-                moving_time = activity.moving_time
-                if moving_time and hasattr(moving_time, 'total_seconds'):
-                    duration_minutes = int(moving_time.total_seconds() / 60)
-                else:
-                    duration_minutes = 0
-                
-                # Determine intensity based on pace
-                pace_min_per_km = duration_minutes / distance_km if distance_km > 0 else 0
-                
-                if pace_min_per_km <= 4:
-                    intensity = IntensityLevel.EXTREME
-                elif pace_min_per_km <= 5:
-                    intensity = IntensityLevel.HIGH
-                elif pace_min_per_km <= 6.5:
-                    intensity = IntensityLevel.MODERATE
-                else:
-                    intensity = IntensityLevel.LOW
-                
-                # Calculate coins
-                coins_earned = calculate_coins_for_run(distance_km, intensity)
-                
-                # Create run record
-                run = Run()
-                run.user_id = user_id
-                run.distance_km = distance_km
-                run.duration_minutes = duration_minutes
-                run.intensity = intensity
-                run.pace_min_per_km = pace_min_per_km
-                run.coins_earned = coins_earned
-                run.created_at = start_date
-                
-                db.session.add(run)
-                synced_count += 1
-            
-            # Update user's coins and garden
-            if synced_count > 0:
-                from models import CoinWallet, Garden
-                
-                wallet = CoinWallet.query.filter_by(user_id=user_id).first()
-                if wallet:
-                    total_coins = sum(run.coins_earned for run in Run.query.filter_by(user_id=user_id).all())
-                    wallet.balance = total_coins
-                    wallet.total_earned = total_coins
-                
-                # Update garden experience
-                garden = Garden.query.filter_by(user_id=user_id).first()
-                if garden:
-                    total_distance = sum(run.distance_km for run in Run.query.filter_by(user_id=user_id).all())
-                    garden.add_experience(int(total_distance * 10))
-                    
-                    # Water plants based on recent activity
-                    for plant in garden.plants:
-                        # Use the most recent run for watering
-                        recent_run = Run.query.filter_by(user_id=user_id).order_by(Run.created_at.desc()).first()
-                        if recent_run:
-                            plant.water(recent_run.distance_km, recent_run.intensity)
-            
-            # Update last sync time
+            # Update last sync time, which also ends any fleet sync backoff
             strava_account = StravaAccount.query.filter_by(user_id=user_id, is_active=True).first()
             if strava_account:
                 strava_account.last_sync = datetime.now(timezone.utc)
+                strava_account.sync_failures = 0
             
             db.session.commit()
             
@@ -217,25 +398,25 @@ class StravaService:
                 "total_checked": synced_count + skipped_count
             }
             
-        except exc.RateLimitExceeded as e:
+        except rate_limit_exceeded() as e:
+            db.session.rollback()
             logger.warning(f"Strava rate limit exceeded: {str(e)}")
-            return {"error": "Strava rate limit exceeded. Please try again later."}
+            return {"error": "Strava rate limit exceeded. Please try again later.", "rate_limited": True}
         except Exception as e:
+            db.session.rollback()
             logger.error(f"Failed to sync activities: {str(e)}")
             return {"error": f"Failed to sync activities: {str(e)}"}
     
     def get_athlete_stats(self, user_id):
-        """Get athlete statistics from Strava"""
-        client = self.get_client_for_user(user_id)
-        if not client:
+        """Get athlete statistics from Strava, as a task (see strava_tasks)"""
+        strava_account = self.account_for_user(user_id)
+        if not strava_account:
             return None
         
         try:
-            strava_account = StravaAccount.query.filter_by(user_id=user_id, is_active=True).first()
-            if not strava_account:
-                return None
-            
-            athlete_stats = client.get_athlete_stats(strava_account.strava_athlete_id)
+            athlete_stats = yield strava_call(
+                'get_athlete_stats', strava_account.access_token, strava_account.strava_athlete_id
+            )
             
             recent_totals = athlete_stats.recent_run_totals
             all_totals = athlete_stats.all_run_totals
@@ -0,0 +1,77 @@
+"""Strava-bound work written once for both serving modes.
+
+A task is a generator that yields a StravaCall for every Strava API call it
+makes and gets the result (or the exception, raised at the yield) back. run()
+drives a task on the current thread with stravalib, the async server in
+strava_async.py drives it on an async HTTP client instead.
+
+The database session is rolled back before each call, so no connection or
+transaction is held while Strava answers. Commit what must be kept before
+yielding and reload what is needed after.
+"""
+from collections import namedtuple
+from functools import wraps
+from flask import g
+from app import db
+
+StravaCall = namedtuple('StravaCall', ['method', 'access_token', 'args', 'kwargs'])
+
+# Client methods returning an iterator, read to the end where the call is made
+ITERATOR_METHODS = {'get_activities'}
+
+# The async server running in this process, set while it serves
+async_server = None
+
+def strava_call(method, access_token, *args, **kwargs):
+    """Describe a call of a stravalib Client method for a task to yield"""
+    return StravaCall(method, access_token, args, kwargs)
+
+def execute(call):
+    """Make a call with stravalib on the current thread"""
+    from strava_service import strava_service
+    client = strava_service.cached_client(call.access_token)
+    result = getattr(client, call.method)(*call.args, **call.kwargs)
+    return list(result) if call.method in ITERATOR_METHODS else result
+
+def step(task, send, value):
+    """Advance a task to its next call, returning (done, call or result)"""
+    try:
+        call = send(value)
+    except StopIteration as stop:
+        return True, stop.value
+    db.session.rollback()
+    return False, call
+
+def run(task):
+    """Drive a task to its end on the current thread and return its result"""
+    send, value = task.send, None
+    while True:
+        done, call = step(task, send, value)
+        if done:
+            return call
+        try:
+            send, value = task.send, execute(call)
+        except Exception as e:
+            send, value = task.throw, e
+
+def strava_bound(view):
+    """Mark a view written as a task.
+
+    The task runs right here under a WSGI server. Under the async server the
+    view returns it instead, for the server to drive.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        task = view(*args, **kwargs)
+        if g.get('defer_strava_calls'):
+            return task
+        return run(task)
+    wrapper.strava_bound = True
+    return wrapper
+
+def submit_background(app, task):
+    """Run a task on the async server's event loop if one serves this process, returning whether it will"""
+    if async_server is None:
+        return False
+    async_server.submit_background(app, task)
+    return True
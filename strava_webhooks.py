@@ -0,0 +1,187 @@
+import threading
+import click
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import update, or_
+from app import db
+from models import StravaWebhookEvent, StravaAccount, Run
+from strava_service import strava_service
+from sync_jobs import get_executor
+from utils import rebuild_user_run_stats
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Events claimed per processing pass
+BATCH_SIZE = 500
+
+# Events claimed longer ago than this were left by a processor that died, and are claimed again
+CLAIM_TIMEOUT = timedelta(minutes=15)
+
+_process_lock = threading.Lock()
+
+def record_event(payload):
+    """Store a webhook event in the local queue, returning None if it is malformed"""
+    try:
+        event = StravaWebhookEvent()
+        event.owner_id = int(payload['owner_id'])
+        event.object_type = str(payload['object_type'])
+        event.object_id = int(payload['object_id'])
+        event.aspect_type = str(payload['aspect_type'])
+        event.updates = payload.get('updates') or {}
+        if payload.get('event_time'):
+            event.event_time = datetime.fromtimestamp(int(payload['event_time']), tz=timezone.utc)
+    except (KeyError, ValueError, TypeError):
+        return None
+
+    event.status = 'pending'
+    db.session.add(event)
+    db.session.commit()
+    return event
+
+def schedule_processing():
+    """Process the queue in the background, or inline when syncs run eagerly"""
+    app = current_app._get_current_object()
+    if app.config.get('STRAVA_SYNC_EAGER'):
+        process_pending_events()
+    else:
+        get_executor(app).submit(_process_in_context, app)
+
+def _process_in_context(app):
+    with app.app_context():
+        process_pending_events()
+
+def claim_pending_events(batch_size=BATCH_SIZE):
+    """Mark a batch of pending events processing and return them, oldest first.
+
+    Checking and flipping the status is one conditional UPDATE, so with
+    several workers or instances processing the queue each event is claimed,
+    and fetched from Strava, by only one of them.
+    """
+    now = datetime.now(timezone.utc)
+    claimable = or_(
+        StravaWebhookEvent.status == 'pending',
+        (StravaWebhookEvent.status == 'processing') & (StravaWebhookEvent.claimed_at < now - CLAIM_TIMEOUT)
+    )
+    batch = db.session.query(StravaWebhookEvent.id).filter(claimable).order_by(
+        StravaWebhookEvent.id
+    ).limit(batch_size).scalar_subquery()
+    claimed_ids = db.session.execute(
+        update(StravaWebhookEvent)
+        .where(StravaWebhookEvent.id.in_(batch), claimable)
+        .values(status='processing', claimed_at=now)
+        .returning(StravaWebhookEvent.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.session.commit()
+    if not claimed_ids:
+        return []
+    return StravaWebhookEvent.query.filter(StravaWebhookEvent.id.in_(claimed_ids)).order_by(StravaWebhookEvent.id).all()
+
+def process_pending_events(batch_size=BATCH_SIZE):
+    """Process queued events in batches grouped by athlete.
+
+    Returns the number of events handled.
+    """
+    # A pass already in progress in this process will pick up anything queued meanwhile
+    if not _process_lock.acquire(blocking=False):
+        return 0
+
+    try:
+        handled = 0
+        while True:
+            events = claim_pending_events(batch_size)
+            if not events:
+                return handled
+
+            by_owner = {}
+            for event in events:
+                by_owner.setdefault(event.owner_id, []).append(event)
+
+            accounts = {
+                account.strava_athlete_id: account
+                for account in StravaAccount.query.filter(
+                    StravaAccount.strava_athlete_id.in_(list(by_owner)),
+                    StravaAccount.is_active.is_(True)
+                )
+            }
+
+            for owner_id, owner_events in by_owner.items():
+                process_athlete_events(accounts.get(owner_id), owner_events)
+                handled += len(owner_events)
+    finally:
+        _process_lock.release()
+
+def process_athlete_events(account, events):
+    """Apply one athlete's events, fetching only the activities that changed"""
+    try:
+        if account:
+            user_id = account.user_id
+
+            # Only the latest aspect of each activity matters
+            latest_aspects = {}
+            for event in events:
+                if event.object_type == 'athlete':
+                    if str((event.updates or {}).get('authorized', '')).lower() == 'false':
+                        # The athlete revoked access to our app
+                        account.is_active = False
+                elif event.object_type == 'activity':
+                    latest_aspects[event.object_id] = event.aspect_type
+
+            deleted_ids = [activity_id for activity_id, aspect in latest_aspects.items() if aspect == 'delete']
+            changed_ids = [activity_id for activity_id, aspect in latest_aspects.items() if aspect != 'delete']
+            history_changed = False
+
+            if account.is_active and changed_ids:
+                client = strava_service.get_client_for_user(user_id)
+                if not client:
+                    raise RuntimeError('No valid Strava connection')
+                activities = [client.get_activity(activity_id) for activity_id in changed_ids]
+                # Edits apply to stored runs, the rest (new, or created and edited since) is imported
+                new_activities, history_changed = strava_service.update_activities(user_id, activities)
+                if new_activities:
+                    strava_service.import_activities(user_id, new_activities)
+
+            if deleted_ids:
+                Run.query.filter(
+                    Run.user_id == user_id,
+                    Run.strava_activity_id.in_(deleted_ids)
+                ).delete(synchronize_session=False)
+                history_changed = True
+
+            if history_changed:
+                # Coins already earned are kept, the running aggregates follow the history
+                rebuild_user_run_stats(user_id)
+
+            account.last_sync = datetime.now(timezone.utc)
+
+        # Events for athletes we don't know are dropped
+        now = datetime.now(timezone.utc)
+        for event in events:
+            event.status = 'processed'
+            event.processed_at = now
+        db.session.commit()
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to process Strava events for athlete {events[0].owner_id}: {str(e)}")
+        now = datetime.now(timezone.utc)
+        for event in events:
+            event.status = 'failed'
+            event.error = str(e)
+            event.processed_at = now
+        db.session.commit()
+
+@click.command('process-webhook-events')
+@click.option('--retry-failed', is_flag=True, help='Queue failed events again before processing.')
+@with_appcontext
+def process_webhook_events_command(retry_failed):
+    """Process queued Strava webhook events"""
+    if retry_failed:
+        StravaWebhookEvent.query.filter_by(status='failed').update(
+            {'status': 'pending', 'error': None}, synchronize_session=False
+        )
+        db.session.commit()
+    handled = process_pending_events()
+    print(f"Processed {handled} Strava webhook events")
@@ -0,0 +1,137 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import SyncJob, SyncJobStatus
+from strava_service import strava_service
+import strava_tasks
+import logging
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = [SyncJobStatus.QUEUED, SyncJobStatus.RUNNING]
+
+# Jobs still active after this long are assumed lost (e.g. the worker process died)
+STALE_JOB_AFTER = timedelta(minutes=10)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor(app):
+    """Get the process-wide worker pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config.get('STRAVA_SYNC_WORKERS', 2),
+                thread_name_prefix='strava-sync'
+            )
+        return _executor
+
+def find_active_job(user_id):
+    """Get the user's queued or running sync job, if any.
+
+    A stale one is marked failed instead, which frees the user for a new job.
+    """
+    job = SyncJob.query.filter(
+        SyncJob.user_id == user_id,
+        SyncJob.status.in_(ACTIVE_STATUSES)
+    ).first()
+    if not job:
+        return None
+
+    created_at = job.created_at if job.created_at.tzinfo else job.created_at.replace(tzinfo=timezone.utc)
+    if created_at >= datetime.now(timezone.utc) - STALE_JOB_AFTER:
+        return job
+
+    # Only if it is still active, another request may have failed it already
+    db.session.execute(update(SyncJob).where(
+        SyncJob.id == job.id, SyncJob.status.in_(ACTIVE_STATUSES)
+    ).values(
+        status=SyncJobStatus.FAILED,
+        error='Sync job was lost before it finished',
+        finished_at=datetime.now(timezone.utc)
+    ).execution_options(synchronize_session=False))
+    db.session.commit()
+    logger.warning(f"Marked stale sync job {job.id} of user {user_id} as failed")
+    return None
+
+def enqueue_sync(user_id, days_back=7):
+    """Queue a Strava sync for a user.
+
+    Returns (job, created). A user with a sync already queued or running gets
+    that job back instead of a new one; the database enforces one per user
+    across processes.
+    """
+    job = find_active_job(user_id)
+    if job:
+        return job, False
+
+    job = SyncJob()
+    job.id = uuid.uuid4().hex
+    job.user_id = user_id
+    job.status = SyncJobStatus.QUEUED
+    job.days_back = days_back
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker queued one between the check and the insert
+        db.session.rollback()
+        job = find_active_job(user_id)
+        if not job:
+            raise
+        return job, False
+
+    app = current_app._get_current_object()
+    if app.config.get('STRAVA_SYNC_EAGER'):
+        # Run inline, for tests and single-process debugging
+        run_sync_job(app, job.id)
+        db.session.refresh(job)
+    elif not strava_tasks.submit_background(app, sync_job_task(job.id)):
+        get_executor(app).submit(run_sync_job, app, job.id)
+
+    return job, True
+
+def run_sync_job(app, job_id):
+    """Run a queued sync job on this thread"""
+    with app.app_context():
+        strava_tasks.run(sync_job_task(job_id))
+
+def sync_job_task(job_id):
+    """Run a queued sync job and record its outcome, as a task (see strava_tasks)"""
+    job = db.session.get(SyncJob, job_id)
+    if not job:
+        return
+    user_id, days_back = job.user_id, job.days_back
+
+    # Claim the job unless it was failed as stale (or claimed) meanwhile
+    claimed = db.session.execute(update(SyncJob).where(
+        SyncJob.id == job_id, SyncJob.status == SyncJobStatus.QUEUED
+    ).values(
+        status=SyncJobStatus.RUNNING, started_at=datetime.now(timezone.utc)
+    ).execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+
+    try:
+        result = yield from strava_service.sync_recent_activities(user_id, days_back)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Sync job {job_id} crashed: {str(e)}")
+        result = {'error': f'Failed to sync activities: {str(e)}'}
+
+    job = db.session.get(SyncJob, job_id)
+    if 'error' in result:
+        job.status = SyncJobStatus.FAILED
+        job.error = result['error']
+    else:
+        job.status = SyncJobStatus.SUCCEEDED
+        job.result = result
+    job.finished_at = datetime.now(timezone.utc)
+    db.session.commit()
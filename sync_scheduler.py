@@ -0,0 +1,228 @@
+import math
+import time
+import click
+from datetime import datetime, timezone, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import func, update
+from app import db
+from models import StravaAccount, Run
+from strava_service import strava_service
+import strava_tasks
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Strava's default read quotas: 100 requests per 15 minutes, 1000 per day
+DEFAULT_SHORT_TERM_LIMIT = 100
+DEFAULT_DAILY_LIMIT = 1000
+
+# Longest wait before a failing account is tried again
+MAX_FAILURE_BACKOFF = timedelta(days=1)
+
+class TokenBucket:
+    """Request budget shared across all accounts, mirroring Strava's quota windows.
+
+    Strava resets the short-term window on the quarter hour and the daily window
+    at midnight UTC, so usage is tracked per aligned window rather than refilled
+    continuously.
+    """
+
+    def __init__(self, short_term_limit=DEFAULT_SHORT_TERM_LIMIT, daily_limit=DEFAULT_DAILY_LIMIT,
+                 reserve=0, clock=time.time):
+        # Windows as (limit, length in seconds); the reserve is left for user-triggered syncs
+        self.windows = [(short_term_limit - reserve, 15 * 60), (daily_limit - reserve, 24 * 60 * 60)]
+        self.clock = clock
+        self.used = {}
+
+    def _window_start(self, length):
+        now = self.clock()
+        return now - (now % length)
+
+    def _used(self, length):
+        start, used = self.used.get(length, (None, 0))
+        if start != self._window_start(length):
+            return 0
+        return used
+
+    def try_acquire(self, cost=1):
+        """Spend `cost` requests if every window has room for them"""
+        if any(self._used(length) + cost > limit for limit, length in self.windows):
+            return False
+        for _, length in self.windows:
+            self.used[length] = (self._window_start(length), self._used(length) + cost)
+        return True
+
+    def exhaust(self):
+        """Mark the current short-term window as spent, e.g. after a 429 from Strava"""
+        limit, length = self.windows[0]
+        self.used[length] = (self._window_start(length), limit)
+
+    def seconds_until_available(self):
+        """Seconds until the fullest exhausted window resets, 0 if there is headroom"""
+        now = self.clock()
+        wait = 0
+        for limit, length in self.windows:
+            if self._used(length) >= limit:
+                wait = max(wait, self._window_start(length) + length - now)
+        return wait
+
+    def headroom(self):
+        return {
+            'short_term': self.windows[0][0] - self._used(self.windows[0][1]),
+            'daily': self.windows[1][0] - self._used(self.windows[1][1])
+        }
+
+class FleetSyncScheduler:
+    """Periodically syncs every active StravaAccount within the shared request budget"""
+
+    def __init__(self, service, bucket, min_interval=timedelta(hours=1), max_days_back=30,
+                 max_backoff=MAX_FAILURE_BACKOFF, clock=time.time):
+        self.service = service
+        self.bucket = bucket
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.max_days_back = max_days_back
+        self.clock = clock
+        self.started_at = clock()
+        self.counters = {
+            'accounts_synced': 0,
+            'accounts_failed': 0,
+            'accounts_backing_off': 0,
+            'activities_imported': 0,
+            'requests_spent': 0,
+            'rate_limited': 0
+        }
+
+    def candidates(self):
+        """Accounts due for a sync, most urgent first.
+
+        Urgency is hours since the last sync, weighted by how many runs the user
+        logged in the last 30 days; accounts that were never synced come first.
+        An account whose syncs keep failing waits out a backoff between attempts,
+        and if it never synced it goes last rather than first.
+        """
+        now = datetime.now(timezone.utc)
+        due_before = now - self.min_interval
+
+        recent_runs = db.session.query(
+            Run.user_id, func.count(Run.id).label('recent_runs')
+        ).filter(
+            Run.created_at >= now - timedelta(days=30)
+        ).group_by(Run.user_id).subquery()
+
+        rows = db.session.query(
+            StravaAccount.user_id,
+            StravaAccount.last_sync,
+            func.coalesce(recent_runs.c.recent_runs, 0),
+            StravaAccount.last_sync_attempt,
+            StravaAccount.sync_failures
+        ).outerjoin(
+            recent_runs, recent_runs.c.user_id == StravaAccount.user_id
+        ).filter(
+            StravaAccount.is_active.is_(True),
+            (StravaAccount.last_sync.is_(None)) | (StravaAccount.last_sync < due_before)
+        ).all()
+
+        def backing_off(row):
+            _, _, _, last_attempt, failures = row
+            if not failures or last_attempt is None:
+                return False
+            if last_attempt.tzinfo is None:
+                last_attempt = last_attempt.replace(tzinfo=timezone.utc)
+            return now - last_attempt < self.backoff_for(failures)
+
+        def priority(row):
+            user_id, last_sync, run_count, _, failures = row
+            if last_sync is None:
+                return 0 if failures else math.inf
+            if last_sync.tzinfo is None:
+                last_sync = last_sync.replace(tzinfo=timezone.utc)
+            stale_hours = (now - last_sync).total_seconds() / 3600
+            return stale_hours * (1 + run_count)
+
+        due = [row for row in rows if not backing_off(row)]
+        self.counters['accounts_backing_off'] = len(rows) - len(due)
+        return sorted(due, key=priority, reverse=True)
+
+    def backoff_for(self, failures):
+        """Wait after a number of consecutive failures, doubling from min_interval"""
+        return min(self.min_interval * 2 ** min(failures - 1, 16), self.max_backoff)
+
+    def record_failure(self, user_id):
+        """Push a failing account back, so a revoked or broken one can't spend the budget every pass"""
+        db.session.execute(update(StravaAccount).where(
+            StravaAccount.user_id == user_id,
+            StravaAccount.is_active.is_(True)
+        ).values(
+            sync_failures=StravaAccount.sync_failures + 1,
+            last_sync_attempt=datetime.now(timezone.utc)
+        ))
+        db.session.commit()
+
+    def days_back_for(self, last_sync):
+        """Sync window covering everything since the last sync"""
+        if last_sync is None:
+            return 7
+        if last_sync.tzinfo is None:
+            last_sync = last_sync.replace(tzinfo=timezone.utc)
+        elapsed_days = (datetime.now(timezone.utc) - last_sync).total_seconds() / 86400
+        return min(self.max_days_back, math.ceil(elapsed_days) + 1)
+
+    def run_once(self):
+        """Sync due accounts until none are left or the budget runs out.
+
+        Returns the number of seconds to wait before the next pass.
+        """
+        for user_id, last_sync, *_ in self.candidates():
+            # One activities page per account
+            if not self.bucket.try_acquire():
+                break
+            self.counters['requests_spent'] += 1
+
+            result = strava_tasks.run(self.service.sync_recent_activities(user_id, self.days_back_for(last_sync)))
+
+            if result.get('rate_limited'):
+                self.counters['rate_limited'] += 1
+                self.bucket.exhaust()
+                logger.warning("Strava rate limit hit, backing off until the quota window resets")
+                break
+            if 'error' in result:
+                self.counters['accounts_failed'] += 1
+                self.record_failure(user_id)
+                logger.warning(f"Fleet sync failed for user {user_id}: {result['error']}")
+                continue
+
+            self.counters['accounts_synced'] += 1
+            self.counters['activities_imported'] += result.get('synced_activities', 0)
+
+        logger.info(f"Fleet sync metrics: {self.metrics()}")
+        return self.bucket.seconds_until_available()
+
+    def metrics(self):
+        elapsed_minutes = max((self.clock() - self.started_at) / 60, 1 / 60)
+        return {
+            **self.counters,
+            'accounts_per_minute': round(self.counters['accounts_synced'] / elapsed_minutes, 2),
+            'quota_headroom': self.bucket.headroom()
+        }
+
+@click.command('sync-fleet')
+@click.option('--interval', default=300, show_default=True, help='Seconds between passes.')
+@click.option('--min-interval', default=60, show_default=True, help='Minutes before an account is due again.')
+@click.option('--short-term-limit', default=DEFAULT_SHORT_TERM_LIMIT, show_default=True, help='Requests per 15 minutes.')
+@click.option('--daily-limit', default=DEFAULT_DAILY_LIMIT, show_default=True, help='Requests per day.')
+@click.option('--reserve', default=10, show_default=True, help='Requests per window left for user-triggered syncs.')
+@click.option('--once', is_flag=True, help='Run a single pass and exit.')
+@with_appcontext
+def sync_fleet_command(interval, min_interval, short_term_limit, daily_limit, reserve, once):
+    """Periodically sync all active Strava accounts within the API quota"""
+    bucket = TokenBucket(short_term_limit, daily_limit, reserve)
+    scheduler = FleetSyncScheduler(strava_service, bucket, min_interval=timedelta(minutes=min_interval))
+
+    while True:
+        wait = scheduler.run_once()
+        # Release the connection and identity map between passes
+        db.session.remove()
+        if once:
+            break
+        time.sleep(max(wait, interval))
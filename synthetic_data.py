@@ -0,0 +1,296 @@
+import csv
+import io
+import time
+import click
+import numpy as np
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy import func, select, text
+from werkzeug.security import generate_password_hash
+from app import db
+from models import (User, Run, CoinWallet, CoinTransaction, Garden, Plant, Seed, StravaAccount, UserRunStats, IntensityLevel,
+                    XP_PER_KM, XP_PER_LEVEL, BASE_GARDEN_SIZE, MAX_GARDEN_SIZE, MAX_GROWTH)
+from coin_ledger import OPENING
+from rules_engine import intensity_multipliers, coins_for_runs, growth_for_runs, stages_for_growth, STAGE_ORDER
+import logging
+
+logger = logging.getLogger(__name__)
+
+INTENSITIES = list(IntensityLevel)
+# Most runs are moderate, few are flat out
+INTENSITY_WEIGHTS = [0.2, 0.5, 0.22, 0.08]
+# Pace relative to a runner's usual pace, per intensity
+INTENSITY_PACE_FACTORS = np.array([1.1, 1.0, 0.9, 0.82])
+
+# Synthetic Strava ids start here, well clear of real ones in a dev database
+FIRST_ATHLETE_ID = 9_000_000_000
+FIRST_ACTIVITY_ID = 90_000_000_000
+
+US_PER_DAY = 86_400_000_000
+
+def bulk_insert(conn, table, columns, rows):
+    """Insert rows through the fastest path the database offers"""
+    if not rows:
+        return
+    column_list = ', '.join(columns)
+    dbapi_connection = conn.connection.dbapi_connection
+
+    if conn.dialect.name == 'postgresql':
+        # Unquoted empty CSV fields load as NULL
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with dbapi_connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY "{table}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+    elif conn.dialect.name == 'sqlite':
+        cursor = dbapi_connection.cursor()
+        cursor.executemany(f'INSERT INTO "{table}" ({column_list}) VALUES ({", ".join("?" * len(columns))})', rows)
+        cursor.close()
+    else:
+        conn.execute(
+            text(f'INSERT INTO "{table}" ({column_list}) VALUES ({", ".join(":" + column for column in columns)})'),
+            [dict(zip(columns, row)) for row in rows]
+        )
+
+def to_timestamps(microseconds):
+    """Format epoch microseconds the way SQLAlchemy stores naive DateTimes"""
+    return np.char.replace(np.datetime_as_string(microseconds.astype('datetime64[us]'), unit='us'), 'T', ' ').tolist()
+
+class SyntheticDataGenerator:
+    """Generates a reproducible population of users with runs, wallets, gardens and Strava accounts.
+
+    Aggregates are derived from the generated runs with the same rules log_run
+    applies, so the data is consistent with what the API would have produced.
+    """
+
+    def __init__(self, users, runs_per_user=120, history_days=730, strava_share=0.35,
+                 chunk_size=2000, seed=0, password='synthetic-password'):
+        self.users = users
+        self.runs_per_user = runs_per_user
+        self.history_days = history_days
+        self.strava_share = strava_share
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+        self.password = password
+        self.counts = {'users': 0, 'runs': 0, 'plants': 0, 'strava_accounts': 0}
+
+    def run(self):
+        self.now_us = int(datetime.now(timezone.utc).replace(tzinfo=None).timestamp() * 1e6)
+        # Every synthetic user shares one password, so it is hashed once
+        self.password_hash = generate_password_hash(
+            self.password, current_app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+        )
+
+        seeds = db.session.execute(select(Seed.id, Seed.name, Seed.cost_coins).where(Seed.is_available.is_(True))).all()
+        if not seeds:
+            raise click.ClickException('No seeds in the catalog, run flask db-upgrade first')
+        self.seed_ids = np.array([seed.id for seed in seeds])
+        self.seed_names = [seed.name for seed in seeds]
+        self.seed_costs = np.array([seed.cost_coins for seed in seeds])
+
+        self.next_ids = {
+            model: (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+            for model in (User, Run, CoinWallet, CoinTransaction, Garden, Plant, StravaAccount, UserRunStats)
+        }
+        self.next_athlete_id = max(FIRST_ATHLETE_ID, (db.session.execute(select(func.max(StravaAccount.strava_athlete_id))).scalar() or 0) + 1)
+        self.next_activity_id = max(FIRST_ACTIVITY_ID, (db.session.execute(select(func.max(Run.strava_activity_id))).scalar() or 0) + 1)
+
+        started = time.monotonic()
+        for offset in range(0, self.users, self.chunk_size):
+            self.generate_chunk(min(self.chunk_size, self.users - offset))
+            db.session.commit()
+            elapsed = time.monotonic() - started
+            logger.info(f"Generated {self.counts['users']} users, {self.counts['runs']} runs in {elapsed:.1f}s")
+
+        self.finish()
+        return dict(self.counts)
+
+    def take_ids(self, model, count):
+        first = self.next_ids[model]
+        self.next_ids[model] += count
+        return np.arange(first, first + count)
+
+    def generate_chunk(self, n):
+        rng = self.rng
+        conn = db.session.connection()
+        user_ids = self.take_ids(User, n)
+        signed_up = self.now_us - (rng.uniform(14, self.history_days, n) * US_PER_DAY).astype(np.int64)
+        signed_up_at = to_timestamps(signed_up)
+
+        bulk_insert(conn, 'user', ['id', 'email', 'username', 'password_hash', 'created_at', 'is_active'], [
+            (user_id, f'runner{user_id}@synthetic.example', f'runner{user_id}', self.password_hash, created_at, True)
+            for user_id, created_at in zip(user_ids.tolist(), signed_up_at)
+        ])
+
+        # Heavy tailed: most users log a few runs, a few log hundreds
+        sigma = 0.9
+        run_counts = rng.poisson(rng.lognormal(np.log(self.runs_per_user) - sigma ** 2 / 2, sigma, n))
+        run_user = np.repeat(np.arange(n), run_counts)
+        run_total = len(run_user)
+
+        distance = np.clip(rng.lognormal(np.log(6), 0.45, run_total), 1.0, 60.0).round(2)
+        intensity = rng.choice(len(INTENSITIES), run_total, p=INTENSITY_WEIGHTS)
+        usual_pace = np.clip(rng.normal(6.3, 0.9, n), 3.8, 10.0)
+        pace = usual_pace[run_user] * INTENSITY_PACE_FACTORS[intensity] * rng.normal(1.0, 0.04, run_total)
+        duration = np.maximum(1, np.rint(distance * pace)).astype(np.int64)
+        multipliers = intensity_multipliers(INTENSITIES)[intensity]
+        coins = coins_for_runs(distance, multipliers)
+        created = signed_up[run_user] + (rng.random(run_total) * (self.now_us - signed_up[run_user])).astype(np.int64)
+
+        # Insert in time order, as the API would have
+        order = np.argsort(created, kind='stable')
+        run_user, distance, intensity, duration, coins, created = (
+            run_user[order], distance[order], intensity[order], duration[order], coins[order], created[order]
+        )
+        run_pace = duration / distance
+
+        has_strava = rng.random(n) < self.strava_share
+        from_strava = has_strava[run_user] & (rng.random(run_total) < 0.8)
+        activity_ids = np.full(run_total, -1, dtype=np.int64)
+        activity_ids[from_strava] = self.next_activity_id + np.arange(from_strava.sum())
+        self.next_activity_id += int(from_strava.sum())
+
+        intensity_names = [level.name for level in INTENSITIES]
+        bulk_insert(conn, 'run', ['id', 'user_id', 'strava_activity_id', 'distance_km', 'duration_minutes', 'intensity',
+                                  'pace_min_per_km', 'coins_earned', 'created_at'], [
+            (run_id, user_id, activity_id if activity_id >= 0 else None, km, minutes, intensity_names[level], run_pace_value, earned, created_at)
+            for run_id, user_id, activity_id, km, minutes, level, run_pace_value, earned, created_at in zip(
+                self.take_ids(Run, run_total).tolist(), user_ids[run_user].tolist(), activity_ids.tolist(),
+                distance.tolist(), duration.tolist(), intensity.tolist(), run_pace.tolist(), coins.tolist(),
+                to_timestamps(created)
+            )
+        ])
+
+        # Aggregates, derived exactly as log_run would have
+        total_distance = np.bincount(run_user, distance, minlength=n)
+        total_duration = np.bincount(run_user, duration, minlength=n).astype(np.int64)
+        total_coins = np.bincount(run_user, coins, minlength=n).astype(np.int64)
+        experience = np.bincount(run_user, np.trunc(distance * XP_PER_KM), minlength=n).astype(np.int64)
+        best_pace = np.full(n, np.inf)
+        np.minimum.at(best_pace, run_user, run_pace)
+        level = experience // XP_PER_LEVEL + 1
+        size = np.where(level > 1, np.minimum(MAX_GARDEN_SIZE, BASE_GARDEN_SIZE + level), BASE_GARDEN_SIZE)
+
+        garden_ids = self.take_ids(Garden, n)
+        # Each run waters the plants planted before it
+        by_user = np.lexsort((created, run_user))
+        user_runs = (
+            np.searchsorted(run_user[by_user], np.arange(n + 1)),
+            created[by_user],
+            growth_for_runs(distance, multipliers[order])[by_user]
+        )
+        spent, plant_stage_counts = self.generate_plants(conn, garden_ids, signed_up, size, level, total_coins, user_runs)
+
+        bulk_insert(conn, 'garden', ['id', 'user_id', 'name', 'size_x', 'size_y', 'level', 'experience_points', 'created_at'], [
+            (garden_id, user_id, 'My Mystical Garden', garden_size, garden_size, garden_level, xp, created_at)
+            for garden_id, user_id, garden_size, garden_level, xp, created_at in zip(
+                garden_ids.tolist(), user_ids.tolist(), size.tolist(), level.tolist(), experience.tolist(), signed_up_at
+            )
+        ])
+
+        now = to_timestamps(np.array([self.now_us]))[0]
+        bulk_insert(conn, 'coin_wallet', ['id', 'user_id', 'balance', 'total_earned', 'total_spent', 'updated_at'], [
+            (wallet_id, user_id, earned - spent_coins, earned, spent_coins, now)
+            for wallet_id, user_id, earned, spent_coins in zip(
+                self.take_ids(CoinWallet, n).tolist(), user_ids.tolist(), total_coins.tolist(), spent.tolist()
+            )
+        ])
+        # The ledger opens with each balance, as migration 6 does for existing wallets
+        bulk_insert(conn, 'coin_transaction', ['id', 'user_id', 'amount', 'kind', 'applied', 'created_at'], [
+            (transaction_id, user_id, balance, OPENING, True, now)
+            for transaction_id, user_id, balance in zip(
+                self.take_ids(CoinTransaction, n).tolist(), user_ids.tolist(), (total_coins - spent).tolist()
+            )
+        ])
+
+        stage_columns = [f'plants_{stage.value}' for stage in STAGE_ORDER]
+        bulk_insert(conn, 'user_run_stats', ['id', 'user_id', 'total_runs', 'total_distance_km', 'total_duration_minutes',
+                                             'total_coins_earned', 'best_pace_min_per_km'] + stage_columns, [
+            (stats_id, user_id, runs, km, minutes, earned, best if runs else None, *stages)
+            for stats_id, user_id, runs, km, minutes, earned, best, stages in zip(
+                self.take_ids(UserRunStats, n).tolist(), user_ids.tolist(), run_counts.tolist(), total_distance.tolist(),
+                total_duration.tolist(), total_coins.tolist(), best_pace.tolist(), plant_stage_counts.tolist()
+            )
+        ])
+
+        strava_users = np.flatnonzero(has_strava)
+        athlete_ids = self.next_athlete_id + np.arange(len(strava_users))
+        self.next_athlete_id += len(strava_users)
+        connected = signed_up[strava_users] + (rng.random(len(strava_users)) * (self.now_us - signed_up[strava_users])).astype(np.int64)
+        last_sync = self.now_us - (rng.uniform(0.1, 48, len(strava_users)) * 3_600_000_000).astype(np.int64)
+        expires = to_timestamps(np.array([self.now_us + 6 * 3_600_000_000]))[0]
+        bulk_insert(conn, 'strava_account', ['id', 'user_id', 'strava_athlete_id', 'access_token', 'refresh_token', 'expires_at',
+                                             'athlete_firstname', 'athlete_lastname', 'connected_at', 'last_sync', 'is_active'], [
+            (account_id, user_id, athlete_id, f'synthetic-access-{athlete_id}', f'synthetic-refresh-{athlete_id}', expires,
+             'Runner', str(user_id), connected_at, synced_at, True)
+            for account_id, user_id, athlete_id, connected_at, synced_at in zip(
+                self.take_ids(StravaAccount, len(strava_users)).tolist(), user_ids[strava_users].tolist(),
+                athlete_ids.tolist(), to_timestamps(connected), to_timestamps(last_sync)
+            )
+        ])
+
+        self.counts['users'] += n
+        self.counts['runs'] += run_total
+        self.counts['strava_accounts'] += len(strava_users)
+
+    def generate_plants(self, conn, garden_ids, signed_up, size, level, budget, user_runs):
+        """Plant affordable seeds in free cells, returning (coins spent, plant counts per stage) per user"""
+        rng = self.rng
+        n = len(garden_ids)
+        spent = np.zeros(n, dtype=np.int64)
+        stage_counts = np.zeros((n, len(STAGE_ORDER)), dtype=np.int64)
+        rows = []
+
+        for i in range(n):
+            cells = int(size[i]) ** 2
+            wanted = min(cells, rng.poisson(2 + 3 * level[i]))
+            if not wanted:
+                continue
+            picks = rng.integers(0, len(self.seed_ids), wanted)
+            affordable = np.cumsum(self.seed_costs[picks]) <= budget[i]
+            picks = picks[affordable]
+            if not len(picks):
+                continue
+
+            count = len(picks)
+            spent[i] = self.seed_costs[picks].sum()
+            positions = rng.choice(cells, count, replace=False)
+            planted = signed_up[i] + (rng.random(count) * (self.now_us - signed_up[i])).astype(np.int64)
+
+            # Growth from the user's runs after each plant went in, as log_run applies it
+            bounds, run_times, run_growth = user_runs
+            times = run_times[bounds[i]:bounds[i + 1]]
+            cumulative = np.concatenate([[0.0], np.cumsum(run_growth[bounds[i]:bounds[i + 1]])])
+            first_run = np.searchsorted(times, planted, side='left')
+            growth = np.minimum(MAX_GROWTH, cumulative[-1] - cumulative[first_run])
+            stages = stages_for_growth(growth)
+            np.add.at(stage_counts[i], stages, 1)
+            watered = times[-1] if len(times) else self.now_us
+
+            watered_at = to_timestamps(np.array([watered]))[0]
+            for seed_index, position, progress, stage, planted_at in zip(
+                picks.tolist(), positions.tolist(), growth.tolist(), stages.tolist(), to_timestamps(planted)
+            ):
+                rows.append((
+                    int(self.seed_ids[seed_index]), int(garden_ids[i]), self.seed_names[seed_index], STAGE_ORDER[stage].name,
+                    progress, 100.0, watered_at if progress > 0 else None, planted_at, position % int(size[i]), position // int(size[i])
+                ))
+
+        plant_ids = self.take_ids(Plant, len(rows)).tolist()
+        bulk_insert(conn, 'plant', ['id', 'seed_id', 'garden_id', 'name', 'stage', 'growth_progress', 'health',
+                                    'last_watered', 'planted_at', 'position_x', 'position_y'],
+                    [(plant_id, *row) for plant_id, row in zip(plant_ids, rows)])
+        self.counts['plants'] += len(rows)
+        return spent, stage_counts
+
+    def finish(self):
+        with db.engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                # Ids were assigned explicitly, so move the sequences past them
+                for model in self.next_ids:
+                    table = model.__tablename__
+                    conn.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), (SELECT MAX(id) FROM \"{table}\"))"
+                    ))
+            # Fresh planner statistics for the new volume
+            conn.execute(text('ANALYZE'))
@@ -0,0 +1,67 @@
+import itertools
+import os
+import tempfile
+import pytest
+from sqlalchemy import event
+
+# app.py creates an app at import, so point it at a throwaway database before anything imports it
+os.environ.update(
+    DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='garden-tests-'), 'import.db'),
+    JWT_SECRET_KEY='test-secret-key-long-enough-for-hs256',
+    PASSWORD_HASH_EAGER='true',
+    PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+    STRAVA_SYNC_EAGER='true',
+)
+os.environ.pop('DATABASE_REPLICA_URLS', None)
+os.environ.pop('SERVING_MODE', None)
+
+# Loading the app first, as main.py does, lets test modules import any module without circular imports
+from app import create_app, db  # noqa: E402
+
+_usernames = itertools.count(1)
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """An app on its own SQLite database, migrated like a fresh deployment"""
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///' + str(tmp_path / 'test.db'))
+    app = create_app()
+    # No app context is held here: requests must each get their own, as they do when served
+    yield app
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def make_user(client):
+    """Register a user through the API, returning (user id, auth headers)"""
+    def make_user():
+        number = next(_usernames)
+        response = client.post('/auth/register', json={
+            'email': f'runner{number}@example.com', 'username': f'runner{number}', 'password': 'test-password'
+        })
+        assert response.status_code == 201, response.get_json()
+        body = response.get_json()
+        return body['user']['id'], {'Authorization': 'Bearer ' + body['access_token']}
+    return make_user
+
+@pytest.fixture
+def count_statements(app):
+    """Run a function and return how many SQL statements it sent to the database"""
+    with app.app_context():
+        engine = db.engine
+
+    def count_statements(function, *args, **kwargs):
+        statements = []
+        def listener(conn, cursor, statement, *rest):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            function(*args, **kwargs)
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        return len(statements)
+    return count_statements
@@ -0,0 +1,55 @@
+from sqlalchemy import func
+from app import db
+from models import CoinWallet, CoinTransaction
+import coin_ledger
+
+def wallet_of(user_id):
+    db.session.expire_all()
+    return CoinWallet.query.filter_by(user_id=user_id).one()
+
+def ledger_sum(user_id):
+    return db.session.query(func.sum(CoinTransaction.amount)).filter_by(user_id=user_id).scalar() or 0
+
+def test_spend_never_overdraws(app, make_user):
+    user_id, _ = make_user()
+    with app.app_context():
+        coin_ledger.credit(user_id, 30, coin_ledger.RUN)
+        db.session.commit()
+
+        # The wallet alone is short, the pending credit is compacted to cover the spend
+        assert coin_ledger.spend(user_id, 20)
+        assert not coin_ledger.spend(user_id, 11)
+        assert coin_ledger.spend(user_id, 10)
+        assert not coin_ledger.spend(user_id, 1)
+        db.session.commit()
+
+        wallet = wallet_of(user_id)
+        assert (wallet.balance, wallet.total_earned, wallet.total_spent) == (0, 30, 30)
+        assert ledger_sum(user_id) == wallet.balance
+
+def test_credits_are_compacted_once(app, make_user):
+    user_id, _ = make_user()
+    with app.app_context():
+        coin_ledger.credit(user_id, 12, coin_ledger.RUN)
+        coin_ledger.credit(user_id, 5, coin_ledger.STRAVA)
+        db.session.commit()
+
+        assert coin_ledger.compact([user_id]) == {user_id: 17}
+        # Another compactor arriving afterwards finds nothing left to apply
+        assert coin_ledger.compact([user_id]) == {}
+        db.session.commit()
+
+        wallet = wallet_of(user_id)
+        assert (wallet.balance, wallet.total_earned) == (17, 17)
+        assert coin_ledger.balance(user_id) == 17 == ledger_sum(user_id)
+
+def test_new_wallet_includes_pending_credits(app, client, make_user):
+    user_id, headers = make_user()
+    with app.app_context():
+        CoinWallet.query.filter_by(user_id=user_id).delete()
+        coin_ledger.credit(user_id, 40, coin_ledger.RUN)
+        db.session.commit()
+
+    wallet = client.get('/api/wallet', headers=headers).get_json()['wallet']
+    assert (wallet['balance'], wallet['total_earned']) == (40, 40)
+    assert client.get('/api/stats', headers=headers).get_json()['wallet']['balance'] == 40
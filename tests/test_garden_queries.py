@@ -0,0 +1,36 @@
+import pytest
+from app import db
+from models import Garden, Plant, Seed
+
+def plant_garden(user_id, count):
+    """Fill a user's garden row by row with count plants, from every seed in turn"""
+    garden = Garden.query.filter_by(user_id=user_id).one()
+    seed_ids = [seed_id for (seed_id,) in db.session.query(Seed.id).order_by(Seed.id)]
+    db.session.add_all(
+        Plant(garden_id=garden.id, seed_id=seed_ids[i % len(seed_ids)],
+              position_x=i % garden.size_x, position_y=i // garden.size_x)
+        for i in range(count)
+    )
+    db.session.commit()
+
+@pytest.fixture
+def garden_headers(app, make_user):
+    """Auth headers of a user with one plant and of one with a garden of 40"""
+    (small_id, small), (large_id, large) = make_user(), make_user()
+    with app.app_context():
+        plant_garden(small_id, 1)
+        plant_garden(large_id, 40)
+    return small, large
+
+@pytest.mark.parametrize('method, path, body', [
+    ('GET', '/api/garden', None),
+    ('PUT', '/api/garden', {'name': 'Moonlit Meadow'}),
+    ('GET', '/api/stats', None),
+])
+def test_statements_do_not_grow_with_the_garden(client, count_statements, garden_headers, method, path, body):
+    def request(headers):
+        response = client.open(path, method=method, json=body, headers=headers)
+        assert response.status_code == 200, response.get_json()
+
+    small, large = (count_statements(request, headers) for headers in garden_headers)
+    assert small == large
@@ -0,0 +1,19 @@
+import pytest
+from sqlalchemy import create_engine
+from migrations import MIGRATIONS, explain_query, hot_queries, upgrade_schema
+
+@pytest.fixture
+def migrated_engine(app, tmp_path):
+    """A new database brought up to date by the migrations, which a second run leaves alone"""
+    engine = create_engine('sqlite:///' + str(tmp_path / 'migrated.db'))
+    with app.app_context():
+        assert upgrade_schema(engine) == [version for version, _, _ in MIGRATIONS]
+    assert upgrade_schema(engine) == []
+    yield engine
+    engine.dispose()
+
+@pytest.mark.parametrize('name', list(hot_queries()))
+def test_hot_query_uses_an_index(migrated_engine, name):
+    with migrated_engine.connect() as conn:
+        uses_index, plan = explain_query(conn, hot_queries()[name])
+    assert uses_index, f'{name} scans or sorts without an index:\n{plan}'
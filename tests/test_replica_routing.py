@@ -0,0 +1,58 @@
+import shutil
+import time
+import pytest
+from app import create_app, db
+import replicas
+
+STICKY_SECONDS = 1
+
+@pytest.fixture
+def replicated_app(tmp_path, monkeypatch):
+    """An app on a SQLite primary with a replica file, copied from it once by the test"""
+    primary, replica = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{primary}')
+    monkeypatch.setenv('DATABASE_REPLICA_URLS', f'sqlite:///{replica}')
+    monkeypatch.setenv('REPLICA_STICKY_SECONDS', str(STICKY_SECONDS))
+    monkeypatch.setattr(replicas, '_last_writes', {})
+    app = create_app()
+
+    def stop_replicating():
+        """Copy the primary to the replica, which then misses every later write"""
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+        shutil.copyfile(primary, replica)
+
+    yield app, stop_replicating
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+def test_writer_reads_its_writes_from_any_worker(replicated_app):
+    app, stop_replicating = replicated_app
+    client = app.test_client(use_cookies=False)
+
+    def register(name):
+        body = client.post('/auth/register', json={
+            'email': f'{name}@example.com', 'username': name, 'password': 'test-password'
+        }).get_json()
+        return {'Authorization': 'Bearer ' + body['access_token']}
+
+    def total_runs(headers):
+        return client.get('/api/stats', headers=headers).get_json()['running_stats']['total_runs']
+
+    writer, reader = register('writer'), register('reader')
+    stop_replicating()
+    # Past the window of the tokens the registrations issued
+    time.sleep(STICKY_SECONDS)
+
+    run = {'distance_km': 5, 'duration_minutes': 30, 'intensity': 'moderate'}
+    assert client.post('/api/runs', json=run, headers=writer).status_code == 201
+    assert client.post('/api/runs', json=run, headers=reader).status_code == 201
+    time.sleep(STICKY_SECONDS)
+    assert total_runs(reader) == 0, 'reads after the window go to the replica, which missed the run'
+
+    assert client.post('/api/runs', json=run, headers=writer).status_code == 201
+    # Served by another worker, without the cookie: only the primary's record routes the read
+    replicas._last_writes.clear()
+    assert total_runs(writer) == 2
@@ -0,0 +1,65 @@
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+from app import db
+from rules_engine import RulesRecomputation, verify_parity
+from strava_service import strava_service
+
+CHANGES = ['runs_changed', 'wallets_changed', 'gardens_changed', 'plants_changed', 'coin_delta']
+
+def activity(activity_id, start_date, distance_m=8000, moving_time_s=2700):
+    return SimpleNamespace(
+        id=activity_id, type='Run', distance=distance_m, moving_time=timedelta(seconds=moving_time_s),
+        start_date=start_date, start_date_local=start_date.replace(tzinfo=None)
+    )
+
+def test_array_rules_match_the_scalar_rules():
+    assert verify_parity() == []
+
+def test_recompute_with_unchanged_rules_changes_nothing(app, client, make_user):
+    user_id, headers = make_user()
+    now = datetime.now(timezone.utc)
+
+    def post(path, body=None):
+        response = client.post(path, json=body, headers=headers)
+        assert response.status_code in (200, 201), response.get_json()
+
+    def state():
+        garden, runs = (client.get(path, headers=headers) for path in ('/api/garden', '/api/runs?per_page=100'))
+        wallet = client.get('/api/wallet', headers=headers).get_json()['wallet']
+        stats = client.get('/api/stats', headers=headers).get_json()
+        # Recomputing compacts the coin ledger, which rewrites the wallet row with the same balance
+        for wallet_dict in (wallet, stats['wallet']):
+            wallet_dict.pop('updated_at')
+        return {
+            'garden': (garden.get_json()['garden'], garden.headers.get('ETag')),
+            'runs': runs.get_json()['runs'],
+            'wallet': wallet,
+            'stats': stats
+        }
+
+    seed_id = min(client.get('/api/seeds', headers=headers).get_json()['seeds'], key=lambda seed: seed['cost_coins'])['id']
+
+    # Earn enough to plant, then record runs from before and after each plant by every route
+    post('/api/runs', {'distance_km': 12, 'duration_minutes': 60, 'intensity': 'high'})
+    post(f'/api/seeds/{seed_id}/buy', {'position_x': 0, 'position_y': 0})
+    post('/api/runs/batch', {'runs': [
+        {'client_id': 'yesterday', 'distance_km': 6, 'duration_minutes': 35, 'intensity': 'moderate',
+         'created_at': (now - timedelta(days=1)).isoformat()},
+        {'client_id': 'just-now', 'distance_km': 4, 'duration_minutes': 25, 'intensity': 'low'},
+    ]})
+    post(f'/api/seeds/{seed_id}/buy', {'position_x': 1, 'position_y': 0})
+    with app.app_context():
+        strava_service.import_activities(user_id, [
+            activity(1, now - timedelta(days=2)), activity(2, datetime.now(timezone.utc))
+        ])
+        db.session.commit()
+
+    before = state()
+    first, second = sorted(before['garden'][0]['plants'], key=lambda plant: plant['position_x'])
+    # Only the runs after it was planted watered the second plant
+    assert 0 < second['growth_progress'] < first['growth_progress']
+
+    with app.app_context():
+        summary = RulesRecomputation(dry_run=False).run()
+    assert {key: summary[key] for key in CHANGES} == dict.fromkeys(CHANGES, 0)
+    assert state() == before
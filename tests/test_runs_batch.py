@@ -0,0 +1,66 @@
+import pytest
+from sqlalchemy import insert
+from app import db
+from models import Run, IntensityLevel
+import api
+
+def batch(*client_ids):
+    return {'runs': [
+        {'client_id': client_id, 'distance_km': 5, 'duration_minutes': 30, 'intensity': 'moderate'}
+        for client_id in client_ids
+    ]}
+
+@pytest.fixture
+def upload(client, make_user):
+    """Post a batch for a new user, returning the status and body"""
+    _, headers = make_user()
+
+    def upload(body):
+        response = client.post('/api/runs/batch', json=body, headers=headers)
+        return response.status_code, response.get_json()
+    return upload
+
+def statuses(body):
+    return [result['status'] for result in body['results']]
+
+def test_replayed_upload_is_stored_once(client, upload):
+    status, first = upload(batch('a', 'b'))
+    assert status == 201 and statuses(first) == ['created', 'created']
+
+    # The response was lost, so the client sends the same batch again
+    status, replay = upload(batch('a', 'b'))
+    assert status == 200 and statuses(replay) == ['duplicate', 'duplicate']
+    assert replay['coins_earned'] == 0
+    assert [result['run']['id'] for result in replay['results']] == [result['run']['id'] for result in first['results']]
+
+    status, mixed = upload(batch('b', 'c'))
+    assert status == 201 and statuses(mixed) == ['duplicate', 'created']
+    assert mixed['total_coins'] == 3 * first['coins_earned'] // 2
+
+def test_client_id_repeated_within_a_batch(upload):
+    status, body = upload(batch('a', 'a'))
+    assert status == 201 and statuses(body) == ['created', 'duplicate']
+    assert body['results'][1]['run']['id'] == body['results'][0]['run']['id']
+    assert body['coins_earned'] == body['results'][0]['run']['coins_earned']
+
+def test_invalid_client_id_is_reported(upload):
+    status, body = upload(batch('x' * 65, ['a'], 'ok'))
+    assert status == 201 and statuses(body) == ['error', 'error', 'created']
+
+def test_concurrent_replay_is_reported_as_duplicate(app, upload, monkeypatch):
+    # Another request stores run 'a' after this one looked for it
+    get_user_run_stats = api.get_user_run_stats
+    def race(user_id):
+        if not Run.query.filter_by(client_id='a').count():
+            with db.engine.begin() as conn:
+                conn.execute(insert(Run).values(
+                    user_id=user_id, client_id='a', distance_km=5, duration_minutes=30,
+                    intensity=IntensityLevel.MODERATE, coins_earned=60
+                ))
+        return get_user_run_stats(user_id)
+    monkeypatch.setattr(api, 'get_user_run_stats', race)
+
+    status, body = upload(batch('a', 'b'))
+    assert status == 201 and statuses(body) == ['duplicate', 'created']
+    with app.app_context():
+        assert Run.query.filter_by(client_id='a').count() == 1
@@ -0,0 +1,42 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+
+RUNS = 5
+
+@pytest.fixture
+def runner(client, make_user):
+    """Auth headers of a user with RUNS runs a day apart, uploaded in one batch"""
+    _, headers = make_user()
+    start = datetime.now(timezone.utc) - timedelta(days=RUNS)
+    response = client.post('/api/runs/batch', headers=headers, json={'runs': [
+        {'client_id': str(i), 'distance_km': 5 + i, 'duration_minutes': 30, 'intensity': 'moderate',
+         'created_at': (start + timedelta(days=i)).isoformat()}
+        for i in range(RUNS)
+    ]})
+    assert response.status_code == 201
+    return headers
+
+def get_runs(client, headers, query):
+    response = client.get(f'/api/runs?{query}', headers=headers)
+    return response.status_code, response.get_json()
+
+def test_pages_follow_the_cursor(client, runner):
+    status, first = get_runs(client, runner, 'per_page=3')
+    assert status == 200 and first['pagination']['has_more']
+    status, second = get_runs(client, runner, f"per_page=3&cursor={first['pagination']['next_cursor']}")
+    assert status == 200 and not second['pagination']['has_more']
+    assert second['pagination']['next_cursor'] is None
+
+    # Newest first, each run exactly once
+    distances = [run['distance_km'] for run in first['runs'] + second['runs']]
+    assert distances == [5.0 + i for i in reversed(range(RUNS))]
+
+def test_malformed_cursor_is_rejected(client, runner):
+    status, body = get_runs(client, runner, 'cursor=not-a-cursor')
+    assert status == 400 and body['error'] == 'Invalid cursor'
+
+@pytest.mark.parametrize('per_page', [0, -1])
+def test_page_sizes_below_one_use_the_default(client, runner, per_page):
+    status, body = get_runs(client, runner, f'per_page={per_page}')
+    assert status == 200
+    assert body['pagination']['per_page'] == 20 and len(body['runs']) == RUNS
@@ -0,0 +1,27 @@
+from sqlalchemy import event
+from app import db
+from models import UserRunStats
+
+def test_stats_without_an_aggregate_row_are_read_only(app, client, make_user):
+    user_id, headers = make_user()
+    run = {'distance_km': 8, 'duration_minutes': 40, 'intensity': 'moderate'}
+    assert client.post('/api/runs', json=run, headers=headers).status_code == 201
+    expected = client.get('/api/stats', headers=headers).get_json()
+
+    # As for users from before the aggregates existed
+    with app.app_context():
+        UserRunStats.query.filter_by(user_id=user_id).delete()
+        db.session.commit()
+        engine = db.engine
+
+    statements = []
+    def listener(conn, cursor, statement, *rest):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        response = client.get('/api/stats', headers=headers)
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+
+    assert response.status_code == 200 and response.get_json() == expected
+    assert [statement for statement in statements if not statement.lstrip().upper().startswith('SELECT')] == []
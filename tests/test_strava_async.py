@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from flask import jsonify, request
+
+httpx = pytest.importorskip('httpx')
+
+import strava_async  # noqa: E402
+from strava_tasks import strava_bound, strava_call  # noqa: E402
+
+FORWARDED = [(b'x-forwarded-proto', b'https'), (b'x-forwarded-host', b'garden.example.org')]
+
+def scope(path, headers=()):
+    return {
+        'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': b'',
+        'http_version': '1.1', 'scheme': 'http', 'server': ('127.0.0.1', 8000), 'client': ('10.0.0.1', 5123),
+        'headers': [(b'host', b'127.0.0.1:8000'), *headers]
+    }
+
+async def receive():
+    return {'type': 'http.request', 'body': b''}
+
+@pytest.fixture
+def strava_view(app, monkeypatch):
+    """A strava-bound view, its Strava calls answered by answer(request), and what its request went through"""
+    events = []
+    answers = {}
+
+    @app.route('/test/athlete')
+    @strava_bound
+    def athlete_view():
+        try:
+            athlete = yield strava_call('get_athlete', 'token')
+            return jsonify(id=athlete.id, url=request.url)
+        finally:
+            events.append('task closed')
+
+    @app.teardown_request
+    def popped(exc):
+        events.append('request popped')
+
+    async def handler(http_request):
+        return await answers['answer'](http_request)
+
+    monkeypatch.setattr(strava_async, 'transport', httpx.MockTransport(handler))
+
+    def serve(answer, headers=()):
+        answers['answer'] = answer
+        return strava_async.AsyncStravaServer(app), scope('/test/athlete', headers)
+    return serve, events
+
+def test_strava_bound_views_see_forwarded_headers(strava_view):
+    serve, _ = strava_view
+
+    async def answer(http_request):
+        return httpx.Response(200, json={'id': 42})
+
+    async def main():
+        server, request_scope = serve(answer, FORWARDED)
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+        await server(request_scope, receive, send)
+        await server.stop()
+        return sent
+
+    start, body = asyncio.run(main())
+    assert start['status'] == 200
+    assert body['body'] == b'{"id":42,"url":"https://garden.example.org/test/athlete"}\n'
+
+def test_cancelled_request_is_popped(strava_view):
+    serve, events = strava_view
+    calling = asyncio.Event()
+
+    async def answer(http_request):
+        calling.set()
+        await asyncio.Event().wait()
+
+    async def main():
+        server, request_scope = serve(answer)
+
+        async def send(message):
+            pass
+        request_task = asyncio.create_task(server(request_scope, receive, send))
+        await calling.wait()
+        # The client goes away while Strava is answering
+        request_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request_task
+        for _ in range(100):
+            if len(events) == 2:
+                break
+            await asyncio.sleep(0.01)
+        await server.stop()
+
+    asyncio.run(main())
+    assert events == ['task closed', 'request popped']
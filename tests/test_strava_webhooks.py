@@ -0,0 +1,118 @@
+import copy
+import pytest
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+from app import db
+from models import Run, StravaAccount, StravaWebhookEvent, UserRunStats
+from strava_service import strava_service
+import strava_webhooks
+
+ATHLETE_ID = 134815
+ACTIVITY_ID = 1360128428
+
+# Payloads as Strava sends them, trimmed to the fields the app reads
+CREATE_EVENT = {
+    'aspect_type': 'create', 'event_time': 1516126040, 'object_id': ACTIVITY_ID, 'object_type': 'activity',
+    'owner_id': ATHLETE_ID, 'subscription_id': 120475, 'updates': {}
+}
+UPDATE_EVENT = {
+    'aspect_type': 'update', 'event_time': 1516126950, 'object_id': ACTIVITY_ID, 'object_type': 'activity',
+    'owner_id': ATHLETE_ID, 'subscription_id': 120475, 'updates': {'title': 'Tempo run, GPS fixed'}
+}
+ACTIVITY = {
+    'id': ACTIVITY_ID, 'name': 'Tempo run', 'type': 'Run', 'sport_type': 'Run',
+    'distance': 8012.4, 'moving_time': 2880, 'elapsed_time': 2950,
+    'start_date': '2018-01-16T17:20:00Z', 'start_date_local': '2018-01-16T18:20:00Z'
+}
+EDITED_ACTIVITY = {**ACTIVITY, 'name': 'Tempo run, GPS fixed', 'distance': 10021.7, 'moving_time': 3000}
+
+class RecordedStravaClient:
+    """Answers get_activity with the recorded activity JSON, shaped like stravalib's models"""
+    activities = {}
+
+    def __init__(self, access_token=None, requests_session=None):
+        pass
+
+    def get_activity(self, activity_id):
+        data = self.activities[activity_id]
+        return SimpleNamespace(
+            id=data['id'], type=data['type'], distance=data['distance'],
+            moving_time=timedelta(seconds=data['moving_time']),
+            start_date=datetime.fromisoformat(data['start_date']),
+            start_date_local=datetime.fromisoformat(data['start_date_local']).replace(tzinfo=None)
+        )
+
+@pytest.fixture
+def athlete(app, client, make_user, monkeypatch):
+    """A user with a linked Strava account, whose activities come from RecordedStravaClient"""
+    monkeypatch.setattr(strava_service, '_client_class', RecordedStravaClient)
+    monkeypatch.setattr(strava_service, '_clients', {})
+    monkeypatch.setattr(RecordedStravaClient, 'activities', {ACTIVITY_ID: copy.deepcopy(ACTIVITY)})
+
+    user_id, _ = make_user()
+    with app.app_context():
+        db.session.add(StravaAccount(
+            user_id=user_id, strava_athlete_id=ATHLETE_ID, access_token='token', refresh_token='refresh',
+            expires_at=datetime.now(timezone.utc) + timedelta(hours=6)
+        ))
+        db.session.commit()
+
+        def send(event, activity=None):
+            if activity:
+                RecordedStravaClient.activities[ACTIVITY_ID] = copy.deepcopy(activity)
+            # Processed inline, syncs run eagerly in tests
+            assert client.post('/api/strava/webhook', json=event).status_code == 200
+            db.session.expire_all()
+
+        yield user_id, send
+
+def test_update_event_edits_the_stored_run(athlete):
+    user_id, send = athlete
+    send(CREATE_EVENT)
+    run = Run.query.filter_by(strava_activity_id=ACTIVITY_ID).one()
+    assert run.distance_km == pytest.approx(8.0124)
+
+    send(UPDATE_EVENT, EDITED_ACTIVITY)
+    run = Run.query.filter_by(strava_activity_id=ACTIVITY_ID).one()
+    assert run.distance_km == pytest.approx(10.0217)
+    assert run.duration_minutes == 50
+    stats = UserRunStats.query.filter_by(user_id=user_id).one()
+    assert (stats.total_runs, stats.total_distance_km) == (1, pytest.approx(10.0217))
+
+def test_update_event_to_another_sport_removes_the_run(athlete):
+    user_id, send = athlete
+    send(CREATE_EVENT)
+
+    send({**UPDATE_EVENT, 'updates': {'type': 'Ride'}}, {**ACTIVITY, 'type': 'Ride', 'sport_type': 'Ride'})
+    assert Run.query.filter_by(strava_activity_id=ACTIVITY_ID).count() == 0
+    assert UserRunStats.query.filter_by(user_id=user_id).one().total_runs == 0
+
+def test_update_event_for_an_unknown_activity_imports_it(athlete):
+    user_id, send = athlete
+    send(UPDATE_EVENT, EDITED_ACTIVITY)
+    assert Run.query.filter_by(user_id=user_id, strava_activity_id=ACTIVITY_ID).one().distance_km == pytest.approx(10.0217)
+
+def test_renaming_an_activity_leaves_its_run_alone(athlete):
+    user_id, send = athlete
+    send(CREATE_EVENT)
+
+    renamed = RecordedStravaClient().get_activity(ACTIVITY_ID)
+    assert strava_service.update_activities(user_id, [renamed]) == ([], False)
+
+def test_each_event_is_claimed_once(app):
+    with app.app_context():
+        for _ in range(3):
+            strava_webhooks.record_event(CREATE_EVENT)
+
+        # A second worker polling the queue meanwhile finds nothing left to claim
+        first = strava_webhooks.claim_pending_events(batch_size=2)
+        second = strava_webhooks.claim_pending_events()
+        assert [len(first), len(second)] == [2, 1]
+        assert strava_webhooks.claim_pending_events() == []
+
+        # Events left processing by a worker that died are claimed again
+        StravaWebhookEvent.query.filter_by(id=first[0].id).update({
+            'claimed_at': datetime.now(timezone.utc) - strava_webhooks.CLAIM_TIMEOUT - timedelta(minutes=1)
+        })
+        db.session.commit()
+        assert [event.id for event in strava_webhooks.claim_pending_events()] == [first[0].id]
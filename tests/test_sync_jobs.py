@@ -0,0 +1,59 @@
+import pytest
+from datetime import datetime, timezone
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import SyncJob, SyncJobStatus
+import strava_tasks
+import sync_jobs
+
+def add_job(user_id, status=SyncJobStatus.QUEUED, created_at=None):
+    job = SyncJob(id=f'job{SyncJob.query.count()}', user_id=user_id, status=status,
+                  created_at=created_at or datetime.now(timezone.utc))
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+@pytest.fixture
+def user_id(app, make_user):
+    user_id, _ = make_user()
+    with app.app_context():
+        yield user_id
+
+def test_database_allows_one_active_job_per_user(user_id):
+    add_job(user_id, SyncJobStatus.SUCCEEDED)
+    add_job(user_id, SyncJobStatus.FAILED)
+    add_job(user_id, SyncJobStatus.QUEUED)
+    with pytest.raises(IntegrityError):
+        add_job(user_id, SyncJobStatus.RUNNING)
+
+def test_enqueue_returns_the_job_another_worker_queued_first(user_id, monkeypatch):
+    other = add_job(user_id)
+    # As if the other worker's insert landed between our check and our insert
+    find_active_job = sync_jobs.find_active_job
+    calls = []
+    def miss_first_check(user_id):
+        calls.append(user_id)
+        return find_active_job(user_id) if len(calls) > 1 else None
+    monkeypatch.setattr(sync_jobs, 'find_active_job', miss_first_check)
+
+    job, created = sync_jobs.enqueue_sync(user_id)
+    assert not created
+    assert job.id == other.id
+    assert len(calls) == 2
+    assert SyncJob.query.filter_by(user_id=user_id).count() == 1
+
+def test_stale_job_is_failed_and_replaced(user_id):
+    stale = add_job(user_id, created_at=datetime.now(timezone.utc) - sync_jobs.STALE_JOB_AFTER * 2)
+    stale_id = stale.id
+
+    job, created = sync_jobs.enqueue_sync(user_id)
+    assert created
+    assert job.id != stale_id
+    stale = db.session.get(SyncJob, stale_id)
+    assert stale.status == SyncJobStatus.FAILED
+    assert stale.finished_at is not None
+
+    # The stale job is never run if a worker picks it up late
+    strava_tasks.run(sync_jobs.sync_job_task(stale_id))
+    db.session.expire_all()
+    assert db.session.get(SyncJob, stale_id).started_at is None
@@ -0,0 +1,80 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from app import db
+from models import StravaAccount
+from sync_scheduler import FleetSyncScheduler, TokenBucket
+
+class FakeService:
+    """Syncs that fail for the broken users, recording who was synced"""
+
+    def __init__(self, broken):
+        self.broken = broken
+        self.synced = []
+
+    def sync_recent_activities(self, user_id, days_back):
+        self.synced.append(user_id)
+        return {'error': 'Authorization Error'} if user_id in self.broken else {'success': True}
+        yield
+
+def connect_strava(user_id, last_sync=None):
+    db.session.add(StravaAccount(
+        user_id=user_id, strava_athlete_id=1000 + user_id, access_token='token', refresh_token='refresh',
+        expires_at=datetime.now(timezone.utc) + timedelta(hours=6), last_sync=last_sync
+    ))
+    db.session.commit()
+
+def rewind_last_attempt(user_id, by):
+    account = StravaAccount.query.filter_by(user_id=user_id).one()
+    account.last_sync_attempt -= by
+    db.session.commit()
+
+@pytest.fixture
+def accounts(app, make_user):
+    """A never synced account whose syncs fail, and a healthy one synced two hours ago"""
+    (broken, _), (healthy, _) = make_user(), make_user()
+    with app.app_context():
+        connect_strava(broken)
+        connect_strava(healthy, last_sync=datetime.now(timezone.utc) - timedelta(hours=2))
+        yield broken, healthy
+
+def test_failing_account_backs_off(accounts):
+    broken, healthy = accounts
+    service = FakeService({broken})
+    scheduler = FleetSyncScheduler(service, TokenBucket(), min_interval=timedelta(hours=1))
+
+    scheduler.run_once()
+    assert service.synced == [broken, healthy]
+    account = StravaAccount.query.filter_by(user_id=broken).one()
+    assert account.sync_failures == 1 and account.last_sync_attempt is not None
+
+    # Skipped until the backoff passes, then tried again and backed off twice as long
+    service.synced.clear()
+    scheduler.run_once()
+    assert service.synced == [healthy]
+    assert scheduler.metrics()['accounts_backing_off'] == 1
+
+    rewind_last_attempt(broken, timedelta(hours=1))
+    service.synced.clear()
+    scheduler.run_once()
+    assert service.synced == [healthy, broken]
+
+    rewind_last_attempt(broken, timedelta(hours=1))
+    service.synced.clear()
+    scheduler.run_once()
+    assert service.synced == [healthy]
+
+def test_failing_account_does_not_starve_the_budget(accounts):
+    broken, healthy = accounts
+    service = FakeService({broken})
+    # One request per pass
+    scheduler = FleetSyncScheduler(service, TokenBucket(short_term_limit=1), min_interval=timedelta(hours=1))
+
+    scheduler.run_once()
+    assert service.synced == [broken]
+
+    # A failed, never synced account no longer goes first once its backoff is over
+    rewind_last_attempt(broken, timedelta(hours=1))
+    scheduler.bucket = TokenBucket(short_term_limit=1)
+    service.synced.clear()
+    scheduler.run_once()
+    assert service.synced == [healthy]
@@ -1,105 +1,274 @@
 from app import db
-from models import Seed, IntensityLevel
+import base64
+import bisect
+import json
+from datetime import datetime, timezone
+from models import (Seed, IntensityLevel, PlantStage, INTENSITY_MULTIPLIERS, MAX_GROWTH, STAGE_THRESHOLDS,
+                    Garden, Plant, Run, UserRunStats)
+from sqlalchemy import func, case, literal, update, tuple_, select, insert
+from entity_versions import bump_versions
+from serializers import select_runs
+
+COINS_PER_KM = 10
+
+# Bonus coins for longer runs, as (minimum distance in km, bonus)
+DISTANCE_BONUSES = [
+    (10, 50),  # Bonus for 10K+
+    (21.1, 100),  # Bonus for half marathon+
+    (42.2, 200)  # Bonus for marathon+
+]
 
 def calculate_coins_for_run(distance_km, intensity):
     """Calculate coins earned for a run based on distance and intensity"""
     # Base coins: 10 coins per km
-    base_coins = int(distance_km * 10)
+    base_coins = int(distance_km * COINS_PER_KM)
     
     # Intensity multipliers
-    intensity_multipliers = {
-        IntensityLevel.LOW: 1.0,
-        IntensityLevel.MODERATE: 1.2,
-        IntensityLevel.HIGH: 1.5,
-        IntensityLevel.EXTREME: 2.0
-    }
-    
-    multiplier = intensity_multipliers.get(intensity, 1.0)
+    multiplier = INTENSITY_MULTIPLIERS.get(intensity, 1.0)
     total_coins = int(base_coins * multiplier)
     
     # Bonus for longer runs
-    if distance_km >= 10:
-        total_coins += 50  # Bonus for 10K+
-    if distance_km >= 21.1:
-        total_coins += 100  # Bonus for half marathon+
-    if distance_km >= 42.2:
-        total_coins += 200  # Bonus for marathon+
+    for min_distance_km, bonus in DISTANCE_BONUSES:
+        if distance_km >= min_distance_km:
+            total_coins += bonus
     
     return total_coins
 
-def create_default_seeds():
-    """Create default seeds if they don't exist"""
-    default_seeds = [
-        {
-            'name': 'Mystic Rose',
-            'description': 'A beautiful rose that blooms with magical energy. Requires consistent running to flourish.',
-            'cost_coins': 50,
-            'growth_requirements': {
-                'min_weekly_distance': 10,
-                'preferred_intensity': 'moderate'
-            },
-            'rarity': 'common',
-            'plant_type': 'flower'
+def water_garden(garden_id, growth_boost, plant_ids=None):
+    """Grow every plant in a garden, or only plant_ids, with a single UPDATE, matching Plant.grow.
+    
+    Returns the plants' new stages.
+    """
+    new_progress = Plant.growth_progress + growth_boost
+    progress = case((new_progress >= MAX_GROWTH, MAX_GROWTH), else_=new_progress)
+    stage = case(
+        *[(progress >= threshold, literal(stage, Plant.stage.type)) for threshold, stage in STAGE_THRESHOLDS],
+        else_=Plant.stage
+    )
+    
+    stmt = update(Plant).where(Plant.garden_id == garden_id).values(
+        growth_progress=progress,
+        stage=stage,
+        last_watered=datetime.now(timezone.utc)
+    ).returning(Plant.stage).execution_options(synchronize_session=False)
+    if plant_ids is not None:
+        stmt = stmt.where(Plant.id.in_(plant_ids))
+    stages = db.session.execute(stmt).all()
+    if stages:
+        bump_versions(db.session.connection(), Garden, [garden_id])
+    return stages
+
+def as_utc(moment):
+    """Stored datetimes are naive UTC"""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def water_garden_with_runs(garden_id, runs):
+    """Water a garden with runs that may have happened before some of its plants were planted.
+    
+    This is the watering rule, which rules_engine recomputes from run history:
+    every run waters each plant planted by the time the run happened (its
+    created_at) with Plant.growth_boost. Plants that get the same runs are grown
+    with one UPDATE. Returns the stages of all the garden's plants.
+    """
+    now = datetime.now(timezone.utc)
+    runs = sorted(runs, key=lambda run: as_utc(run.created_at or now))
+    times = [as_utc(run.created_at or now) for run in runs]
+    
+    # Growth from each run onwards, so a plant gets the suffix from its first run
+    remaining_growth = [0.0]
+    for run in reversed(runs):
+        remaining_growth.append(remaining_growth[-1] + Plant.growth_boost(run.distance_km, run.intensity))
+    remaining_growth.reverse()
+    
+    plants = db.session.query(Plant.id, Plant.planted_at, Plant.stage).filter(Plant.garden_id == garden_id).all()
+    plants_by_first_run = {}
+    stages = []
+    for plant in plants:
+        first_run = bisect.bisect_left(times, as_utc(plant.planted_at)) if plant.planted_at else 0
+        if first_run < len(runs):
+            plants_by_first_run.setdefault(first_run, []).append(plant.id)
+        else:
+            # Planted after every run, so not watered
+            stages.append(plant)
+    
+    for first_run, plant_ids in plants_by_first_run.items():
+        stages += water_garden(garden_id, remaining_growth[first_run], plant_ids)
+    return stages
+
+def encode_run_cursor(run):
+    """Opaque cursor pointing just past a run in newest-first order"""
+    raw = json.dumps([run.created_at.isoformat(), run.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_run_cursor(cursor):
+    """Return (created_at, id) from a cursor, raising ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, run_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(run_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def page_user_runs(user_id, limit, cursor=None, since=None, until=None):
+    """Fetch a page of run rows newest first, returning (rows, next_cursor).
+
+    Seeks from the cursor on (created_at, id) so every page costs the same,
+    however deep into the history it is. Rows carry the columns of Run.to_dict().
+    """
+    query = select_runs().where(Run.user_id == user_id)
+    if since:
+        query = query.where(Run.created_at >= since)
+    if until:
+        query = query.where(Run.created_at < until)
+    if cursor:
+        query = query.where(tuple_(Run.created_at, Run.id) < decode_run_cursor(cursor))
+
+    # One extra row tells us whether there is another page
+    rows = db.session.execute(query.order_by(Run.created_at.desc(), Run.id.desc()).limit(limit + 1)).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_run_cursor(rows[-1])
+    return rows, None
+
+def count_user_runs(user_id, since=None, until=None):
+    query = db.session.query(func.count(Run.id)).filter(Run.user_id == user_id)
+    if since:
+        query = query.filter(Run.created_at >= since)
+    if until:
+        query = query.filter(Run.created_at < until)
+    return query.scalar()
+
+def new_user_run_stats(user_id):
+    """Create an empty aggregate row for a user with no runs or plants"""
+    stats = UserRunStats(
+        user_id=user_id,
+        total_runs=0,
+        total_distance_km=0.0,
+        total_duration_minutes=0,
+        total_coins_earned=0,
+        plants_seed=0,
+        plants_sprout=0,
+        plants_sapling=0,
+        plants_mature=0,
+        plants_blooming=0
+    )
+    db.session.add(stats)
+    return stats
+
+def rebuild_user_run_stats(user_id):
+    """Recompute a user's aggregate row from their full run history and garden"""
+    stats = UserRunStats.query.filter_by(user_id=user_id).first()
+    if not stats:
+        stats = new_user_run_stats(user_id)
+    return aggregate_user_run_stats(stats, user_id)
+
+def aggregate_user_run_stats(stats, user_id):
+    """Set an aggregate row's values from a user's full run history and garden"""
+    totals = db.session.query(
+        func.count(Run.id),
+        func.coalesce(func.sum(Run.distance_km), 0.0),
+        func.coalesce(func.sum(Run.duration_minutes), 0),
+        func.coalesce(func.sum(Run.coins_earned), 0),
+        func.min(case((Run.pace_min_per_km > 0, Run.pace_min_per_km)))
+    ).filter(Run.user_id == user_id).one()
+    
+    stats.total_runs, stats.total_distance_km, stats.total_duration_minutes, \
+        stats.total_coins_earned, stats.best_pace_min_per_km = totals
+    
+    stage_counts = dict(
+        db.session.query(Plant.stage, func.count(Plant.id))
+        .join(Garden)
+        .filter(Garden.user_id == user_id)
+        .group_by(Plant.stage)
+        .all()
+    )
+    for stage in PlantStage:
+        setattr(stats, f'plants_{stage.value}', stage_counts.get(stage, 0))
+    
+    stats.updated_at = datetime.now(timezone.utc)
+    return stats
+
+def get_user_run_stats(user_id):
+    """Get a user's aggregate row, building it from history the first time"""
+    stats = UserRunStats.query.filter_by(user_id=user_id).first()
+    if not stats:
+        stats = rebuild_user_run_stats(user_id)
+    return stats
+
+# The starting seed catalog, added by migration
+DEFAULT_SEEDS = [
+    {
+        'name': 'Mystic Rose',
+        'description': 'A beautiful rose that blooms with magical energy. Requires consistent running to flourish.',
+        'cost_coins': 50,
+        'growth_requirements': {
+            'min_weekly_distance': 10,
+            'preferred_intensity': 'moderate'
         },
-        {
-            'name': 'Runner\'s Mint',
-            'description': 'An energizing herb that thrives on high-intensity workouts.',
-            'cost_coins': 75,
-            'growth_requirements': {
-                'min_weekly_distance': 15,
-                'preferred_intensity': 'high'
-            },
-            'rarity': 'common',
-            'plant_type': 'herb'
+        'rarity': 'common',
+        'plant_type': 'flower'
+    },
+    {
+        'name': 'Runner\'s Mint',
+        'description': 'An energizing herb that thrives on high-intensity workouts.',
+        'cost_coins': 75,
+        'growth_requirements': {
+            'min_weekly_distance': 15,
+            'preferred_intensity': 'high'
         },
-        {
-            'name': 'Endurance Oak',
-            'description': 'A mighty oak tree that grows stronger with long-distance runs.',
-            'cost_coins': 150,
-            'growth_requirements': {
-                'min_weekly_distance': 25,
-                'preferred_intensity': 'low'
-            },
-            'rarity': 'rare',
-            'plant_type': 'tree'
+        'rarity': 'common',
+        'plant_type': 'herb'
+    },
+    {
+        'name': 'Endurance Oak',
+        'description': 'A mighty oak tree that grows stronger with long-distance runs.',
+        'cost_coins': 150,
+        'growth_requirements': {
+            'min_weekly_distance': 25,
+            'preferred_intensity': 'low'
         },
-        {
-            'name': 'Speed Lotus',
-            'description': 'An exotic lotus that responds to bursts of extreme intensity.',
-            'cost_coins': 200,
-            'growth_requirements': {
-                'min_weekly_distance': 20,
-                'preferred_intensity': 'extreme'
-            },
-            'rarity': 'rare',
-            'plant_type': 'flower'
+        'rarity': 'rare',
+        'plant_type': 'tree'
+    },
+    {
+        'name': 'Speed Lotus',
+        'description': 'An exotic lotus that responds to bursts of extreme intensity.',
+        'cost_coins': 200,
+        'growth_requirements': {
+            'min_weekly_distance': 20,
+            'preferred_intensity': 'extreme'
         },
-        {
-            'name': 'Phoenix Fern',
-            'description': 'A legendary fern that only grows for the most dedicated runners.',
-            'cost_coins': 500,
-            'growth_requirements': {
-                'min_weekly_distance': 50,
-                'preferred_intensity': 'high'
-            },
-            'rarity': 'epic',
-            'plant_type': 'fern'
+        'rarity': 'rare',
+        'plant_type': 'flower'
+    },
+    {
+        'name': 'Phoenix Fern',
+        'description': 'A legendary fern that only grows for the most dedicated runners.',
+        'cost_coins': 500,
+        'growth_requirements': {
+            'min_weekly_distance': 50,
+            'preferred_intensity': 'high'
         },
-        {
-            'name': 'Celestial Bamboo',
-            'description': 'Divine bamboo that reaches toward the heavens with every mile you run.',
-            'cost_coins': 1000,
-            'growth_requirements': {
-                'min_weekly_distance': 100,
-                'preferred_intensity': 'moderate'
-            },
-            'rarity': 'legendary',
-            'plant_type': 'bamboo'
-        }
-    ]
-    
-    for seed_data in default_seeds:
-        existing_seed = Seed.query.filter_by(name=seed_data['name']).first()
-        if not existing_seed:
-            seed = Seed(**seed_data)
-            db.session.add(seed)
+        'rarity': 'epic',
+        'plant_type': 'fern'
+    },
+    {
+        'name': 'Celestial Bamboo',
+        'description': 'Divine bamboo that reaches toward the heavens with every mile you run.',
+        'cost_coins': 1000,
+        'growth_requirements': {
+            'min_weekly_distance': 100,
+            'preferred_intensity': 'moderate'
+        },
+        'rarity': 'legendary',
+        'plant_type': 'bamboo'
+    }
+]
+
+def create_default_seeds(conn):
+    """Add any default seeds missing from the catalog, returning how many were added"""
+    existing = set(conn.execute(select(Seed.name)).scalars())
+    missing = [seed_data for seed_data in DEFAULT_SEEDS if seed_data['name'] not in existing]
+    if missing:
+        conn.execute(insert(Seed), missing)
+    return len(missing)